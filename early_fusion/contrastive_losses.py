@@ -0,0 +1,146 @@
+# memory-bounded contrastive losses: the similarity matrix is computed in (chunk_size x chunk_size) tiles, the row
+# log-sum-exp is accumulated over the column tiles (logaddexp), and the backward pass recomputes the tiles (softmax from
+# the saved row log-sum-exp) instead of keeping them, so the memory is O(chunk_size^2 + N * D) instead of O(N^2)
+#   nt_xent_loss: NT-Xent over the 2B embeddings of the two modalities (positive: the same sample in the other modality,
+#                 negatives: the 2B - 2 others; the self-similarities are excluded by index, without an eye mask)
+#   info_nce_loss: InfoNCE of queries against keys (positive of query i: key i, the other keys, e.g. queued ones, are negatives)
+#   clip_loss:    symmetric InfoNCE (CLIP) of the two modalities
+# the inputs are expected to be L2-normalized already (CrossModelGatedEncoder normalizes its outputs); the gradients are
+# exact (same as the dense losses, see contrastive_trainer.py for the training loop)
+# python contrastive_losses.py --batch_size 16384 --dim 256    # time and peak memory of a forward/backward pass on the cpu
+import time
+import resource
+import argparse
+import torch
+import torch.nn.functional as F
+
+
+def _chunks(n, chunk_size):
+    return [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+
+def _tile_logits(x, y, r, c, temperature, exclude_diagonal):
+    logits = x[r[0]:r[1]] @ y[c[0]:c[1]].T / temperature
+    if exclude_diagonal and r[0] < c[1] and c[0] < r[1]:  # (tile crossing the diagonal: mask the self-similarities)
+        start, end = max(r[0], c[0]), min(r[1], c[1])
+        idx = torch.arange(start, end, device=x.device)
+        logits[idx - r[0], idx - c[0]] = -float('inf')
+    return logits
+
+
+def _row_logsumexp(x, y, temperature, chunk_size, exclude_diagonal=False):
+    lse = torch.full((x.size(0),), -float('inf'), dtype=x.dtype, device=x.device)
+    for r in _chunks(x.size(0), chunk_size):
+        for c in _chunks(y.size(0), chunk_size):
+            tile = _tile_logits(x, y, r, c, temperature, exclude_diagonal)
+            lse[r[0]:r[1]] = torch.logaddexp(lse[r[0]:r[1]], torch.logsumexp(tile, dim=1))
+    return lse
+
+
+def _softmax_products(x, y, lse, temperature, chunk_size, exclude_diagonal=False, need_y=True):
+    # P @ y and P^T @ x of the row softmax P = exp(x y^T / T - lse), tile by tile
+    grad_x = torch.zeros_like(x)
+    grad_y = torch.zeros_like(y) if need_y else None
+    for r in _chunks(x.size(0), chunk_size):
+        for c in _chunks(y.size(0), chunk_size):
+            p = torch.exp(_tile_logits(x, y, r, c, temperature, exclude_diagonal) - lse[r[0]:r[1], None])
+            grad_x[r[0]:r[1]] += p @ y[c[0]:c[1]]
+            if need_y:
+                grad_y[c[0]:c[1]] += p.T @ x[r[0]:r[1]]
+    return grad_x, grad_y
+
+
+class _NTXent(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, z1, z2, temperature, chunk_size):
+        z = torch.cat([z1, z2], dim=0)
+        positives = torch.cat([z2, z1], dim=0)
+        lse = _row_logsumexp(z, z, temperature, chunk_size, exclude_diagonal=True)
+        ctx.save_for_backward(z, lse)
+        ctx.temperature, ctx.chunk_size = temperature, chunk_size
+        return (lse - (z * positives).sum(dim=1) / temperature).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        z, lse = ctx.saved_tensors
+        n, batch_size = z.size(0), z.size(0) // 2
+        # d/dz_i: sum_j (P_ij + P_ji) z_j - 2 z_pos(i) (z_i is the positive of its own positive), / (N T)
+        grad_rows, grad_cols = _softmax_products(z, z, lse, ctx.temperature, ctx.chunk_size, exclude_diagonal=True)
+        positives = torch.cat([z[batch_size:], z[:batch_size]], dim=0)
+        grad = (grad_rows + grad_cols - 2 * positives) * (grad_output / (n * ctx.temperature))
+        return grad[:batch_size], grad[batch_size:], None, None
+
+
+class _InfoNCE(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, queries, keys, temperature, chunk_size):
+        lse = _row_logsumexp(queries, keys, temperature, chunk_size)
+        ctx.save_for_backward(queries, keys, lse)
+        ctx.temperature, ctx.chunk_size = temperature, chunk_size
+        return (lse - (queries * keys[:queries.size(0)]).sum(dim=1) / temperature).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        queries, keys, lse = ctx.saved_tensors
+        batch_size = queries.size(0)
+        need_keys = ctx.needs_input_grad[1]
+        grad_queries, grad_keys = _softmax_products(queries, keys, lse, ctx.temperature, ctx.chunk_size,
+                                                    need_y=need_keys)
+        scale = grad_output / (batch_size * ctx.temperature)
+        grad_queries = (grad_queries - keys[:batch_size]) * scale
+        if need_keys:
+            grad_keys[:batch_size] -= queries
+            grad_keys = grad_keys * scale
+        return grad_queries, grad_keys, None, None
+
+
+def nt_xent_loss(z1, z2, temperature=0.1, chunk_size=2048): # z1 and z2 are normalized embeddings from two modalities obtained from the encoder (embeddings from the same samples in different modalities)
+    return _NTXent.apply(z1, z2, temperature, chunk_size)
+
+
+def info_nce_loss(queries, keys, temperature=0.1, chunk_size=2048):
+    """
+    :param queries: [B, D] normalized embeddings
+    :param keys: [M, D] normalized embeddings (M >= B), key i is the positive of query i; no gradient if keys don't require it
+    """
+    return _InfoNCE.apply(queries, keys, temperature, chunk_size)
+
+
+def clip_loss(z1, z2, temperature=0.1, chunk_size=2048):
+    # symmetric InfoNCE: each modality against the other
+    return (info_nce_loss(z1, z2, temperature, chunk_size) + info_nce_loss(z2, z1, temperature, chunk_size)) / 2
+
+
+def dense_nt_xent_loss(z1, z2, temperature=0.1):
+    # reference: the full (2B, 2B) similarity matrix (the loss of the scripts before the tiled version)
+    batch_size = z1.size(0)
+    z = torch.cat([z1, z2], dim=0)
+    sim_matrix = z @ z.T / temperature
+    sim_matrix.fill_diagonal_(-float('inf'))
+    labels = torch.cat([torch.arange(batch_size, device=z1.device) + batch_size,
+                        torch.arange(batch_size, device=z1.device)])
+    return F.cross_entropy(sim_matrix, labels)
+
+
+LOSSES = {'nt_xent': nt_xent_loss, 'clip': clip_loss}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16384)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--chunk_size', type=int, default=2048)
+    parser.add_argument('--loss', type=str, default='nt_xent', choices=list(LOSSES))
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    z1 = F.normalize(torch.randn(opt.batch_size, opt.dim), dim=1).requires_grad_()
+    z2 = F.normalize(torch.randn(opt.batch_size, opt.dim), dim=1).requires_grad_()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    loss = LOSSES[opt.loss](z1, z2, chunk_size=opt.chunk_size)
+    loss.backward()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{opt.loss} of batch size {opt.batch_size} (dim {opt.dim}, tiles {opt.chunk_size}): loss {loss.item():.4f}, "
+          f"forward + backward in {time.perf_counter() - start:.1f} s, peak RSS +{rss_after - rss_before:.0f} MB "
+          f"(a dense (2B, 2B) float32 similarity matrix alone: {(2 * opt.batch_size) ** 2 * 4 / 2 ** 20:.0f} MB)")
@@ -0,0 +1,209 @@
+# contrastive training of the cross-modal encoder of early_fusion_crossmodal.py / early_fusion_contrastive_learner.py
+#   the training embeddings are moved to the device once, every epoch is a permutation of the samples sliced on the device,
+#   and the loss is accumulated on the device (one host sync per epoch instead of one .item() per step)
+#   queue_size > 0: MoCo-style negatives; a momentum (EMA) copy of the encoder embeds the keys, and the keys of the last
+#                   queue_size samples of each modality are kept in a queue, so the number of negatives is not limited by
+#                   the batch size (queue_size = 0: NT-Xent over the 2 * batch_size - 2 in-batch negatives as before, or CLIP)
+#   optional torch.compile of the encoder and fused AdamW; samples/s are reported for every epoch
+#   the losses (contrastive_losses.py) never build the full similarity matrix, so large batches fit in memory
+# python contrastive_trainer.py --n_samples 4096 --batch_size 256 --queue_size 4096 --epochs 5   # synthetic benchmark
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.optim.lr_scheduler import CosineAnnealingLR
+from contrastive_losses import LOSSES, info_nce_loss
+
+
+# define the cross modal model that will be trained using a contrastive loss
+class CrossModelGatedEncoder(nn.Module):
+    def __init__(self, emb_dim=1024, hidden_dim=256, proj_dim=128):
+        super().__init__()
+        self.rna_attn = nn.Linear(emb_dim, emb_dim)
+        self.wsi_attn = nn.Linear(emb_dim, emb_dim)
+
+        self.rna_encoder = nn.Sequential(
+            nn.Linear(emb_dim, hidden_dim),
+            nn.ReLU(),
+            nn.Linear(hidden_dim, proj_dim)
+        )
+
+        self.wsi_encoder = nn.Sequential(
+            nn.Linear(emb_dim, hidden_dim),
+            nn.ReLU(),
+            nn.Linear(hidden_dim, proj_dim)
+        )
+
+    def forward(self, rna_emb, wsi_emb):
+        rna_weighted = rna_emb * torch.sigmoid(self.rna_attn(rna_emb))
+        wsi_weighted = wsi_emb * torch.sigmoid(self.wsi_attn(wsi_emb))
+
+        rna_proj = F.normalize(self.rna_encoder(rna_weighted), dim=1)
+        wsi_proj = F.normalize(self.wsi_encoder(wsi_weighted), dim=1)
+
+        return rna_proj, wsi_proj # returns normalized attention-weighted embeddings
+
+
+def queue_contrastive_loss(q_rna, q_wsi, k_rna, k_wsi, queue_rna, queue_wsi, temperature=0.1, chunk_size=2048):
+    """
+    cross-modal InfoNCE with the keys of the batch and the queued keys of the other modality as candidates
+    :param q_rna, q_wsi: [B, D] normalized queries (encoder)
+    :param k_rna, k_wsi: [B, D] normalized keys (momentum encoder, no gradient)
+    :param queue_rna, queue_wsi: [Q, D] normalized keys of previous batches
+    """
+    return (info_nce_loss(q_rna, torch.cat([k_wsi, queue_wsi], dim=0), temperature, chunk_size) +
+            info_nce_loss(q_wsi, torch.cat([k_rna, queue_rna], dim=0), temperature, chunk_size)) / 2
+
+
+class KeyQueue:
+    # ring buffer of the last `size` keys of a modality (on the device of the training)
+    def __init__(self, size, dim, device):
+        self.keys = torch.zeros(size, dim, device=device)
+        self.ptr = 0
+        self.filled = 0
+
+    @torch.no_grad()
+    def enqueue(self, keys):
+        keys = keys[-len(self.keys):]
+        end = self.ptr + len(keys)
+        if end <= len(self.keys):
+            self.keys[self.ptr:end] = keys
+        else:
+            split = len(self.keys) - self.ptr
+            self.keys[self.ptr:] = keys[:split]
+            self.keys[:end - len(self.keys)] = keys[split:]
+        self.ptr = end % len(self.keys)
+        self.filled = min(self.filled + len(keys), len(self.keys))
+
+    def negatives(self):
+        return self.keys[:self.filled]
+
+
+class ContrastiveTrainer:
+    """
+    trains a two-modality encoder (forward(rna, wsi) -> normalized rna_proj, wsi_proj) with a contrastive loss
+    """
+    def __init__(self, encoder, lr=1e-2, weight_decay=0.0, epochs=200, batch_size=32, temperature=0.1, queue_size=0,
+                 momentum=0.99, device=None, compile=False, fused=True, drop_last=False, seed=None, loss='nt_xent',
+                 chunk_size=2048):
+        self.device = torch.device(device) if device is not None else torch.device(
+            'cuda' if torch.cuda.is_available() else 'cpu')
+        self.encoder = encoder.to(self.device)
+        self.epochs, self.batch_size, self.temperature = epochs, batch_size, temperature
+        self.queue_size, self.momentum, self.drop_last = queue_size, momentum, drop_last
+        self.loss_fn, self.chunk_size = LOSSES[loss], chunk_size
+        # permutations on the cpu (as the previous training loop), from the global RNG unless a seed is given
+        self.generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        # fused AdamW (one kernel for all the parameters; weight_decay=0 is Adam); foreach if fused isn't supported here
+        try:
+            self.optimizer = torch.optim.AdamW(self.encoder.parameters(), lr=lr, weight_decay=weight_decay,
+                                               fused=fused or None)
+        except RuntimeError:
+            self.optimizer = torch.optim.AdamW(self.encoder.parameters(), lr=lr, weight_decay=weight_decay, foreach=True)
+        self.scheduler = CosineAnnealingLR(self.optimizer, T_max=epochs)
+        self.forward = torch.compile(self.encoder) if compile else self.encoder
+        if queue_size > 0:
+            self.key_encoder = copy.deepcopy(self.encoder).requires_grad_(False)
+            self.key_forward = torch.compile(self.key_encoder) if compile else self.key_encoder
+        self.history = []
+
+    @torch.no_grad()
+    def _update_key_encoder(self):
+        key_params, params = list(self.key_encoder.parameters()), list(self.encoder.parameters())
+        torch._foreach_mul_(key_params, self.momentum)
+        torch._foreach_add_(key_params, params, alpha=1 - self.momentum)
+
+    def _step(self, rna_batch, wsi_batch, queues):
+        self.optimizer.zero_grad(set_to_none=True)
+        rna_proj, wsi_proj = self.forward(rna_batch, wsi_batch)
+        if queues is None:
+            loss = self.loss_fn(rna_proj, wsi_proj, self.temperature, self.chunk_size)
+        else:
+            with torch.no_grad():
+                self._update_key_encoder()
+                k_rna, k_wsi = self.key_forward(rna_batch, wsi_batch)
+            loss = queue_contrastive_loss(rna_proj, wsi_proj, k_rna, k_wsi, queues[0].negatives(),
+                                          queues[1].negatives(), self.temperature, self.chunk_size)
+        loss.backward()
+        self.optimizer.step()
+        if queues is not None:
+            queues[0].enqueue(k_rna)
+            queues[1].enqueue(k_wsi)
+        return loss.detach()
+
+    def fit(self, rna, wsi, verbose=True):
+        """
+        :param rna, wsi: [n_samples, emb_dim] embeddings of the same samples in the two modalities
+        :return: history (per epoch loss (mean over the steps), lr, samples/s)
+        """
+        rna, wsi = rna.to(self.device, torch.float32), wsi.to(self.device, torch.float32)
+        n = rna.size(0)
+        queues = None
+        if self.queue_size > 0:
+            # a queue spanning the whole training set would hold the keys of a sample's own previous epoch as negatives
+            queue_size = min(self.queue_size, n - self.batch_size)
+            if queue_size < self.queue_size:
+                print(f"Warning: queue_size {self.queue_size} reduced to {max(queue_size, 0)} (training samples {n} - "
+                      f"batch_size {self.batch_size})" + (", in-batch negatives only" if queue_size <= 0 else ""))
+            if queue_size > 0:
+                with torch.no_grad():
+                    dim = self.key_encoder(rna[:1], wsi[:1])[0].size(1)
+                queues = (KeyQueue(queue_size, dim, self.device), KeyQueue(queue_size, dim, self.device))
+        last_start = n - self.batch_size if self.drop_last else n - 1
+        self.encoder.train()
+        for epoch in range(self.epochs):
+            start = time.perf_counter()
+            permutation = torch.randperm(n, generator=self.generator).to(self.device)
+            epoch_loss = torch.zeros((), device=self.device)
+            steps = 0
+            for i in range(0, max(last_start, 0) + 1, self.batch_size):
+                indices = permutation[i:i + self.batch_size]
+                epoch_loss += self._step(rna[indices], wsi[indices], queues)
+                steps += 1
+            self.scheduler.step()  # Update the learning rate after each epoch
+            epoch_loss = epoch_loss.item() / max(steps, 1)  # (the only host sync of the epoch)
+            elapsed = time.perf_counter() - start
+            record = {'epoch': epoch + 1, 'loss': epoch_loss, 'lr': self.scheduler.get_last_lr()[0],
+                      'samples_per_s': n / elapsed}
+            self.history.append(record)
+            if verbose:
+                print(f"Epoch {record['epoch']}, Loss: {record['loss']:.4f}, LR: {record['lr']:.6f}, "
+                      f"{record['samples_per_s']:.0f} samples/s")
+        return self.history
+
+    @torch.no_grad()
+    def encode(self, rna, wsi, batch_size=4096):
+        # normalized projections of all the samples (on the cpu), in batches
+        self.encoder.eval()
+        outputs = [self.encoder(rna[i:i + batch_size].to(self.device, torch.float32),
+                                wsi[i:i + batch_size].to(self.device, torch.float32))
+                   for i in range(0, rna.size(0), batch_size)]
+        return tuple(torch.cat([output[m] for output in outputs]).cpu() for m in range(2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=4096)
+    parser.add_argument('--emb_dim', type=int, default=1024)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--queue_size', type=int, default=0)
+    parser.add_argument('--loss', type=str, default='nt_xent', choices=list(LOSSES))
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--compile', action='store_true')
+    opt = parser.parse_args()
+
+    # two views of shared latent factors
+    torch.manual_seed(0)
+    latent = torch.randn(opt.n_samples, 64)
+    rna = latent @ torch.randn(64, opt.emb_dim) + 0.5 * torch.randn(opt.n_samples, opt.emb_dim)
+    wsi = latent @ torch.randn(64, opt.emb_dim) + 0.5 * torch.randn(opt.n_samples, opt.emb_dim)
+    trainer = ContrastiveTrainer(CrossModelGatedEncoder(opt.emb_dim, 512, 256), lr=1e-3, epochs=opt.epochs,
+                                 batch_size=opt.batch_size, queue_size=opt.queue_size, device=opt.device,
+                                 compile=opt.compile, seed=0, loss=opt.loss)
+    trainer.fit(rna, wsi)
+    rna_proj, wsi_proj = trainer.encode(rna, wsi)
+    top1 = ((rna_proj @ wsi_proj.T).argmax(dim=1) == torch.arange(opt.n_samples)).float().mean().item()
+    print(f"cross-modal top-1 retrieval on the training samples: {top1:.3f}")
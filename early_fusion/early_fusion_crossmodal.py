@@ -28,6 +28,7 @@ import torchtuples as tt
 from pycox.models import CoxPH
 # from pycox.evaluation import concordance_index
 import argparse
+from contrastive_trainer import CrossModelGatedEncoder, ContrastiveTrainer
 
 from pdb import set_trace
 
@@ -64,6 +65,18 @@ def parse_args():
                         help='Apply PCA dimensionality reduction')
     parser.add_argument('--use_model', type=str, default='snn', choices=['snn', 'gbst'],
                         help='Model type: gradient boosted survival tree (gbst) or survival neural network (snn)')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size of the contrastive training')
+    parser.add_argument('--epochs', type=int, default=200, help='Epochs of the contrastive training')
+    parser.add_argument('--temperature', type=float, default=0.1, help='Temperature of the contrastive loss')
+    parser.add_argument('--queue_size', type=int, default=0,
+                        help='Queued negatives per modality (MoCo-style, momentum encoder); 0: in-batch negatives only')
+    parser.add_argument('--queue_momentum', type=float, default=0.99, help='EMA momentum of the key encoder')
+    parser.add_argument('--device', type=str, default=None, help='Device of the contrastive training (default: cuda if available)')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the encoder')
+    parser.add_argument('--loss', type=str, default='nt_xent', choices=['nt_xent', 'clip'],
+                        help='Contrastive loss (without queue): NT-Xent or symmetric InfoNCE (CLIP)')
+    parser.add_argument('--loss_chunk_size', type=int, default=2048,
+                        help='Tile size of the similarity matrix in the contrastive losses (bounds their memory)')
     # parser.add_argument('--mode', type=str, default='only_wsi', 
     #                     choices=['rnaseq_wsi', 'only_rnaseq', 'only_wsi'],
     #                     help='Data modality to use')
@@ -172,62 +185,7 @@ train_wsi_norm = scaler_wsi.fit_transform(train_wsi_embs_array)
 test_wsi_norm = scaler_wsi.transform(test_wsi_embs_array)
 
 
-# define the cross modal model that will be trained using a contrastive loss
-class CrossModelGatedEncoder(nn.Module):
-    def __init__(self, emb_dim=1024, hidden_dim=256, proj_dim=128):
-        super().__init__()
-        self.rna_attn = nn.Linear(emb_dim, emb_dim)
-        self.wsi_attn = nn.Linear(emb_dim, emb_dim)
-
-        self.rna_encoder = nn.Sequential(
-            nn.Linear(emb_dim, hidden_dim),
-            nn.ReLU(),
-            nn.Linear(hidden_dim, proj_dim)
-        )
-
-        self.wsi_encoder = nn.Sequential(
-            nn.Linear(emb_dim, hidden_dim),
-            nn.ReLU(),
-            nn.Linear(hidden_dim, proj_dim)
-        )
-
-    #     # Apply custom weight initialization to all layers
-    #     self.apply(self._init_weights)
-
-    # def _init_weights(self, m):
-    #     """Weight initialization: Xavier uniform for weights, zeros for biases."""
-    #     if isinstance(m, nn.Linear):
-    #         nn.init.xavier_uniform_(m.weight)
-    #         nn.init.zeros_(m.bias)
-
-    def forward(self, rna_emb, wsi_emb):
-        rna_weighted = rna_emb * torch.sigmoid(self.rna_attn(rna_emb))
-        wsi_weighted = wsi_emb * torch.sigmoid(self.wsi_attn(wsi_emb))
-
-        rna_proj = F.normalize(self.rna_encoder(rna_weighted), dim=1)
-        wsi_proj = F.normalize(self.wsi_encoder(wsi_weighted), dim=1)
-
-        return rna_proj, wsi_proj # returns normalized attention-weighted embeddings
-
-# contrastive Loss (NT-Xent)
-def nt_xent_loss(z1, z2, temperature=0.1): # z1 and z2 are normalized embeddings from two modalities obtained from the encoder (embeddings from the same samples in different modalities)
-    batch_size = z1.size(0)
-    z = torch.cat([z1, z2], dim=0)
-    # sim_matrix = F.cosine_similarity(z.unsqueeze(1), z.unsqueeze(0), dim=2) / temperature  # compute the similarity score
-    z_norm = F.normalize(z, dim=1)
-    sim_matrix = torch.einsum('ik,jk->ij', z_norm, z_norm) / temperature
-    # mask out the diagonal entries to not use self-similarities
-    mask = torch.eye(batch_size * 2, dtype=torch.bool).to(z.device)
-    sim_matrix.masked_fill_(mask, -float('inf'))
-    
-    # labels pointing each example to its positive counterpart
-    labels = torch.cat([
-        torch.arange(batch_size, device=z1.device) + batch_size,
-        torch.arange(batch_size, device=z1.device)
-    ])
-    # set_trace()
-    loss = F.cross_entropy(sim_matrix, labels)
-    return loss
+# the cross modal model (CrossModelGatedEncoder) is in contrastive_trainer.py, the contrastive losses in contrastive_losses.py
 
 # normalize embeddings
 scaler_rna = StandardScaler()
@@ -239,49 +197,29 @@ train_wsi = torch.tensor(scaler_wsi.fit_transform(train_wsi_embs_array)).float()
 test_rna = torch.tensor(scaler_rna.transform(test_rna_embs.values)).float()
 test_wsi = torch.tensor(scaler_wsi.transform(test_wsi_embs_array)).float()
 
-# train the cross-modal encoder
-batch_size = 32
-epochs = 200
+# train the cross-modal encoder (embeddings moved to args.device once, see contrastive_trainer.py)
 encoder = CrossModelGatedEncoder(1024, 512, 256)
-optimizer = optim.Adam(encoder.parameters(), lr=1e-2)
-scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
+trainer = ContrastiveTrainer(encoder, lr=1e-2, epochs=args.epochs, batch_size=args.batch_size,
+                             temperature=args.temperature, queue_size=args.queue_size, momentum=args.queue_momentum,
+                             device=args.device, compile=args.compile, loss=args.loss,
+                             chunk_size=args.loss_chunk_size)
 # scheduler = ExponentialLR(optimizer, gamma=0.99)  
 
 # train the contrastive encoder to generate cross modality informed embeddings
-encoder.train()
-for epoch in range(epochs):
-    permutation = torch.randperm(train_rna.size(0))
-    epoch_loss = 0.0
-    for i in range(0, train_rna.size(0), batch_size):
-        indices = permutation[i:i+batch_size]
-        rna_batch, wsi_batch = train_rna[indices], train_wsi[indices]
-        optimizer.zero_grad()
-        rna_proj, wsi_proj = encoder(rna_batch, wsi_batch)
-        # set_trace()
-        loss = nt_xent_loss(rna_proj, wsi_proj)
-        loss.backward()
-        optimizer.step()
-        epoch_loss += loss.item()
-
-    scheduler.step()  # Update the learning rate after each epoch
-
-    current_lr = scheduler.get_last_lr()[0]
-    print(f'Epoch {epoch+1}, Loss: {epoch_loss:.4f}, LR: {current_lr:.6f}')
+trainer.fit(train_rna, train_wsi)
 
 # get fused embeddings for GBST
-encoder.eval()
 # with torch.no_grad():
 #     fused_train = torch.cat(encoder(train_rna, train_wsi), dim=1).numpy()
 #     fused_test = torch.cat(encoder(test_rna, test_wsi), dim=1).numpy()
 
-with torch.no_grad():
-    rna_proj, wsi_proj = encoder(train_rna, train_wsi)
-    rna_weight = 0.8 #0.5 #0.8
-    wsi_weight = 0.2 #0.5 #0.2
-    fused_train = (rna_proj * rna_weight + wsi_proj * wsi_weight).numpy()
+rna_proj, wsi_proj = trainer.encode(train_rna, train_wsi)
+rna_weight = 0.8 #0.5 #0.8
+wsi_weight = 0.2 #0.5 #0.2
+fused_train = (rna_proj * rna_weight + wsi_proj * wsi_weight).numpy()
 
-    rna_proj_test, wsi_proj_test = encoder(test_rna, test_wsi)
-    fused_test = (rna_proj_test * rna_weight + wsi_proj_test * wsi_weight).numpy()
+rna_proj_test, wsi_proj_test = trainer.encode(test_rna, test_wsi)
+fused_test = (rna_proj_test * rna_weight + wsi_proj_test * wsi_weight).numpy()
 
 # set_trace()
 
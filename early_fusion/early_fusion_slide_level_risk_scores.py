@@ -31,6 +31,8 @@ import seaborn as sns
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
 from pdb import set_trace
+import time
+from feature_cache import load_features, SCALERS
 
 timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 use_system = 'cluster' # cluster or laptop
@@ -60,6 +62,14 @@ def parse_args():
     parser.add_argument('--mode', type=str, default='rnaseq_wsi', 
                         choices=['rnaseq_wsi', 'only_rnaseq', 'only_wsi'],
                         help='Data modality to use')
+    parser.add_argument('--scaler', type=str, default='standard', choices=list(SCALERS),
+                        help='Scaler of the embeddings (fitted on the training data)')
+    parser.add_argument('--rna_weight', type=float, default=0.8, help='Weight of the rnaseq embeddings (rnaseq_wsi mode)')
+    parser.add_argument('--wsi_weight', type=float, default=0.2, help='Weight of the WSI embeddings (rnaseq_wsi mode)')
+    parser.add_argument('--feature_cache_dir', type=str, default='./feature_cache',
+                        help='Directory of the cached feature matrices (see feature_cache.py)')
+    parser.add_argument('--rebuild_features', action='store_true',
+                        help='Assemble the features again even if they are cached')
     
     return parser.parse_args()
 
@@ -88,130 +98,33 @@ val_file = os.path.join(input_dir, f"rnaseq_embeddings_val_checkpoint_hp_subset_
 test_file = os.path.join(input_dir, f"rnaseq_embeddings_test_checkpoint_hp_subset_{id}.json")
 
 
-# load the rnaseq embeddings
-train_embs = pd.read_json(train_file).T
-val_embs = pd.read_json(val_file).T
-test_embs = pd.read_json(test_file).T
-
-print("Train embeddings shape (RNASeq):", train_embs.shape)
-
-# print("Test embeddings shape (RNASeq):", test_embs.shape)
-
-# combine val and test sets into a single held out set (the validation dataset wasn't used in training; kfoldCV was used with the training dataset only)
-print("concatenating val and test sets to create a single held out dataset")
-test_validation_embs = pd.concat([val_embs, test_embs], axis=0)  # concatenate along rows (samples)
-test_validation_tcga_ids = list(val_embs.index) + list(test_embs.index)
-print("Test + Validation embeddings shape (RNASeq):", test_validation_embs.shape)
-
-print("Loading WSI data")
-# set_trace()
-# wsi_embs = pd.read_json(os.path.join(input_dir, 'WSI_embeddings_average_uni_29Jan.rounded.json')).T
-# wsi_embs = pd.read_json(os.path.join(input_dir, 'WSI_embeddings_average_uni_30Jan_1000tiles.rounded.json')).T
-
-# load wsi embedding file once and save as parquet file. Load the parquet file for subsequent inference runs
-# wsi_embs = pd.read_json(os.path.join(input_dir, 'WSI_embeddings_uni_31Jan_1000tiles.truncated.json'), lines=True).T
-# wsi_embs.to_parquet(os.path.join(input_dir, 'WSI_embeddings_uni_31Jan_1000tiles.truncated.json.parquet'))
-# set_trace()
-
-wsi_embs = pd.read_parquet(os.path.join(input_dir, 'WSI_embeddings_uni_31Jan_1000tiles.truncated.json.parquet'))
-
-# check shapes
-# embedding_shapes = wsi_embs.iloc[:, 0].apply(lambda x: np.array(x).shape)
-# unique_shapes = embedding_shapes.unique()
-# get the slide level embeddings by averaging the tile level embeddings
-print("obtaining slide level embeddings by averaging the tile level embeddings")
-
-
-wsi_embs["slide_embedding"] = wsi_embs.iloc[:, 0].apply(lambda x: np.mean(x, axis=0))
-wsi_embs = wsi_embs.drop(columns=[0])
+# load the aligned and scaled features (rnaseq embeddings, slide level WSI embeddings = mean of the tile embeddings) and
+# the survival data; assembled once by feature_cache.py and cached, keyed by the input files and the settings below
+# (the loading/intersecting/scaling steps that were here are build_features of feature_cache.py)
+wsi_file = os.path.join(input_dir, 'WSI_embeddings_uni_31Jan_1000tiles.truncated.json.parquet')
+mapping_file = os.path.join(input_dir, 'mapping_df_31Jan_1000tiles.json')
 
 # remove the problematic WSIs (with penmarks etc)
 exclude_ids_wsi = ['TCGA-86-6851', 'TCGA-86-7701', 'TCGA-86-7711', 'TCGA-86-7713', 'TCGA-86-7714', 'TCGA-86-7953', 'TCGA-86-7954', 'TCGA-86-7955', 
                   'TCGA-86-8055', 'TCGA-86-8056', 'TCGA-86-8073', 'TCGA-86-8074', 'TCGA-86-8075', 'TCGA-86-8076', 'TCGA-86-8278', 'TCGA-86-8279', 
                   'TCGA-86-8280', 'TCGA-86-A4P7', 'TCGA-86-A4P8']
-wsi_embs = wsi_embs.drop(index=exclude_ids_wsi, errors='ignore')
-
-# find common indices between the rnaseq and WSI embeddings
-common_train_indices = train_embs.index.intersection(wsi_embs.index).to_series().sample(frac=1, random_state=seed_value).index
-common_test_validation_indices = test_validation_embs.index.intersection(wsi_embs.index).to_series().sample(frac=1, random_state=seed_value).index
-
-# select only common indices for training and test/validation sets
-train_embs = train_embs.loc[common_train_indices]
-test_validation_embs = test_validation_embs.loc[common_test_validation_indices]
-
-# using wsi_embs for both as there was no training done
-train_wsi_embs = wsi_embs.loc[common_train_indices]
-test_validation_wsi_embs = wsi_embs.loc[common_test_validation_indices]
-
-print("Train embeddings shape (WSI):", train_wsi_embs.shape)
-print("Test + Validation embeddings shape (WSI):", test_validation_wsi_embs.shape)
-# print("Test embeddings shape (WSI):", test_embs.shape)
-
-# a scaler that does nothing
-class IdentityScaler(BaseEstimator, TransformerMixin):
-    def __init__(self):
-        pass
-
-    def fit(self, X, y=None):
-        return self
-
-    def transform(self, X, y=None):
-        return X
-
-    def fit_transform(self, X, y=None):
-        return X
-
-###### normalize rnaseq embeddings based on training set
-# use min/max across all the embeddings
-# for fit_transform() input needs to be of shape n_samples x n_features
-print("scaling rnaseq embeddings")
-# scaler_rna = MinMaxScaler(feature_range=(-1, 1))
-# scaler = RobustScaler()
-scaler_rna = StandardScaler()
-# scaler_rna = IdentityScaler()
-train_embs_normalized = pd.DataFrame(scaler_rna.fit_transform(train_embs), index=train_embs.index) # fit only using the training data
-test_validation_embs_normalized = pd.DataFrame(scaler_rna.transform(test_validation_embs),
-                                               index=test_validation_embs.index)
-
-# normalize WSI embeddings using training data
-print("scaling WSI embeddings")
-# scaler_wsi = MinMaxScaler(feature_range=(-1, 1))
-# scaler = RobustScaler()
-scaler_wsi = StandardScaler()
-# scaler_wsi = IdentityScaler()
-
-# ensure non-empty arrays before stacking
-if not train_wsi_embs.empty:
-    train_wsi_embs_array = np.stack(train_wsi_embs["slide_embedding"].values)
-    train_wsi_embs_normalized = pd.DataFrame(scaler_wsi.fit_transform(train_wsi_embs_array), index=train_wsi_embs.index)
-else:
-    train_wsi_embs_normalized = pd.DataFrame()
-
-if not test_validation_wsi_embs.empty:
-    test_validation_wsi_embs_array = np.stack(test_validation_wsi_embs["slide_embedding"].values)
-    test_validation_wsi_embs_normalized = pd.DataFrame(scaler_wsi.transform(test_validation_wsi_embs_array), index=test_validation_wsi_embs.index)
-else:
-    test_validation_wsi_embs_normalized = pd.DataFrame()
-
-# combine normalized unimodal embeddings to obtain multimodal embeddings
-print("concatenating embeddings")
-if args.mode == 'rnaseq_wsi':
-    # X_train = pd.concat([train_embs_normalized, train_wsi_embs_normalized], axis=1)
-    # X_test_validation = pd.concat([test_validation_embs_normalized, test_validation_wsi_embs_normalized], axis=1)
-
-    rna_weight = 0.8 
-    wsi_weight = 0.2 
-    # apply weighted addition
-    X_train = (train_embs_normalized * rna_weight) + (train_wsi_embs_normalized * wsi_weight)
-    X_test_validation = (test_validation_embs_normalized * rna_weight) + (test_validation_wsi_embs_normalized * wsi_weight)
 
-# set_trace()
-elif args.mode == 'only_wsi':
-    X_train = train_wsi_embs_normalized 
-    X_test_validation = test_validation_wsi_embs_normalized 
-if args.mode == 'only_rnaseq':
-    X_train = train_embs_normalized 
-    X_test_validation = test_validation_embs_normalized 
+start_time = time.perf_counter()
+features, features_path = load_features([train_file, val_file, test_file], wsi_file, mapping_file, args.feature_cache_dir,
+                                        rebuild=args.rebuild_features, exclude_ids=exclude_ids_wsi, seed=seed_value,
+                                        scaler=args.scaler, mode=args.mode, rna_weight=args.rna_weight,
+                                        wsi_weight=args.wsi_weight)
+print(f"features loaded in {time.perf_counter() - start_time:.2f} s ({features_path})")
+common_train_indices = pd.Index(features['train_ids'])
+common_test_validation_indices = pd.Index(features['test_validation_ids'])
+X_train = pd.DataFrame(features['X_train'], index=common_train_indices)
+X_test_validation = pd.DataFrame(features['X_test_validation'], index=common_test_validation_indices)
+# unscaled training embeddings (for --plot_embs)
+train_embs = pd.DataFrame(features['train_rna'], index=common_train_indices)
+train_wsi_embs_array = features['train_wsi']
+
+print("Train embeddings shape:", X_train.shape)
+print("Test + Validation embeddings shape:", X_test_validation.shape)
 
 if args.plot_embs:
     def plot_embedding_statistics(rna_embs, wsi_embs, split):
@@ -260,27 +173,20 @@ if args.plot_embs:
 
     
     # plot_embedding_statistics(test_validation_embs_array, test_validation_wsi_embs_array)
-    plot_embedding_statistics(train_embs, pd.DataFrame(train_wsi_embs_array, index=train_wsi_embs.index), "train")
+    plot_embedding_statistics(train_embs, pd.DataFrame(train_wsi_embs_array, index=common_train_indices), "train")
     # set_trace()
-    plot_embedding_distributions(train_embs, pd.DataFrame(train_wsi_embs_array, index=train_wsi_embs.index), "train")
+    plot_embedding_distributions(train_embs, pd.DataFrame(train_wsi_embs_array, index=common_train_indices), "train")
     # plot_embedding_distributions(test_validation_embs, pd.DataFrame(test_validation_wsi_embs_array, index=test_validation_embs.index))
     # plot_embedding_distributions(train_embs_normalized, train_wsi_embs_normalized)
 
     set_trace()
 
-# load survival data
-print("loading survival data")
-mapping_df = pd.read_json(os.path.join(input_dir, 'mapping_df_31Jan_1000tiles.json')).T
-# convert the 'event_occurred' values to 0 and 1 for compatibility with Sksurv
-# mapping_df['event_occurred'] = mapping_df['event_occurred'].map({'Dead': 1, 'Alive': 0}).astype(int)
-mapping_df['event_occurred'] = mapping_df['event_occurred'].map({'Dead': 1, 'Alive': 0}).astype(bool)
-# prepare train and test survival data
-train_survival = mapping_df.loc[common_train_indices]
-test_validation_survival = mapping_df.loc[common_test_validation_indices]
-# set_trace()
-
-train_survival["event_occurred"] = train_survival["event_occurred"].astype(bool)
-test_validation_survival["event_occurred"] = test_validation_survival["event_occurred"].astype(bool)
+# survival data (mapping_df_31Jan_1000tiles.json) of the samples, 'event_occurred' as bool for compatibility with Sksurv
+train_survival = pd.DataFrame({'time': features['train_time'], 'event_occurred': features['train_event']},
+                              index=common_train_indices)
+test_validation_survival = pd.DataFrame({'time': features['test_validation_time'],
+                                         'event_occurred': features['test_validation_event']},
+                                        index=common_test_validation_indices)
 
 train_surv = Surv.from_arrays(train_survival["event_occurred"].values, train_survival["time"].values)
 test_validation_surv = Surv.from_arrays(test_validation_survival["event_occurred"].values, test_validation_survival["time"].values)
@@ -0,0 +1,168 @@
+# feature assembly of the early fusion models, cached on disk
+# the rnaseq embeddings (train/val/test json of generate_rnaseq_embeddings_kfoldCV.py), the slide level WSI embeddings (mean
+# of the tile embeddings of the parquet file) and the survival data are aligned on the common TCGA IDs, the embeddings are
+# scaled with scalers fitted on the training samples and combined, and the result (float32 matrices, IDs and the
+# time/event arrays) is saved as one .npz in cache_dir
+# the cache key is a hash of the input files (path, size, mtime and the first/last MB of their content), the excluded
+# IDs, the seed of the shuffling, the scaler type, the mode and the modality weights; a repeated run (or an HPO trial)
+# with the same inputs only loads the .npz
+# python feature_cache.py --input_dir <early_fusion_inputs> --id 2025-02-27-01-41-45_fold_1_epoch_3000   # build/time it
+import os
+import json
+import inspect
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import StandardScaler, MinMaxScaler, RobustScaler
+
+CACHE_VERSION = 1
+
+
+# a scaler that does nothing
+class IdentityScaler(BaseEstimator, TransformerMixin):
+    def __init__(self):
+        pass
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        return X
+
+    def fit_transform(self, X, y=None):
+        return X
+
+
+SCALERS = {'standard': StandardScaler, 'minmax': lambda: MinMaxScaler(feature_range=(-1, 1)),
+           'robust': RobustScaler, 'identity': IdentityScaler}
+
+
+def file_fingerprint(path, block_size=1 << 20):
+    # path, size, mtime and the first/last block_size bytes (hashing the whole WSI parquet would take as long as reading it)
+    stat = os.stat(path)
+    sha1 = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    with open(path, 'rb') as f:
+        sha1.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            sha1.update(f.read(block_size))
+    return sha1.hexdigest()
+
+
+def cache_key(input_files, **settings):
+    key = {'version': CACHE_VERSION, 'inputs': [file_fingerprint(path) for path in input_files],
+           'settings': {name: list(value) if isinstance(value, (list, tuple)) else value
+                        for name, value in sorted(settings.items())}}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def slide_embeddings(wsi_file):
+    """
+    :param wsi_file: parquet file with one row per slide (index: TCGA ID) and the list of its tile embeddings in column 0
+    :return: DataFrame (index: TCGA ID) with the mean of the tile embeddings of every slide
+    """
+    table = pq.read_table(wsi_file)
+    index_column = table.schema.pandas_metadata['index_columns'][0]
+    ids = table.column(index_column).to_pylist()
+    slides = table.column(table.column_names[0]).combine_chunks()  # list<list<float>>: slides -> tiles -> values
+    tile_offsets = slides.offsets.to_numpy()
+    tiles = slides.flatten()
+    dim = len(tiles[0]) if len(tiles) > 0 else 0
+    values = tiles.flatten().to_numpy(zero_copy_only=False).astype(np.float64).reshape(-1, dim)
+    counts = np.diff(tile_offsets)
+    means = np.full((len(ids), dim), np.nan)
+    nonempty = counts > 0
+    # the sums of the tiles of a slide are reductions over contiguous row ranges of the flattened tiles
+    means[nonempty] = np.add.reduceat(values, tile_offsets[:-1][nonempty], axis=0) / counts[nonempty, None]
+    return pd.DataFrame(means, index=pd.Index(ids))
+
+
+def build_features(rnaseq_files, wsi_file, mapping_file, exclude_ids=(), seed=422, scaler='standard', mode='rnaseq_wsi',
+                   rna_weight=0.8, wsi_weight=0.2):
+    """
+    :param rnaseq_files: (train, val, test) rnaseq embedding json files; val and test are combined into the held out set
+    :return: dict of arrays: X_train, X_test_validation (float32, in the order of the *_ids), train_ids,
+             test_validation_ids, train_time, train_event, test_validation_time, test_validation_event and the unscaled
+             train_rna/train_wsi embeddings
+    """
+    train_file, val_file, test_file = rnaseq_files
+    train_embs = pd.read_json(train_file).T
+    test_validation_embs = pd.concat([pd.read_json(val_file).T, pd.read_json(test_file).T], axis=0)
+    wsi_embs = slide_embeddings(wsi_file).drop(index=list(exclude_ids), errors='ignore')
+
+    # common indices between the rnaseq and WSI embeddings, shuffled as before
+    train_ids = train_embs.index.intersection(wsi_embs.index).to_series().sample(frac=1, random_state=seed).index
+    test_validation_ids = test_validation_embs.index.intersection(wsi_embs.index).to_series().sample(
+        frac=1, random_state=seed).index
+
+    # scalers fitted on the training samples only
+    train_rna = train_embs.loc[train_ids].to_numpy(dtype=np.float64)
+    train_wsi = wsi_embs.loc[train_ids].to_numpy()
+    scaler_rna, scaler_wsi = SCALERS[scaler](), SCALERS[scaler]()
+    rna = (scaler_rna.fit_transform(train_rna),
+           scaler_rna.transform(test_validation_embs.loc[test_validation_ids].to_numpy(dtype=np.float64)))
+    wsi = (scaler_wsi.fit_transform(train_wsi), scaler_wsi.transform(wsi_embs.loc[test_validation_ids].to_numpy()))
+    if mode == 'rnaseq_wsi':
+        x_train, x_test_validation = (rna_weight * r + wsi_weight * w for r, w in zip(rna, wsi))
+    elif mode == 'only_wsi':
+        x_train, x_test_validation = wsi
+    elif mode == 'only_rnaseq':
+        x_train, x_test_validation = rna
+    else:
+        raise ValueError(f"Unsupported mode: {mode}")
+
+    mapping_df = pd.read_json(mapping_file).T
+    event = mapping_df['event_occurred'].map({'Dead': 1, 'Alive': 0}).astype(bool)
+    survival_time = mapping_df['time'].astype(float)
+    return {'X_train': x_train.astype(np.float32), 'X_test_validation': x_test_validation.astype(np.float32),
+            'train_ids': np.asarray(train_ids, dtype=str), 'test_validation_ids': np.asarray(test_validation_ids, dtype=str),
+            'train_time': survival_time.loc[train_ids].to_numpy(), 'train_event': event.loc[train_ids].to_numpy(),
+            'test_validation_time': survival_time.loc[test_validation_ids].to_numpy(),
+            'test_validation_event': event.loc[test_validation_ids].to_numpy(),
+            'train_rna': train_rna.astype(np.float32), 'train_wsi': train_wsi.astype(np.float32)}
+
+
+def load_features(rnaseq_files, wsi_file, mapping_file, cache_dir='./feature_cache', rebuild=False, **settings):
+    """
+    :param settings: exclude_ids, seed, scaler, mode, rna_weight, wsi_weight of build_features
+    :return: build_features result (from cache_dir when the inputs and settings were assembled before), path of the cache
+    """
+    defaults = {name: parameter.default for name, parameter in inspect.signature(build_features).parameters.items()
+                if parameter.default is not inspect.Parameter.empty}
+    settings = {**defaults, **settings}
+    path = os.path.join(cache_dir, f"features_{cache_key(list(rnaseq_files) + [wsi_file, mapping_file], **settings)}.npz")
+    if os.path.exists(path) and not rebuild:
+        with np.load(path) as cached:
+            return {name: cached[name] for name in cached.files}, path
+    features = build_features(rnaseq_files, wsi_file, mapping_file, **settings)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + f".{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **features)
+    os.replace(tmp_path, path)  # (concurrent HPO workers never read a partially written file)
+    return features, path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True)
+    parser.add_argument('--id', type=str, required=True, help='checkpoint id of the rnaseq embedding files')
+    parser.add_argument('--mode', type=str, default='rnaseq_wsi', choices=['rnaseq_wsi', 'only_rnaseq', 'only_wsi'])
+    parser.add_argument('--scaler', type=str, default='standard', choices=list(SCALERS))
+    parser.add_argument('--cache_dir', type=str, default='./feature_cache')
+    parser.add_argument('--rebuild', action='store_true')
+    opt = parser.parse_args()
+
+    rnaseq_files = [os.path.join(opt.input_dir, f"rnaseq_embeddings_{split}_checkpoint_hp_subset_{opt.id}.json")
+                    for split in ['train', 'val', 'test']]
+    for attempt in ['first', 'second']:
+        start = time.perf_counter()
+        features, path = load_features(rnaseq_files,
+                                       os.path.join(opt.input_dir, 'WSI_embeddings_uni_31Jan_1000tiles.truncated.json.parquet'),
+                                       os.path.join(opt.input_dir, 'mapping_df_31Jan_1000tiles.json'), opt.cache_dir,
+                                       rebuild=opt.rebuild and attempt == 'first', scaler=opt.scaler, mode=opt.mode)
+        print(f"{attempt} load: X_train {features['X_train'].shape}, X_test_validation "
+              f"{features['X_test_validation'].shape} in {time.perf_counter() - start:.2f} s ({path})")
@@ -0,0 +1,96 @@
+# benchmark of the batched, masked tile pooling (AttentionPool, LearnedWeightedPool) against pooling slide by slide
+# python benchmark_pooling.py --batch_size 16 --n_tiles 1000 2000 5000 10000 20000 --device cuda
+# each slide of the batch has a random number of tiles in [n_tiles / 2, n_tiles] (padded + key padding mask)
+# reports the median forward and forward+backward time, the peak memory (CUDA only) and the max abs difference to the
+# per-slide loop; 'naive' is the textbook attention pooling that projects every tile to keys and values
+import time
+import argparse
+import numpy as np
+import torch
+
+from generate_wsi_embeddings import AttentionPool, LearnedWeightedPool, masked_softmax
+
+
+def naive_attention_pool(pool, x, mask):
+    # materializes the keys and values of all tiles [batch_size, n_tiles, dim]
+    mask_weights = mask.unsqueeze(-1).to(x.dtype)
+    query = pool.q((x * mask_weights).sum(dim=1) / mask_weights.sum(dim=1))
+    scores = torch.bmm(pool.k(x), query.unsqueeze(-1)).squeeze(-1) * pool.scale
+    weights = masked_softmax(scores, mask)
+    return torch.bmm(weights.unsqueeze(1), pool.v(x)).squeeze(1), weights
+
+
+def loop_pool(pool, x, mask):
+    # one slide at a time, as before the pooling modules were batched
+    outputs = [pool(x[b, mask[b]])[0] for b in range(x.shape[0])]
+    return torch.stack(outputs), None
+
+
+def measure(fn, x, mask, device, repeats, backward):
+    times = []
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for _ in range(repeats):
+        if x.grad is not None:
+            x.grad = None
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        with torch.set_grad_enabled(backward):
+            output, _ = fn(x, mask)
+            if backward:
+                output.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    peak_memory = torch.cuda.max_memory_allocated(device) / 1024 ** 2 if device.type == 'cuda' else float('nan')
+    return float(np.median(times[1:] if repeats > 1 else times)), peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_tiles', type=int, nargs='+', default=[1000, 2000, 5000, 10000, 20000])
+    parser.add_argument('--dim', type=int, default=384, help='tile embedding dimension (384: lunit DINO, 1024: UNI)')
+    parser.add_argument('--chunk_size', type=int, default=2048, help='tile chunk size of the chunked LearnedWeightedPool')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--skip_loop', action='store_true', help='skip the (slow) per-slide loop')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    torch.manual_seed(opt.seed)
+    attention_pool = AttentionPool(opt.dim).to(device)
+    learned_pool = LearnedWeightedPool(opt.dim).to(device)
+    learned_pool_chunked = LearnedWeightedPool(opt.dim, chunk_size=opt.chunk_size).to(device)
+    learned_pool_chunked.load_state_dict(learned_pool.state_dict())
+
+    methods = [
+        ('attention', 'naive', lambda x, m: naive_attention_pool(attention_pool, x, m)),
+        ('attention', 'batched', attention_pool),
+        ('attention', 'loop', lambda x, m: loop_pool(attention_pool, x, m)),
+        ('learned_weighted', 'batched', learned_pool),
+        ('learned_weighted', f'chunked_{opt.chunk_size}', learned_pool_chunked),
+        ('learned_weighted', 'loop', lambda x, m: loop_pool(learned_pool, x, m)),
+    ]
+
+    print(f"batch_size={opt.batch_size}, dim={opt.dim}, device={device}")
+    print(f"{'n_tiles':>8s} {'pooling':>16s} {'method':>14s} {'fwd (ms)':>10s} {'fwd+bwd (ms)':>13s} "
+          f"{'peak (MiB)':>11s} {'max abs diff':>13s}")
+    for n_tiles in opt.n_tiles:
+        lengths = torch.randint(n_tiles // 2, n_tiles + 1, (opt.batch_size,))
+        x = torch.randn(opt.batch_size, n_tiles, opt.dim, device=device, requires_grad=True)
+        mask = (torch.arange(n_tiles).unsqueeze(0) < lengths.unsqueeze(1)).to(device)
+        with torch.no_grad():
+            references = {'attention': loop_pool(attention_pool, x, mask)[0],
+                          'learned_weighted': loop_pool(learned_pool, x, mask)[0]}
+        for pooling, method, fn in methods:
+            if method == 'loop' and opt.skip_loop:
+                continue
+            with torch.no_grad():
+                diff = (fn(x, mask)[0] - references[pooling]).abs().max().item()
+            fwd_time, _ = measure(fn, x, mask, device, opt.repeats, backward=False)
+            bwd_time, peak_memory = measure(fn, x, mask, device, opt.repeats, backward=True)
+            print(f"{n_tiles:8d} {pooling:>16s} {method:>14s} {fwd_time * 1e3:10.2f} {bwd_time * 1e3:13.2f} "
+                  f"{peak_memory:11.1f} {diff:13.2e}")
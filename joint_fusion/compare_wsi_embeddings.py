@@ -0,0 +1,96 @@
+# validate reduced precision (bf16/fp16) or int8 quantized WSI embeddings against the fp32 reference embeddings
+# python generate_wsi_embeddings.py --precision fp32 --output_file WSI_embeddings_fp32.json
+# python generate_wsi_embeddings.py --precision bf16 --device cpu --output_file WSI_embeddings_bf16.json
+# python generate_wsi_embeddings.py --quantization dynamic --device cpu --output_file WSI_embeddings_int8.json
+# python compare_wsi_embeddings.py --reference WSI_embeddings_fp32.json --candidate WSI_embeddings_bf16.json
+# reports the cosine similarity between the two embeddings (per slide, and per tile for no_pooling embeddings), and the
+# drift in the test C-index of a gradient boosted survival model fit on the fp32 slide embeddings when it is fed the
+# candidate embeddings instead (and when it is refit on the candidate embeddings)
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from sksurv.ensemble import GradientBoostingSurvivalAnalysis
+from sksurv.util import Surv
+from sksurv.metrics import concordance_index_censored
+
+
+def load_embeddings(path):
+    with open(path) as file:
+        embeddings = json.load(file)
+    return {tcga_id: np.asarray(emb, dtype=np.float64) for tcga_id, emb in embeddings.items()}
+
+
+def cosine_similarity(a, b, eps=1e-12):
+    # row-wise cosine similarity of two [n, dim] arrays
+    a = np.atleast_2d(a)
+    b = np.atleast_2d(b)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + eps)
+
+
+def slide_embedding(emb):
+    # no_pooling embeddings are [n_tiles, dim]; average them to a slide level embedding
+    return emb.mean(axis=0) if emb.ndim == 2 else emb.ravel()
+
+
+def summarize(name, values):
+    values = np.asarray(values)
+    print(f"{name}: n={values.size}, mean={values.mean():.6f}, min={values.min():.6f}, "
+          f"p1={np.percentile(values, 1):.6f}, p50={np.percentile(values, 50):.6f}")
+
+
+def c_index(model, X, y):
+    return concordance_index_censored(y['event'], y['time'], model.predict(X))[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference', type=str, required=True, help='fp32 embeddings (json written by generate_wsi_embeddings.py)')
+    parser.add_argument('--candidate', type=str, required=True, help='reduced precision or quantized embeddings to validate')
+    parser.add_argument('--mapping_file', type=str, default='./mapping_df_31Jan_1000tiles.json',
+                        help='mapping json with the survival times (time) and vital status (event_occurred)')
+    parser.add_argument('--test_size', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    opt = parser.parse_args()
+
+    reference = load_embeddings(opt.reference)
+    candidate = load_embeddings(opt.candidate)
+    tcga_ids = sorted(set(reference) & set(candidate))
+    print(f"{len(tcga_ids)} slides in both files ({len(reference)} reference, {len(candidate)} candidate)")
+
+    # cosine similarity per slide and (for no_pooling embeddings) per tile
+    slide_cos = []
+    tile_cos = []
+    max_abs_diff = 0.0
+    for tcga_id in tcga_ids:
+        ref, cand = reference[tcga_id], candidate[tcga_id]
+        if ref.shape != cand.shape:
+            raise ValueError(f"Shape mismatch for {tcga_id}: {ref.shape} vs {cand.shape}")
+        if ref.ndim == 2:
+            tile_cos.append(cosine_similarity(ref, cand))
+        slide_cos.append(cosine_similarity(slide_embedding(ref), slide_embedding(cand))[0])
+        max_abs_diff = max(max_abs_diff, float(np.abs(ref - cand).max()))
+    summarize("cosine similarity (slide)", slide_cos)
+    if tile_cos:
+        summarize("cosine similarity (tile)", np.concatenate(tile_cos))
+    print(f"max abs difference: {max_abs_diff:.6f}")
+
+    # C-index drift
+    mapping_df = pd.read_json(opt.mapping_file, orient='index')
+    tcga_ids = [tcga_id for tcga_id in tcga_ids if tcga_id in mapping_df.index]
+    y = Surv.from_arrays(event=(mapping_df.loc[tcga_ids, 'event_occurred'] == 'Dead').values,
+                         time=mapping_df.loc[tcga_ids, 'time'].values.astype(float))
+    X_ref = np.stack([slide_embedding(reference[tcga_id]) for tcga_id in tcga_ids])
+    X_cand = np.stack([slide_embedding(candidate[tcga_id]) for tcga_id in tcga_ids])
+    train_idx, test_idx = train_test_split(np.arange(len(tcga_ids)), test_size=opt.test_size,
+                                           random_state=opt.seed, stratify=y['event'])
+
+    model_ref = GradientBoostingSurvivalAnalysis(random_state=opt.seed).fit(X_ref[train_idx], y[train_idx])
+    ci_ref = c_index(model_ref, X_ref[test_idx], y[test_idx])
+    ci_swapped = c_index(model_ref, X_cand[test_idx], y[test_idx])
+    model_cand = GradientBoostingSurvivalAnalysis(random_state=opt.seed).fit(X_cand[train_idx], y[train_idx])
+    ci_refit = c_index(model_cand, X_cand[test_idx], y[test_idx])
+    print(f"test C-index, fp32 model on fp32 embeddings: {ci_ref:.4f}")
+    print(f"test C-index, fp32 model on candidate embeddings: {ci_swapped:.4f} (drift {ci_swapped - ci_ref:+.4f})")
+    print(f"test C-index, model refit on candidate embeddings: {ci_refit:.4f} (drift {ci_refit - ci_ref:+.4f})")
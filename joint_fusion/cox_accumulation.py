@@ -0,0 +1,213 @@
+# gradient accumulation with exact Cox partial likelihood risk sets
+# the Cox loss of a patient depends on the risk scores of every patient in its risk set, so the usual
+# "sum the losses of the micro-batches" accumulation changes the objective (risk sets are truncated to the micro-batch)
+# instead, for each virtual batch (up to the whole training fold):
+#   pass 1: forward all micro-batches under no_grad and cache only their risk scores (one float per patient)
+#   loss:   compute the Cox loss over the cached risk scores of the whole virtual batch and get dL/d(risk) for each patient
+#   pass 2: recompute the forward pass of each micro-batch with autograd and backpropagate its slice of dL/d(risk)
+# the accumulated parameter gradients are identical to those of a single forward/backward pass over the virtual batch,
+# while the activation memory stays that of a single micro-batch (at the cost of a second forward pass)
+# Note: the data augmentation has to be deterministic between the two passes (the transforms in HDF5Dataset are)
+# one DataLoader serves the whole epoch: VirtualBatchSampler yields the micro-batches of every virtual batch twice in a row
+# (pass 1, pass 2), or once with --keep_micro_batches (the pass 1 micro-batches are kept in host memory for pass 2)
+# python cox_accumulation.py --check_equivalence    # accumulated vs full batch loss/gradients (synthetic MIL cohort)
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+from instrumentation import instr
+from profiling import region
+from utils import get_collate_fn, tiles_to_device
+
+
+def _get_rng_state(device):
+    return torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+
+
+def _set_rng_state(state, device):
+    cpu_state, cuda_state = state
+    torch.set_rng_state(cpu_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state(cuda_state, device)
+
+
+def _forward_risks(model, opt, batch, device):
+    tcga_id, _, _, x_wsi, x_omic = batch
+    x_wsi = tiles_to_device(x_wsi, device)
+    x_omic = x_omic.to(device)
+    predictions = model(opt, tcga_id, x_wsi=x_wsi, x_omic=x_omic)
+    return predictions.reshape(-1).float()  # log-risk scores; the Cox loss is computed in fp32
+
+
+class VirtualBatchSampler(Sampler):
+    """
+    micro-batches (lists of dataset indices) of the virtual batches; every virtual batch is yielded passes times in a row
+    """
+
+    def __init__(self, virtual_batches, micro_batch_size, passes=2):
+        self.micro_batches = [[virtual_batch[i:i + micro_batch_size].tolist()
+                               for i in range(0, len(virtual_batch), micro_batch_size)]
+                              for virtual_batch in virtual_batches]
+        self.passes = passes
+
+    def __iter__(self):
+        for micro_batches in self.micro_batches:
+            for _ in range(self.passes):
+                yield from micro_batches
+
+    def __len__(self):
+        return self.passes * sum(len(micro_batches) for micro_batches in self.micro_batches)
+
+
+def accumulated_cox_step(model, opt, batches, n_micro_batches, cox_loss, optimizer, grad_scaler, device,
+                         keep_batches=False):
+    """
+    One optimizer step with the exact Cox partial likelihood over all the patients of a virtual batch.
+
+    :param batches: iterator over the n_micro_batches micro-batches of the virtual batch, followed by the same
+                    micro-batches again for pass 2 (unless keep_batches), e.g. of a DataLoader with a VirtualBatchSampler
+    :param grad_scaler: torch GradScaler (pass-through when disabled)
+    :param keep_batches: keep the pass 1 micro-batches in host memory and reuse them in pass 2
+    :return: Cox loss over the virtual batch (float)
+    """
+    # pass 1: risk scores only
+    risks, times, events, rng_states, kept = [], [], [], [], []
+    with torch.no_grad(), instr.timer('train/accumulation_pass1'):
+        for _ in range(n_micro_batches):
+            batch = next(batches)
+            rng_states.append(_get_rng_state(device))  # replay dropout etc. identically in pass 2
+            risks.append(_forward_risks(model, opt, batch, device))
+            times.append(batch[1])
+            events.append(batch[2])
+            if keep_batches:
+                kept.append(batch)
+    risks = torch.cat(risks).requires_grad_()
+    times = torch.cat(times).to(device)
+    events = torch.cat(events).to(device)
+    pass2_batches = kept if keep_batches else (next(batches) for _ in range(n_micro_batches))
+
+    with region('cox_loss'), instr.timer('train/loss'):
+        loss = cox_loss(risks, times, events)
+    if loss.grad_fn is None:  # no events in the virtual batch, nothing to learn from
+        for _ in pass2_batches:  # (skip the pass 2 micro-batches of the loader)
+            pass
+        return loss.item()
+    loss.backward()
+    risk_grads = risks.grad.detach()
+
+    # pass 2: recompute each micro-batch and backpropagate its slice of dL/d(risk)
+    optimizer.zero_grad()
+    start = 0
+    with instr.timer('train/accumulation_pass2'):
+        for batch, rng_state in zip(pass2_batches, rng_states):
+            _set_rng_state(rng_state, device)
+            predictions = _forward_risks(model, opt, batch, device)
+            end = start + predictions.numel()
+            grad_scaler.scale(predictions).backward(gradient=risk_grads[start:end])
+            start = end
+    with region('optimizer_step'), instr.timer('train/optimizer_step'):
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
+    return loss.item()
+
+
+def train_epoch_accumulated(model, opt, dataset, train_idx, cox_loss, optimizer, grad_scaler, device, profiler=None,
+                            num_workers=4):
+    """
+    One training epoch over train_idx in virtual batches of opt.micro_batch_size * opt.accumulation_steps patients
+    (opt.accumulation_steps = 0 uses the whole training fold as a single virtual batch, i.e. one step per epoch).
+    A single DataLoader (one set of workers) serves all the steps of the epoch.
+
+    :return: sum of the virtual batch losses (same convention as the loss_epoch of the per-batch loop in train_nn)
+    """
+    virtual_batch_size = opt.micro_batch_size * opt.accumulation_steps or len(train_idx)
+    keep_batches = getattr(opt, 'keep_micro_batches', False)
+    permuted_idx = np.random.permutation(train_idx)
+    virtual_batches = [permuted_idx[start:start + virtual_batch_size]
+                       for start in range(0, len(permuted_idx), virtual_batch_size)]
+    sampler = VirtualBatchSampler(virtual_batches, opt.micro_batch_size, passes=1 if keep_batches else 2)
+    loader = DataLoader(dataset,
+                        batch_sampler=sampler,
+                        collate_fn=get_collate_fn(opt),
+                        num_workers=num_workers,
+                        pin_memory=True)
+    batches = iter(loader)
+    loss_epoch = 0.0
+    for virtual_batch, micro_batches in zip(virtual_batches, sampler.micro_batches):
+        instr.step()
+        loss = accumulated_cox_step(model, opt, batches, len(micro_batches), cox_loss, optimizer, grad_scaler, device,
+                                    keep_batches=keep_batches)
+        instr.debug("loss (train, virtual batch of %d patients): %s", len(virtual_batch), loss)
+        loss_epoch += loss
+        instr.count('train/batches')
+        instr.count('train/samples', len(virtual_batch))
+        if profiler is not None:
+            profiler.step()
+    return loss_epoch
+
+
+class SyntheticBagDataset(Dataset):
+    # patients with a variable number of tile embeddings, rnaseq and survival data (HDF5Dataset item layout)
+    def __init__(self, n_patients, n_genes=19962, tile_dim=32, max_tiles=12, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        counts = torch.randint(1, max_tiles + 1, (n_patients,), generator=generator)
+        self.bags = [torch.randn(int(n), tile_dim, generator=generator) for n in counts]
+        self.x_omic = torch.log1p(torch.rand(n_patients, n_genes, generator=generator) * 100)
+        self.times = torch.randint(1, 2000, (n_patients,), generator=generator).float()  # integer days, so ties do occur
+        self.events = (torch.rand(n_patients, generator=generator) < 0.4).long()
+
+    def __len__(self):
+        return len(self.bags)
+
+    def __getitem__(self, index):
+        return f"SYNTH-{index:04d}", self.times[index], self.events[index], self.bags[index], self.x_omic[index]
+
+
+def check_equivalence(opt):
+    """
+    gradients of accumulated_cox_step (micro-batches, both loader modes) vs a single forward/backward pass over the
+    virtual batch, on a synthetic MIL cohort (eval mode: the full batch pass can't replay the dropout of the micro-batches)
+    """
+    from models import MultimodalNetwork
+    from train_test import CoxLoss
+    from utils import collate_tile_bags
+
+    torch.manual_seed(opt.seed)
+    dataset = SyntheticBagDataset(opt.n_patients, seed=opt.seed)
+    model = MultimodalNetwork(embedding_dim_wsi=64, embedding_dim_omic=64, mode='wsi_omic', fusion_type='mil',
+                              tile_embedding_dim=dataset.bags[0].shape[1]).eval()
+    device = torch.device('cpu')
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=False)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)  # (step() leaves the parameters unchanged)
+
+    predictions = model(opt, None, *collate_tile_bags([dataset[i] for i in range(len(dataset))])[3:])
+    loss = CoxLoss()(predictions.reshape(-1), dataset.times, dataset.events)
+    optimizer.zero_grad()
+    loss.backward()
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    print(f"full batch of {len(dataset)} patients: loss {loss.item():.6f}")
+
+    virtual_batch = np.arange(len(dataset))
+    for keep_batches in [False, True]:
+        sampler = VirtualBatchSampler([virtual_batch], opt.micro_batch_size, passes=1 if keep_batches else 2)
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_tile_bags)
+        accumulated_loss = accumulated_cox_step(model, opt, iter(loader), len(sampler.micro_batches[0]), CoxLoss(),
+                                                optimizer, grad_scaler, device, keep_batches=keep_batches)
+        accumulated_grads = [p.grad for p in model.parameters() if p.grad is not None]
+        grad_diff = max((a - g).abs().max().item() for a, g in zip(accumulated_grads, grads))
+        print(f"micro-batches of {opt.micro_batch_size} (keep_micro_batches={keep_batches}): loss {accumulated_loss:.6f} "
+              f"(diff {abs(accumulated_loss - loss.item()):.2e}), max abs gradient diff {grad_diff:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check_equivalence', action='store_true',
+                        help='compare the accumulated loss and gradients with a full batch pass on synthetic data')
+    parser.add_argument('--n_patients', type=int, default=48)
+    parser.add_argument('--micro_batch_size', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=6)
+    opt = parser.parse_args()
+
+    if opt.check_equivalence:
+        check_equivalence(opt)
@@ -0,0 +1,142 @@
+# data mapping of the joint fusion training: a small metadata table and a dense expression matrix instead of one json
+# object per sample with the ~20k genes of rnaseq_data as a nested dict (parsed by pd.read_json into one python dict per
+# row, then expanded again into a DataFrame for rnaseq_df)
+#   <prefix>.parquet     one row per sample (index tcga_id): days_to_death, days_to_last_followup, event_occurred, time,
+#                        tiles (list of tile file names), ..., rnaseq_row (row of the sample in the expression matrix)
+#   <prefix>.rnaseq.npy  [n_samples, n_genes] float32 expression (memory mapped when loaded)
+#   <prefix>.genes.txt   gene ids of the matrix columns
+# the json files of create_image_molecular_mapping.py (mapped_data_*.json) are parsed once: the gene dicts are turned into
+# float32 arrays while the json is decoded (object_pairs_hook), so neither the per-row dicts nor the DataFrame of all the
+# values are ever built; the result is cached as the files above
+# python data_mapping.py --json mapped_data_23july.json --output_prefix mapped_data_23july
+import os
+import json
+import time
+import resource
+import argparse
+import numpy as np
+import pandas as pd
+
+
+class _Expression:
+    # gene ids (shared by all the samples when they are in the same order) and the float32 values of one rnaseq_data dict
+    __slots__ = ('genes', 'values')
+
+    def __init__(self, genes, values):
+        self.genes = genes
+        self.values = values
+
+
+def _to_float32(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float32)
+
+
+def _expression_hook(min_genes):
+    state = {'genes': None}
+
+    def hook(pairs):
+        if len(pairs) >= min_genes and all(type(value) in (int, float) or value is None for _, value in pairs):
+            genes = [gene for gene, _ in pairs]
+            if genes != state['genes']:  # (the keys are memoized by the json decoder, so this is mostly identity checks)
+                state['genes'] = genes
+            return _Expression(state['genes'], _to_float32([value for _, value in pairs]))
+        return dict(pairs)
+    return hook
+
+
+def _to_split(samples, rnaseq_column='rnaseq_data'):
+    """
+    :param samples: dict tcga_id -> dict of the fields of a sample (rnaseq_data as _Expression or dict)
+    :return: metadata DataFrame, [n_samples, n_genes] float32 matrix, gene ids
+    """
+    expressions = [sample.pop(rnaseq_column, None) for sample in samples.values()]
+    expressions = [_Expression(list(e), _to_float32(list(e.values())))
+                   if isinstance(e, dict) and len(e) > 0 else e for e in expressions]
+    genes = next((e.genes for e in expressions if isinstance(e, _Expression)), [])
+    gene_index = None
+    rnaseq = np.full((len(expressions), len(genes)), np.nan, dtype=np.float32)  # (nan for the samples without rnaseq)
+    for i, expression in enumerate(expressions):
+        if not isinstance(expression, _Expression):
+            continue
+        if expression.genes is genes or expression.genes == genes:
+            rnaseq[i] = expression.values
+        else:  # other gene order: place the values by gene id
+            gene_index = gene_index or {gene: j for j, gene in enumerate(genes)}
+            columns = np.array([gene_index.get(gene, -1) for gene in expression.genes])
+            rnaseq[i, columns[columns >= 0]] = expression.values[columns >= 0]
+    metadata = pd.DataFrame.from_dict(samples, orient='index')
+    metadata.index.name = 'tcga_id'
+    metadata['rnaseq_row'] = np.arange(len(metadata), dtype=np.int32)
+    return metadata, rnaseq, list(genes)
+
+
+def read_json_mapping(json_path, min_genes=100):
+    """
+    :param json_path: mapping json (orient='index') with the gene dict of every sample in rnaseq_data
+    :return: metadata DataFrame, [n_samples, n_genes] float32 matrix, gene ids
+    """
+    with open(json_path) as f:
+        samples = json.load(f, object_pairs_hook=_expression_hook(min_genes))
+    return _to_split(samples)
+
+
+def split_mapping(mapping_df):
+    # same split of a DataFrame with rnaseq_data dicts (e.g. the mapping_df.json files of older runs)
+    return _to_split(mapping_df.to_dict(orient='index'))
+
+
+def write_mapping(metadata, rnaseq, genes, prefix):
+    """
+    :param metadata: rows of the samples to keep (their rnaseq_row select the rows of rnaseq)
+    writes the rows of rnaseq in the order of metadata, so that the rnaseq_row of the written table are 0..n-1
+    """
+    metadata = metadata.copy()
+    rows = metadata['rnaseq_row'].to_numpy()
+    metadata['rnaseq_row'] = np.arange(len(metadata), dtype=np.int32)
+    metadata.to_parquet(prefix + '.parquet')
+    np.save(prefix + '.rnaseq.npy', np.ascontiguousarray(rnaseq[rows], dtype=np.float32))
+    with open(prefix + '.genes.txt', 'w') as f:
+        f.write('\n'.join(genes) + '\n')
+
+
+def load_mapping(prefix, mmap_mode='r'):
+    """
+    :return: metadata DataFrame, [n_samples, n_genes] float32 matrix (memory mapped), gene ids
+    """
+    metadata = pd.read_parquet(prefix + '.parquet')
+    rnaseq = np.load(prefix + '.rnaseq.npy', mmap_mode=mmap_mode)
+    with open(prefix + '.genes.txt') as f:
+        genes = f.read().split()
+    return metadata, rnaseq, genes
+
+
+def mapping_exists(prefix):
+    return all(os.path.exists(prefix + suffix) for suffix in ['.parquet', '.rnaseq.npy', '.genes.txt'])
+
+
+def read_mapping(json_path, prefix):
+    """
+    :return: the split mapping of json_path, from the files of prefix if it was converted before (else converted now)
+    """
+    if mapping_exists(prefix) and os.path.getmtime(prefix + '.parquet') >= os.path.getmtime(json_path):
+        return load_mapping(prefix)
+    metadata, rnaseq, genes = read_json_mapping(json_path)
+    write_mapping(metadata, rnaseq, genes, prefix)
+    return load_mapping(prefix)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # (kB on linux)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', type=str, required=True, help='mapping json of create_image_molecular_mapping.py')
+    parser.add_argument('--output_prefix', type=str, required=True)
+    opt = parser.parse_args()
+
+    start = time.perf_counter()
+    metadata, rnaseq, genes = read_json_mapping(opt.json)
+    write_mapping(metadata, rnaseq, genes, opt.output_prefix)
+    print(f"{len(metadata)} samples x {len(genes)} genes converted in {time.perf_counter() - start:.1f} s "
+          f"(peak RSS {peak_rss_mb():.0f} MB) -> {opt.output_prefix}.parquet/.rnaseq.npy/.genes.txt")
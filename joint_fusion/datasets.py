@@ -16,6 +16,10 @@ import h5py
 from multiprocessing import Manager
 import ast
 
+from instrumentation import instr
+from utils import resolve_tile_path
+from svs_reader import RegionCache
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class CustomDatasetOld(Dataset):
@@ -49,30 +53,27 @@ class CustomDatasetOld(Dataset):
             lambda x: np.log1p(np.array(list(x.values()))))
 
     def __getitem__(self, index):
-        start_time = time.time()
         if torch.is_tensor(index):
             index = index.tolist()
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        days_to_death = sample['days_to_death']
-        days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            days_to_death = sample['days_to_death']
+            days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
         # convert these tile paths to images
         # x_wsi = [Image.open(self.opt.input_wsi_path + tile).convert('RGB') for tile in tiles] #.convert('RGB')
-        x_wsi = [self.transforms(Image.open(self.opt.input_wsi_path + tile)) for tile in tiles]
-        step2_time = time.time()
-        rnaseq_data = sample['rnaseq_data']
-        # x_omic = torch.tensor(list(rnaseq_data.values()))
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        with instr.timer('dataset/tiles'):
+            x_wsi = [self.transforms(Image.open(resolve_tile_path(self.opt, tile))) for tile in tiles]
+        with instr.timer('dataset/omic'):
+            rnaseq_data = sample['rnaseq_data']
+            # x_omic = torch.tensor(list(rnaseq_data.values()))
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
         # if self.transforms:
         #     pass
-        step3_time = time.time()
-
-        print(
-            f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        instr.count('dataset/samples')
 
         # return tcga_id, days_to_death, days_to_last_followup, event_occurred, x_wsi, x_omic
 
@@ -111,41 +112,33 @@ class CustomDatasetCV(Dataset):
             lambda x: np.log1p(np.array(list(x.values()))))
 
     def __getitem__(self, index):
-        start_time = time.time()
-
         if torch.is_tensor(index):
             index = index.tolist()
 
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        days_to_death = sample['days_to_death']
-        days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            days_to_death = sample['days_to_death']
+            days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
 
         # Load images using OpenCV and apply transformations
-        images = []
-        for tile in tiles:
-            image_path = os.path.join(self.opt.input_wsi_path, tile)
-            image = cv2.imread(image_path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = Image.fromarray(image)
-            image = self.transforms(image)
-            images.append(image)
-
-        step2_time = time.time()
-
-        rnaseq_data = sample['rnaseq_data']
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-
-        step3_time = time.time()
+        with instr.timer('dataset/tiles'):
+            images = []
+            for tile in tiles:
+                image_path = resolve_tile_path(self.opt, tile)
+                image = cv2.imread(image_path)
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                image = Image.fromarray(image)
+                image = self.transforms(image)
+                images.append(image)
 
-        # Timing print statements
-        print(
-            f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with instr.timer('dataset/omic'):
+            rnaseq_data = sample['rnaseq_data']
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        instr.count('dataset/samples')
 
         return tcga_id, days_to_event, event_occurred, images, x_omic
 
@@ -183,43 +176,35 @@ class CustomDatasetCached(Dataset):
             lambda x: np.log1p(np.array(list(x.values()))))
 
     def __getitem__(self, index):
-        start_time = time.time()
-
         if torch.is_tensor(index):
             index = index.tolist()
 
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        days_to_death = sample['days_to_death']
-        days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            days_to_death = sample['days_to_death']
+            days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
 
         # Load preprocessed images if they exist
-        cached_images = []
-        for tile in tiles:
-            cached_image_path = os.path.join(self.cache_dir, f"{tile}.pt")
-            if os.path.exists(cached_image_path):
-                cached_image = torch.load(cached_image_path)
-            else:
-                image = Image.open(self.opt.input_wsi_path + tile).convert('RGB')
-                cached_image = self.transforms(image)
-                torch.save(cached_image, cached_image_path)
-            cached_images.append(cached_image)
-
-        step2_time = time.time()
-
-        rnaseq_data = sample['rnaseq_data']
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-
-        step3_time = time.time()
+        with instr.timer('dataset/tiles'):
+            cached_images = []
+            for tile in tiles:
+                cached_image_path = os.path.join(self.cache_dir, f"{tile}.pt")
+                if os.path.exists(cached_image_path):
+                    cached_image = torch.load(cached_image_path)
+                else:
+                    image = Image.open(resolve_tile_path(self.opt, tile)).convert('RGB')
+                    cached_image = self.transforms(image)
+                    torch.save(cached_image, cached_image_path)
+                cached_images.append(cached_image)
 
-        # Timing print statements
-        print(
-            f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with instr.timer('dataset/omic'):
+            rnaseq_data = sample['rnaseq_data']
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        instr.count('dataset/samples')
 
         return tcga_id, days_to_event, event_occurred, cached_images, x_omic
 
@@ -264,67 +249,61 @@ class CustomDataset(Dataset):
         #     lambda x: np.log1p(np.array(list(x.values()))))
 
     def __getitem__(self, index):
-        start_time = time.time()
-
         if torch.is_tensor(index):
             index = index.tolist()
 
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        # days_to_death = sample['days_to_death']
-        # days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            # days_to_death = sample['days_to_death']
+            # days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
 
         # Load preprocessed images if they exist, else preprocess and cache
-        cached_images = []
-        for tile in tiles:
-            cached_image_path = os.path.join(self.cache_dir, f"{tile}.pt")
-            try:
-                if os.path.exists(cached_image_path):
-                    cached_image = torch.load(cached_image_path)
-                    # set_trace()
-                    # cached_image = self.transforms(cached_image)
-                    if not isinstance(cached_image, torch.Tensor):
-                        # print("Skipping ToTensor(), already a tensor [for uni]")
-                        cached_image = self.transforms(cached_image)
-                else:
-                    raise FileNotFoundError
-            except (FileNotFoundError, RuntimeError):
-                image_path = os.path.join(self.opt.input_wsi_path, tile)
-                image = cv2.imread(image_path)
-                if image is None:
-                    raise FileNotFoundError(f"Image {tile} not found at {image_path}")
-
-                # check if the tiles are in RGB and BGR format and convert to RGB if required
-
-
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(image)
-                cached_image = self.transforms(image)
-                # cached_image = transforms.ToTensor()(image).to(device).requires_grad_()
-                torch.save(cached_image, cached_image_path)
-            cached_images.append(cached_image)
-
-        step2_time = time.time()
-        cached_images = torch.stack(cached_images)
-
-        # rnaseq_data = sample['rnaseq_data']
-        # set_trace()
-        rnaseq_data = ast.literal_eval(sample['rnaseq_data'])
-        # set_trace()
-        rnaseq_values = np.array(list(rnaseq_data.values()), dtype=np.float32)
-        # convert to PyTorch tensor and enable gradient flow
-        x_omic = torch.from_numpy(rnaseq_values).requires_grad_()
-        # x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-
-        step3_time = time.time()
-
-        # Timing print statements
-        print(f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with instr.timer('dataset/tiles'):
+            cached_images = []
+            for tile in tiles:
+                cached_image_path = os.path.join(self.cache_dir, f"{tile}.pt")
+                try:
+                    if os.path.exists(cached_image_path):
+                        cached_image = torch.load(cached_image_path)
+                        # set_trace()
+                        # cached_image = self.transforms(cached_image)
+                        if not isinstance(cached_image, torch.Tensor):
+                            # print("Skipping ToTensor(), already a tensor [for uni]")
+                            cached_image = self.transforms(cached_image)
+                        instr.count('dataset/tile_cache_hits')
+                    else:
+                        raise FileNotFoundError
+                except (FileNotFoundError, RuntimeError):
+                    image_path = resolve_tile_path(self.opt, tile)
+                    image = cv2.imread(image_path)
+                    if image is None:
+                        raise FileNotFoundError(f"Image {tile} not found at {image_path}")
+
+                    # check if the tiles are in RGB and BGR format and convert to RGB if required
+
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    image = Image.fromarray(image)
+                    cached_image = self.transforms(image)
+                    # cached_image = transforms.ToTensor()(image).to(device).requires_grad_()
+                    torch.save(cached_image, cached_image_path)
+                    instr.count('dataset/tile_cache_misses')
+                cached_images.append(cached_image)
+            cached_images = torch.stack(cached_images)
+
+        with instr.timer('dataset/omic'):
+            # rnaseq_data = sample['rnaseq_data']
+            # set_trace()
+            rnaseq_data = ast.literal_eval(sample['rnaseq_data'])
+            # set_trace()
+            rnaseq_values = np.array(list(rnaseq_data.values()), dtype=np.float32)
+            # convert to PyTorch tensor and enable gradient flow
+            x_omic = torch.from_numpy(rnaseq_values).requires_grad_()
+            # x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        instr.count('dataset/samples')
 
         return tcga_id, days_to_event, event_occurred, cached_images, x_omic
 
@@ -365,7 +344,7 @@ class CustomDatasetDelayed(Dataset):
 
     def _preprocess_image(self, tiles):
         for tile in tiles:
-            image_path = os.path.join(self.opt.input_wsi_path, tile)
+            image_path = resolve_tile_path(self.opt, tile)
             image = Image.open(image_path)
             image = self.transforms(image)
             cached_image_path = os.path.join(self.cache_dir, f"{tile}.h5")
@@ -373,39 +352,31 @@ class CustomDatasetDelayed(Dataset):
                 f.create_dataset('image', data=image.numpy())
 
     def __getitem__(self, index):
-        start_time = time.time()
-
         if torch.is_tensor(index):
             index = index.tolist()
 
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        days_to_death = sample['days_to_death']
-        days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            days_to_death = sample['days_to_death']
+            days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
 
         # Load preprocessed images from cache
-        cached_images = []
-        for tile in tiles:
-            cached_image_path = os.path.join(self.cache_dir, f"{tile}.h5")
-            with h5py.File(cached_image_path, 'r') as f:
-                cached_image = torch.tensor(f['image'][:])
-            cached_images.append(cached_image)
-
-        step2_time = time.time()
-
-        rnaseq_data = sample['rnaseq_data']
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-
-        step3_time = time.time()
+        with instr.timer('dataset/tiles'):
+            cached_images = []
+            for tile in tiles:
+                cached_image_path = os.path.join(self.cache_dir, f"{tile}.h5")
+                with h5py.File(cached_image_path, 'r') as f:
+                    cached_image = torch.tensor(f['image'][:])
+                cached_images.append(cached_image)
 
-        # Timing print statements
-        print(
-            f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with instr.timer('dataset/omic'):
+            rnaseq_data = sample['rnaseq_data']
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        instr.count('dataset/samples')
 
         return tcga_id, days_to_event, event_occurred, cached_images, x_omic
 
@@ -448,44 +419,36 @@ class CustomDatasetCacheWhole(Dataset):
             for idx, sample in self.mapping_df.iterrows():
                 tiles = sample['tiles']
                 for tile in tiles:
-                    tile_path = self.opt.input_wsi_path + tile
+                    tile_path = resolve_tile_path(self.opt, tile)
                     image = Image.open(tile_path).convert('RGB')
                     transformed_image = self.transforms(image)
                     h5f.create_dataset(tile, data=transformed_image.numpy(), compression='gzip')
 
     def __getitem__(self, index):
-        start_time = time.time()
-
         if torch.is_tensor(index):
             index = index.tolist()
 
-        sample = self.mapping_df.iloc[index]
-        tcga_id = self.mapping_df.index[index]
-        days_to_death = sample['days_to_death']
-        days_to_last_followup = sample['days_to_last_followup']
-        days_to_event = sample['time']
-        event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
-        tiles = sample['tiles']
-
-        step1_time = time.time()
+        with instr.timer('dataset/metadata'):
+            sample = self.mapping_df.iloc[index]
+            tcga_id = self.mapping_df.index[index]
+            days_to_death = sample['days_to_death']
+            days_to_last_followup = sample['days_to_last_followup']
+            days_to_event = sample['time']
+            event_occurred = 1 if sample['event_occurred'] == 'Dead' else 0
+            tiles = sample['tiles']
 
         # Load cached images from HDF5 file
-        cached_images = []
-        with h5py.File(self.cache_file, 'r') as h5f:
-            for tile in tiles:
-                cached_image = torch.tensor(h5f[tile][()])
-                cached_images.append(cached_image)
-
-        step2_time = time.time()
-
-        rnaseq_data = sample['rnaseq_data']
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-
-        step3_time = time.time()
+        with instr.timer('dataset/tiles'):
+            cached_images = []
+            with h5py.File(self.cache_file, 'r') as h5f:
+                for tile in tiles:
+                    cached_image = torch.tensor(h5f[tile][()])
+                    cached_images.append(cached_image)
 
-        # Timing print statements
-        print(
-            f"Index: {index}, Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with instr.timer('dataset/omic'):
+            rnaseq_data = sample['rnaseq_data']
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+        instr.count('dataset/samples')
 
         return tcga_id, days_to_event, event_occurred, cached_images, x_omic
 
@@ -512,6 +475,17 @@ class HDF5Dataset(Dataset):
         # local cache dict
         self.cache = {}
 
+        # multi-instance (tile bag) mode: sample tiles_per_slide tiles of each slide on every access, so that slides with
+        # any number of tiles can be used (batch with utils.collate_tile_bags); 0 returns all the tiles as a list (legacy)
+        self.tiles_per_slide = getattr(opt, 'tiles_per_slide', 0)
+        self.tile_sampling = getattr(opt, 'tile_sampling', 'random')
+        self.tile_sampling_seed = getattr(opt, 'tile_sampling_seed', 0)
+        self.epoch = 0
+        # the tile bags are resampled every epoch, so their tiles are cached as decoded uint8 pixels in an LRU cache bounded
+        # in bytes (per process, i.e. per DataLoader worker; 0 disables it) instead of in self.cache
+        tile_cache_mb = getattr(opt, 'tile_cache_mb', 512)
+        self.tile_cache = RegionCache(tile_cache_mb * 2 ** 20) if self.tiles_per_slide > 0 and tile_cache_mb > 0 else None
+
         # Transformations/augmentations for WSI data
         if self.train_val_test == "train":
             self.transforms = transforms.Compose([
@@ -533,6 +507,11 @@ class HDF5Dataset(Dataset):
         return len(self.dataset)
         # return min(len(self.dataset), 8) # for debugging using smaller number of samples
 
+    def set_epoch(self, epoch):
+        # the tile bags are resampled every epoch, but are the same for every access within an epoch
+        # (needed e.g. for the two passes of the gradient accumulation in cox_accumulation.py)
+        self.epoch = epoch
+
     def __getitem__(self, index):
         self.getitem_count += 1  # Increment the counter
 
@@ -540,39 +519,42 @@ class HDF5Dataset(Dataset):
         # if self.getitem_count > 8:
         #     raise StopIteration("stopping after 8 samples")
 
-        start_time = time.time()
         if torch.is_tensor(index):
             index = index.tolist()
 
-        patient_id = list(self.dataset.keys())[index]
-        patient_data = self.dataset[patient_id]
-        # set_trace()
-        # days_to_death = patient_data['days_to_death'][()]
-        # days_to_last_followup = patient_data['days_to_last_followup'][()]
-        days_to_event = patient_data['days_to_event'][()]
-        event_occurred = patient_data['event_occurred'][()]
-        step1_time = time.time()
-
-        rnaseq_data = patient_data['rnaseq_data'][()]
-        rnaseq_data = np.log1p(rnaseq_data)  # log transformation
-        x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
-        step2_time = time.time()
-
-        if patient_id not in self.cache:
-            images_group = patient_data['images']
-            images = []
-            for key in images_group.keys():
-                image_data = images_group[key][()]
-                image = Image.fromarray(image_data)
-                image = self.transforms(image)  # this is taking significant time
-                if self.train_val_test == 'test':
-                    image.requires_grad_()  # to calculate the gradient of the output w.r.t. this tensor for getting the saliency maps
-                    # set_trace()
-                images.append(image)
-            self.cache[patient_id] = images
-        else:
-            images = self.cache[patient_id]
-        step3_time = time.time()
+        with instr.timer('dataset/metadata'):
+            patient_id = list(self.dataset.keys())[index]
+            patient_data = self.dataset[patient_id]
+            # set_trace()
+            # days_to_death = patient_data['days_to_death'][()]
+            # days_to_last_followup = patient_data['days_to_last_followup'][()]
+            days_to_event = patient_data['days_to_event'][()]
+            event_occurred = patient_data['event_occurred'][()]
+
+        with instr.timer('dataset/omic'):
+            rnaseq_data = patient_data['rnaseq_data'][()]
+            rnaseq_data = np.log1p(rnaseq_data)  # log transformation
+            x_omic = torch.tensor(rnaseq_data, dtype=torch.float32)
+
+        with instr.timer('dataset/tiles'):
+            if self.tiles_per_slide > 0:
+                images = self.load_tile_bag(index, patient_id, patient_data.get('images'))
+            elif patient_id not in self.cache:
+                images_group = patient_data['images']
+                images = []
+                for key in images_group.keys():
+                    image_data = images_group[key][()]
+                    image = Image.fromarray(image_data)
+                    image = self.transforms(image)  # this is taking significant time
+                    if self.train_val_test == 'test':
+                        image.requires_grad_()  # to calculate the gradient of the output w.r.t. this tensor for getting the saliency maps
+                        # set_trace()
+                    images.append(image)
+                self.cache[patient_id] = images
+                instr.count('dataset/tile_cache_misses')
+            else:
+                images = self.cache[patient_id]
+                instr.count('dataset/tile_cache_hits')
 
         # images_group = patient_data['images']
         # images = []
@@ -581,9 +563,105 @@ class HDF5Dataset(Dataset):
         #     image = Image.fromarray(image_data)
         #     image = self.transforms(image)
         #     images.append(image)
-        # step3_time = time.time()
 
-        # print(
-        #     f"Index: {index}, loaded {self.getitem_count} of {len(self.dataset) / torch.cuda.device_count()} samples [total samples: {len(self.dataset)} ], Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        instr.count('dataset/samples')
+        instr.debug("Index: %s, loaded %d of %d samples", index, self.getitem_count, len(self.dataset))
 
         return patient_id, days_to_event, event_occurred, images, x_omic
+
+    def tile_rng(self, index):
+        if self.train_val_test == 'train':
+            return np.random.default_rng((self.tile_sampling_seed, self.epoch, index))
+        return None  # evenly spaced tiles for validation/testing so that the scores are reproducible
+
+    def load_tile_bag(self, index, patient_id, images_group):
+        """
+        sample (up to) tiles_per_slide tiles of a slide; the decoded tiles (uint8) are kept in the LRU tile cache
+        :return: tensor [n_tiles, n_channels, h, w] with n_tiles = min(tiles_per_slide, number of tiles of the slide)
+        """
+        keys = sorted(images_group.keys(), key=lambda key: int(key.split('_')[-1]))  # image_0, image_1, ... (tiling order)
+        keys = sample_tile_keys(keys, self.tiles_per_slide, self.tile_sampling, rng=self.tile_rng(index))
+        images = []
+        for key in keys:
+            tile = self.tile_cache.get((patient_id, key)) if self.tile_cache is not None else None
+            if tile is None:
+                tile = images_group[key][()]
+                if self.tile_cache is not None:
+                    self.tile_cache.put((patient_id, key), tile)
+                instr.count('dataset/tile_cache_misses')
+            else:
+                instr.count('dataset/tile_cache_hits')
+            images.append(self.transforms(Image.fromarray(tile)))
+        images = torch.stack(images)
+        if self.train_val_test == 'test':
+            images.requires_grad_()  # for the saliency maps
+        return images
+
+
+class SVSTileDataset(HDF5Dataset):
+    """
+    HDF5Dataset (survival data and RNA-seq from the h5 file) whose tiles are decoded from the whole slide images at the
+    coordinates of a tile manifest (svs_reader.py) instead of being read from the image tiles of the h5 file, so that no
+    tile images have to be extracted; multi-instance mode only (opt.tiles_per_slide > 0)
+    the slide handles and the LRU cache of decoded tiles are per process (i.e. per DataLoader worker)
+    """
+
+    def __init__(self, opt, h5_file, split, mode='wsi', train_val_test="train"):
+        super().__init__(opt, h5_file, split, mode=mode, train_val_test=train_val_test)
+        if self.tiles_per_slide <= 0:
+            raise ValueError("reading the tiles from the slides requires --tiles_per_slide > 0")
+        from svs_reader import SlideTileReader, load_slide_manifest
+        manifest = load_slide_manifest(opt.svs_manifest, getattr(opt, 'slides_dir', None))
+        manifest = manifest.sort_values(['patient_id', 'slide_path', 'y', 'x'])  # tiling order
+        self.patient_tiles = {patient_id: (group['slide_path'].to_numpy(), group[['x', 'y']].to_numpy())
+                              for patient_id, group in manifest.groupby('patient_id', observed=True)}
+        self.reader = SlideTileReader(tile_px=opt.input_size_wsi, tile_um=getattr(opt, 'tile_um', None),
+                                      max_open=getattr(opt, 'max_open_slides', 16),
+                                      cache_mb=getattr(opt, 'region_cache_mb', 512))
+
+    def load_tile_bag(self, index, patient_id, images_group):
+        """
+        sample (up to) tiles_per_slide tiles of the slides of a patient; the tiles of each slide are read in one batch
+        :return: tensor [n_tiles, n_channels, h, w]
+        """
+        patient_id = patient_id.decode() if isinstance(patient_id, bytes) else patient_id
+        slide_paths, coords = self.patient_tiles[patient_id]
+        keys = np.asarray(sample_tile_keys(list(range(len(coords))), self.tiles_per_slide, self.tile_sampling,
+                                           rng=self.tile_rng(index)), dtype=np.int64)
+        images = [None] * len(keys)
+        for slide_path in np.unique(slide_paths[keys]):
+            positions = np.flatnonzero(slide_paths[keys] == slide_path)
+            hits = self.reader.cache.hits if self.reader.cache is not None else 0
+            tiles = self.reader.read_tiles(slide_path, coords[keys[positions]])
+            if self.reader.cache is not None:
+                instr.count('dataset/tile_cache_hits', self.reader.cache.hits - hits)
+                instr.count('dataset/tile_cache_misses', len(positions) - (self.reader.cache.hits - hits))
+            for position, tile in zip(positions, tiles):
+                images[position] = self.transforms(Image.fromarray(tile))
+        images = torch.stack(images)
+        if self.train_val_test == 'test':
+            images.requires_grad_()  # for the saliency maps
+        return images
+
+
+def sample_tile_keys(keys, k, policy='random', rng=None):
+    """
+    choose k of the tiles of a slide (all of them if the slide has k tiles or less)
+    :param keys: tile keys in tiling order
+    :param policy: 'random' (uniform without replacement) or 'stratified' (one random tile from each of k contiguous
+                   blocks of the tiling order, which spreads the sample over the slide)
+    :param rng: numpy Generator; None picks evenly spaced tiles (deterministic)
+    """
+    n = len(keys)
+    if n <= k:
+        return list(keys)
+    if rng is None:
+        idx = np.linspace(0, n, k, endpoint=False).astype(int)
+    elif policy == 'random':
+        idx = np.sort(rng.choice(n, size=k, replace=False))
+    elif policy == 'stratified':
+        bounds = np.linspace(0, n, k + 1).astype(int)
+        idx = (bounds[:-1] + rng.random(k) * (bounds[1:] - bounds[:-1])).astype(int)
+    else:
+        raise ValueError(f"Unsupported tile sampling policy: {policy}")
+    return [keys[i] for i in idx]
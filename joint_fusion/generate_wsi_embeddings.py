@@ -7,44 +7,91 @@ import pandas as pd
 import torch
 import json
 from torch.utils.data import Dataset, DataLoader, TensorDataset
-from datasets import CustomDataset, HDF5Dataset
+from utils import TileBatch
+from tile_embedding_store import write_tile_embeddings
 import torch.nn as nn
-from torchvision import transforms
-from PIL import Image
-import timm
-from timm.models.vision_transformer import VisionTransformer
-from torchvision.io import read_image
-from torchvision.transforms import Resize, Normalize, ToTensor, Compose
-from timm.data import resolve_data_config
-from timm.data.transforms_factory import create_transform
-from huggingface_hub import login
 from pdb import set_trace
+# torchvision, the compiled/exported engines (inference_engines.py) and the int8 backbones (quantization.py) are imported
+# where they are used, so that the pooling modules (models.py) can be imported without the vision stack
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# autocast dtypes for the ViT backbone ('fp32' disables autocast)
+AMP_DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def masked_softmax(scores, mask=None):
+    """
+    softmax over the tiles (last dim) ignoring the padding tiles
+    :param scores: [batch_size, n_tiles]
+    :param mask: [batch_size, n_tiles], True for the real tiles (None: all tiles are real)
+    """
+    if mask is None:
+        return torch.softmax(scores, dim=-1)
+    # finfo.min instead of -inf so that slides without any tile get all-zero weights instead of NaNs
+    weights = torch.softmax(scores.masked_fill(~mask, torch.finfo(scores.dtype).min), dim=-1)
+    return weights * mask
+
+
+def _as_batch(x, mask):
+    # accept a single slide [n_tiles, dim] as well as a batch [batch_size, n_tiles, dim]
+    if x.dim() == 2:
+        return x.unsqueeze(0), None if mask is None else mask.unsqueeze(0), True
+    return x, mask, False
+
+
+def _chunked_scores(score_fn, x, chunk_size):
+    # apply score_fn ([batch_size, n, dim] -> [batch_size, n]) to chunks of tiles; with autograd enabled, each chunk is
+    # checkpointed so that only the scores (and not the hidden activations of all the tiles) are kept for backward
+    if chunk_size is None or x.shape[1] <= chunk_size:
+        return score_fn(x)
+    from torch.utils.checkpoint import checkpoint
+    scores = []
+    for start in range(0, x.shape[1], chunk_size):
+        x_chunk = x[:, start:start + chunk_size]
+        if torch.is_grad_enabled():
+            scores.append(checkpoint(score_fn, x_chunk, use_reentrant=False))
+        else:
+            scores.append(score_fn(x_chunk))
+    return torch.cat(scores, dim=1)
+
 
 class LearnedWeightedPool(nn.Module):
     """
     A simple pooling mechanism for weighted averaging of tile embeddings.
+    Works on a single slide [n_tiles, dim] or a padded batch [batch_size, n_tiles, dim] with a key padding mask.
+    chunk_size bounds the memory of the scoring MLP for slides with many (e.g. 10k+) tiles.
     """
 
-    def __init__(self, dim):
+    def __init__(self, dim, chunk_size=None):
         super().__init__()
+        self.chunk_size = chunk_size
         self.attention = nn.Sequential(
             nn.Linear(dim, dim // 2),
             nn.Tanh(),
             nn.Linear(dim // 2, 1)
         )
 
-    def forward(self, x):
-        # x shape: (n_tiles, embedding_dim)
-        weights = torch.softmax(self.attention(x), dim=0)  # (n_tiles, 1)
-        return (weights * x).sum(dim=0)  # (embedding_dim,)
+    def score(self, x):
+        return self.attention(x).squeeze(-1)  # (batch_size, n_tiles)
+
+    def forward(self, x, mask=None):
+        # x shape: (n_tiles, embedding_dim) or (batch_size, n_tiles, embedding_dim)
+        x, mask, unbatched = _as_batch(x, mask)
+        weights = masked_softmax(_chunked_scores(self.score, x, self.chunk_size), mask)  # (batch_size, n_tiles)
+        output = torch.bmm(weights.unsqueeze(1), x).squeeze(1)  # (batch_size, embedding_dim)
+        if unbatched:
+            return output.squeeze(0), weights.squeeze(0)
+        return output, weights  # Return both output and attention weights
 
 
 class AttentionPool(nn.Module):
     """
     attention pooling mechanism using a learnable query vector to attend to tile embeddings.
+    Works on a single slide [n_tiles, dim] or a padded batch [batch_size, n_tiles, dim] with a key padding mask.
+    The key and value projections are folded into the query and the pooled output, which is exact for linear projections:
+    k(x).q = x.(W_k^T q) + b_k.q and sum_i w_i v(x_i) = v(sum_i w_i x_i) (the weights sum to 1),
+    so the keys and values of the individual tiles are never materialized and the memory is linear in n_tiles.
     """
 
     def __init__(self, dim):
@@ -55,29 +102,63 @@ class AttentionPool(nn.Module):
         self.v = nn.Linear(dim, dim)
         self.scale = dim ** -0.5  # scaling factor for dot product attention
 
-    def forward(self, x):
-        # x shape: (n_tiles, embedding_dim)
+    def forward(self, x, mask=None):
+        # x shape: (n_tiles, embedding_dim) or (batch_size, n_tiles, embedding_dim)
+        x, mask, unbatched = _as_batch(x, mask)
 
-        # create a learnable query vector (1, embedding_dim)
+        # create a learnable query vector (batch_size, embedding_dim) from the mean of the (real) tiles
         # this will attend to all tile embeddings
-        query = self.q(torch.mean(x, dim=0, keepdim=True))  # (1, embedding_dim)
+        if mask is None:
+            mean = x.mean(dim=1)
+        else:  # bmm with the mask instead of x * mask, which would copy all the tile embeddings
+            counts = mask.sum(dim=1, keepdim=True).clamp(min=1).to(x.dtype)
+            mean = torch.bmm(mask.unsqueeze(1).to(x.dtype), x).squeeze(1) / counts
+        query = self.q(mean)  # (batch_size, embedding_dim)
+
+        # attention scores q.k for all tiles without projecting the tiles to keys
+        # (batch_size, n_tiles, embedding_dim) @ (batch_size, embedding_dim, 1) = (batch_size, n_tiles)
+        key_query = query @ self.k.weight  # (batch_size, embedding_dim)
+        attention_scores = (torch.bmm(x, key_query.unsqueeze(-1)).squeeze(-1)
+                            + (query @ self.k.bias).unsqueeze(-1)) * self.scale
 
-        # project tiles to keys and values
-        keys = self.k(x)  # (n_tiles, embedding_dim)
-        values = self.v(x)  # (n_tiles, embedding_dim)
+        # normalize attention scores
+        attention_weights = masked_softmax(attention_scores, mask)  # (batch_size, n_tiles)  [ attention = softmax(Q.K/sqrt(dim))V]
 
-        # compute attention scores
-        # (1, embedding_dim) @ (embedding_dim, n_tiles) = (1, n_tiles)
-        attention_scores = (query @ keys.transpose(-2, -1)) * self.scale
+        # weighted sum of the tiles, then the value projection
+        # (batch_size, 1, n_tiles) @ (batch_size, n_tiles, embedding_dim) = (batch_size, embedding_dim)
+        output = self.v(torch.bmm(attention_weights.unsqueeze(1), x).squeeze(1))
 
-        # normalize attention scores
-        attention_weights = torch.softmax(attention_scores, dim=-1)  # (1, n_tiles)  [ attention = softmax(Q.K/sqrt(dim))V]
+        if unbatched:
+            return output.squeeze(0), attention_weights.squeeze(0)
+        return output, attention_weights  # Return both output and attention weights
 
-        # Compute weighted sum of values
-        # (1, n_tiles) @ (n_tiles, embedding_dim) = (1, embedding_dim)
-        output = attention_weights @ values
 
-        return output.squeeze(0), attention_weights.squeeze(0)  # Return both output and attention weights
+class GatedAttentionPool(nn.Module):
+    """
+    gated attention MIL pooling (ABMIL, Ilse et al. 2018): score_i = w^T (tanh(V x_i) * sigmoid(U x_i)).
+    Works on a single slide [n_tiles, dim] or a padded batch [batch_size, n_tiles, dim] with a key padding mask.
+    V and U are stacked into a single projection so that the tiles are read by one matmul instead of two.
+    """
+
+    def __init__(self, dim, hidden_dim=128, dropout=0.0, chunk_size=None):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.attention_vu = nn.Linear(dim, 2 * hidden_dim)  # [V; U]
+        self.dropout = nn.Dropout(dropout)
+        self.attention_w = nn.Linear(hidden_dim, 1)
+
+    def score(self, x):
+        v, u = self.attention_vu(x).chunk(2, dim=-1)
+        return self.attention_w(self.dropout(torch.tanh(v) * torch.sigmoid(u))).squeeze(-1)  # (batch_size, n_tiles)
+
+    def forward(self, x, mask=None):
+        # x shape: (n_tiles, embedding_dim) or (batch_size, n_tiles, embedding_dim)
+        x, mask, unbatched = _as_batch(x, mask)
+        weights = masked_softmax(_chunked_scores(self.score, x, self.chunk_size), mask)  # (batch_size, n_tiles)
+        output = torch.bmm(weights.unsqueeze(1), x).squeeze(1)  # (batch_size, embedding_dim)
+        if unbatched:
+            return output.squeeze(0), weights.squeeze(0)
+        return output, weights
 
 
 # create a custom dataset to prepare tile data for entering into the encoder
@@ -107,51 +188,77 @@ class CustomDatasetWSI(Dataset):
         return tile
 
 
-# ensure you're authenticated with huggingface to access the UNI model weights
-HF_TOKEN = os.getenv("HF_TOKEN")
-if HF_TOKEN:
-    login(token=HF_TOKEN)
-else:
-    print("Warning: No Hugging Face token provided. Authentication might fail.")
+# the backbones are built on demand (nothing is imported, downloaded or logged into at import time)
+# weights_dir: local weights cache (default: $WSI_WEIGHTS_DIR, else the torch hub / huggingface caches)
+# offline: only use cached weights and never contact the network (default: $WSI_OFFLINE=1)
+BACKBONE_CONFIG = {'weights_dir': os.getenv("WSI_WEIGHTS_DIR"), 'offline': os.getenv("WSI_OFFLINE", "0") == "1"}
+_hf_logged_in = False
 
 
-def load_uni_model(model_name="UNI"):
+def configure_backbones(weights_dir=None, offline=None):
+    if weights_dir is not None:
+        BACKBONE_CONFIG['weights_dir'] = weights_dir
+    if offline is not None:
+        BACKBONE_CONFIG['offline'] = offline
+
+
+def _hf_login():
+    # ensure you're authenticated with huggingface to access the UNI model weights (once, when UNI is first built)
+    global _hf_logged_in
+    if _hf_logged_in:
+        return
+    from huggingface_hub import login
+    HF_TOKEN = os.getenv("HF_TOKEN")
+    if HF_TOKEN:
+        login(token=HF_TOKEN)
+    else:
+        print("Warning: No Hugging Face token provided. Authentication might fail.")
+    _hf_logged_in = True
+
+
+def load_uni_model(model_name="UNI", pretrained=True):
     """
     Load the UNI model from the MahmoodLab huggingface repository.
+    A local copy at <weights_dir>/<model_name>/pytorch_model.bin is used without accessing the hub.
     """
-    timm_kwargs = {
-        'img_size': 224,
-        'patch_size': 14,
-        'depth': 24,
-        'num_heads': 24,
-        'init_values': 1e-5,
-        'embed_dim': 1536,
-        'mlp_ratio': 2.66667 * 2,
-        'num_classes': 0,
-        'no_embed_class': True,
-        'mlp_layer': torch.nn.SiLU,
-        'act_layer': torch.nn.SiLU,
-        'reg_tokens': 8,
-        'dynamic_img_size': True
-    }
-    # model = timm.create_model(f"hf-hub:MahmoodLab/{model_name}", pretrained=True, **timm_kwargs)
-    # model = timm.create_model(f"hf-hub:MahmoodLab/{model_name}", pretrained=True)
-    # init_values need to be passed in to successfully load LayerScale parameters (e.g. - block.0.ls1.gamma)
-    model = timm.create_model(f"hf-hub:MahmoodLab/{model_name}", pretrained=True, init_values=1e-5, dynamic_img_size=True)
-    transform = create_transform(**resolve_data_config(model.pretrained_cfg, model=model))
+    weights_dir, offline = BACKBONE_CONFIG['weights_dir'], BACKBONE_CONFIG['offline']
+    if offline:
+        os.environ["HF_HUB_OFFLINE"] = "1"  # read before huggingface_hub is first imported: resolve from the cache only
+    import timm
+    from timm.data import resolve_data_config
+    from timm.data.transforms_factory import create_transform
+
+    local_weights = os.path.join(weights_dir, model_name, "pytorch_model.bin") if weights_dir else None
+    if not pretrained or (local_weights and os.path.exists(local_weights)):
+        # UNI is a ViT-L/16; architecture from timm, weights (if any) from the local copy
+        model = timm.create_model("vit_large_patch16_224", pretrained=False, img_size=224, patch_size=16,
+                                  init_values=1e-5, num_classes=0, dynamic_img_size=True)
+        if pretrained:
+            model.load_state_dict(torch.load(local_weights, map_location="cpu"), strict=True)
+        transform = create_transform(input_size=(3, 224, 224), interpolation='bicubic', crop_pct=1.0,
+                                     mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
+    else:
+        if not offline:
+            _hf_login()
+        hub_kwargs = {'cache_dir': weights_dir} if weights_dir else {}
+        # init_values need to be passed in to successfully load LayerScale parameters (e.g. - block.0.ls1.gamma)
+        model = timm.create_model(f"hf-hub:MahmoodLab/{model_name}", pretrained=True, init_values=1e-5,
+                                  dynamic_img_size=True, **hub_kwargs)
+        transform = create_transform(**resolve_data_config(model.pretrained_cfg, model=model))
     model.eval()
     return model, transform
 
 
-
-transform_lunit = Compose([
-    Resize((224, 224)),  # resize image to 224x224 for the model
-    # ToTensor(),
-    # normalization parameters for lunit DINO from
-    # https://github.com/lunit-io/benchmark-ssl-pathology/releases/tag/pretrained-weights
-    Normalize(mean=[0.70322989, 0.53606487, 0.66096631],
-              std=[0.21716536, 0.26081574, 0.20723464]),
-])
+def lunit_transform():
+    from torchvision.transforms import Resize, Normalize, Compose
+    return Compose([
+        Resize((224, 224)),  # resize image to 224x224 for the model
+        # ToTensor(),
+        # normalization parameters for lunit DINO from
+        # https://github.com/lunit-io/benchmark-ssl-pathology/releases/tag/pretrained-weights
+        Normalize(mean=[0.70322989, 0.53606487, 0.66096631],
+                  std=[0.21716536, 0.26081574, 0.20723464]),
+    ])
 
 # transform_uni = Compose([
 #         Resize(224),
@@ -174,6 +281,39 @@ def get_pretrained_lunit(key):
     pretrained_url = f"{URL_PREFIX}/{model_zoo_registry.get(key)}"
     return pretrained_url
 
+
+def load_lunit_state_dict(key, progress=False):
+    # from the weights cache if present, downloaded into it otherwise (not in offline mode)
+    pretrained_url = get_pretrained_lunit(key)
+    weights_dir = BACKBONE_CONFIG['weights_dir'] or os.path.join(torch.hub.get_dir(), "checkpoints")
+    cached_file = os.path.join(weights_dir, os.path.basename(pretrained_url))
+    if os.path.exists(cached_file):
+        return torch.load(cached_file, map_location="cpu")
+    if BACKBONE_CONFIG['offline']:
+        raise FileNotFoundError(f"{cached_file} not found (offline mode); download {pretrained_url} into {weights_dir}")
+    return torch.hub.load_state_dict_from_url(pretrained_url, model_dir=weights_dir, progress=progress,
+                                              map_location="cpu")
+
+
+def build_lunit_dino(pretrained=True, progress=False, key="DINO_p16", patch_size=16):
+    from timm.models.vision_transformer import VisionTransformer
+    model = VisionTransformer(
+        img_size=224,
+        patch_size=patch_size,
+        embed_dim=384,
+        num_heads=6,
+        num_classes=0
+    )
+    if pretrained:
+        model.load_state_dict(load_lunit_state_dict(key, progress))
+    return model, lunit_transform(), 384
+
+
+def build_uni(pretrained=True, progress=False):
+    model, transform = load_uni_model(pretrained=pretrained)
+    return model, transform, model.num_features  # 1024 for UNI
+
+
 # def get_pretrained_uni(key):
 #     URL_PREFIX = "https://github.com/lunit-io/benchmark-ssl-pathology/releases/download/pretrained-weights"
 #     model_zoo_registry = {
@@ -189,6 +329,8 @@ class WSIEncoder(nn.Module):
     By default, the model is fully frozen.
     For joint_fusion, the last transformer block and norm layers are unfrozen
     (for partial retraining).
+    Only the backbone runs under autocast (precision='bf16' or 'fp16'); the tile embeddings are cast back to fp32
+    before pooling so that the fusion MLP and the Cox loss stay in fp32.
     """
 
     def __init__(self,
@@ -197,18 +339,23 @@ class WSIEncoder(nn.Module):
                  pretrained=True,
                  progress=False,
                  # key="DINO_p16",
-                 patch_size=16):
+                 patch_size=16,
+                 precision='fp32',
+                 channels_last=False,
+                 device=None,
+                 tile_chunk_size=256,
+                 pooling_chunk_size=None,
+                 inference_engine='eager',
+                 engine_cache_dir='./engine_cache',
+                 quantization=None):
         super(WSIEncoder, self).__init__()
         self.wsi_fm = wsi_fm
         self.pooling = pooling
+        self.tile_chunk_size = tile_chunk_size  # max tiles per backbone forward pass for tile bags
+        self.last_attention_weights = None  # tile weights of the last attention/learned_weighted pooling call
         if self.wsi_fm == 'lunit_DINO':
-            # self.model = self.vit_small(pretrained, progress, key, patch_size=patch_size)
-            self.model = self.vit_small(pretrained,
-                                        progress,
-                                        "DINO_p16",
-                                        patch_size=patch_size)
-            self.transform = transform_lunit
-            self.embed_dim = 384
+            self.model, self.transform, self.embed_dim = build_lunit_dino(pretrained, progress, "DINO_p16",
+                                                                          patch_size=patch_size)
 
             # freeze all layers
             for param in self.model.parameters():
@@ -229,8 +376,7 @@ class WSIEncoder(nn.Module):
                     param.requires_grad = True
 
         elif self.wsi_fm == 'uni':
-            self.model, self.transform = load_uni_model()
-            self.embed_dim = 1024 # get it from the last layer output automatically
+            self.model, self.transform, self.embed_dim = build_uni(pretrained, progress)
             # set_trace()
 
             # freeze all layers by default
@@ -273,11 +419,14 @@ class WSIEncoder(nn.Module):
         #     param.requires_grad = False
 
         if self.pooling == 'learned_weighted':
-            self.attention_pool = LearnedWeightedPool(self.embed_dim)
+            self.attention_pool = LearnedWeightedPool(self.embed_dim, chunk_size=pooling_chunk_size)
 
         if self.pooling == 'attention':
             self.attention_pool = AttentionPool(self.embed_dim)
 
+        if self.pooling == 'gated_attention':
+            self.attention_pool = GatedAttentionPool(self.embed_dim, chunk_size=pooling_chunk_size)
+
         trainable_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
         print("Number of trainable params for the histology model (from generate_wsi_embeddings.py): ",
               trainable_params)
@@ -285,51 +434,107 @@ class WSIEncoder(nn.Module):
         # set the model to evaluation mode for early fusion
         if __name__ == "__main__":
             self.model.eval()  # use train mode when imported as module (joint fusion), and in inference mode when directly ran (early fusion)
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
         self.model.to(self.device)
-        if self.pooling in {'attention', 'learned_weighted'}:
+        if self.pooling in {'attention', 'learned_weighted', 'gated_attention'}:
             self.attention_pool.to(self.device)
-
-    def vit_small(self, pretrained, progress, key, patch_size=16):
-        model = VisionTransformer(
-            img_size=224,
-            patch_size=patch_size,
-            embed_dim=384,
-            num_heads=6,
-            num_classes=0
-        )
-        # # freeze all layers (when not using joint fusion)
-        # for param in model.parameters():
-        #     param.requires_grad = False
-        #
-        # if __name__ != "__main__":  # i.e. for joint fusion the last block is trained together with the rnaseq encoder
-        #     num_blocks = len(model.blocks)
-        #     print(f"Total number of transformer blocks in DINO: {num_blocks}")
-        #
-        #     # unfreeze the last transformer block
-        #     last_block_idx = num_blocks - 1
-        #     print(f"unfreezing block {last_block_idx}")
-        #     for param in model.blocks[last_block_idx].parameters():
-        #         param.requires_grad = True
-        #
-        #     # unfreeze the final norm layer
-        #     for param in model.norm.parameters():
-        #         param.requires_grad = True
-        #
-        # # print the trainable params
-        # print("parameters for the WSI model (those in the last layer should be trainable for joint fusion)")
-        # for name, param in model.named_parameters():
-        #     print(f"{name}: {param.requires_grad}")
-
-        if pretrained:
-            pretrained_url = get_pretrained_lunit(key)
-            model.load_state_dict(torch.hub.load_state_dict_from_url(pretrained_url, progress=progress))
-        return model
+        self.set_precision(precision, channels_last)
+
+        # compiled/exported backbone, only used under no_grad (frozen inference for early fusion)
+        self.engine = None
+        if inference_engine != 'eager':
+            if inference_engine in {'torchscript', 'onnx'} and precision != 'fp32':
+                raise ValueError(f"the {inference_engine} engine runs in fp32 (got precision={precision})")
+            from inference_engines import InferenceEngine
+            self.engine = InferenceEngine(self.model, engine=inference_engine, cache_dir=engine_cache_dir,
+                                          name=self.wsi_fm, device=self.device)
+
+        # int8 backbone for CPU inference, also only used under no_grad ('static' needs calibrate() before use)
+        self.quantization = quantization
+        self.quantized_model = None
+        if quantization is not None:
+            from quantization import QUANTIZATION_MODES, quantize_dynamic_int8
+            if quantization not in QUANTIZATION_MODES:
+                raise ValueError(f"Unsupported quantization: {quantization} (choose from {QUANTIZATION_MODES})")
+            if self.device.type != 'cpu' or precision != 'fp32' or inference_engine != 'eager':
+                raise ValueError("int8 quantization runs on CPU with precision='fp32' and the eager engine")
+            if quantization == 'dynamic':
+                self.quantized_model = quantize_dynamic_int8(self.model)
+
+    def calibrate(self, tiles):
+        """
+        static int8 quantization of the backbone with the activation ranges observed on a sample of tiles
+        :param tiles: [n_tiles, n_channels, h, w]
+        """
+        from quantization import quantize_static_int8
+        self.quantized_model = quantize_static_int8(self.model, tiles.to(self.device), batch_size=self.tile_chunk_size)
+        print(f"calibrated the static int8 backbone on {tiles.shape[0]} tiles")
+
+    def set_precision(self, precision='fp32', channels_last=False):
+        """
+        :param precision: 'fp32', 'bf16' or 'fp16' autocast for the backbone forward pass
+        :param channels_last: use NHWC memory format for the tiles and the patch embedding conv
+        """
+        if precision not in AMP_DTYPES:
+            raise ValueError(f"Unsupported precision: {precision} (choose from {list(AMP_DTYPES)})")
+        if precision == 'fp16' and self.device.type != 'cuda':
+            raise ValueError("fp16 autocast requires CUDA, use precision='bf16' on CPU")
+        self.precision = precision
+        self.amp_dtype = AMP_DTYPES[precision]
+        self.channels_last = channels_last
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        print(f"WSI backbone precision: {precision}, channels_last: {channels_last}, device: {self.device}")
+
+    def _backbone(self, tiles):
+        # tiles: [n_tiles, n_channels, h, w]
+        if self.channels_last:
+            tiles = tiles.contiguous(memory_format=torch.channels_last)
+        backbone = self.model
+        if not torch.is_grad_enabled():
+            if self.quantization is not None:
+                if self.quantized_model is None:
+                    raise RuntimeError("static quantization: call WSIEncoder.calibrate() on a sample of tiles first")
+                backbone = self.quantized_model
+            elif self.engine is not None:
+                backbone = self.engine
+        with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            features = backbone(tiles)
+        return features.float()  # pooling, fusion and the Cox loss run in fp32
+
+    def get_bag_embeddings(self, tile_batch):
+        """
+        slide level embeddings for a batch of variable length tile bags
+        :param tile_batch: utils.TileBatch (padded tiles [batch_size, max_tiles, C, H, W] and mask [batch_size, max_tiles])
+        :return: [batch_size, embed_dim]
+        """
+        mask = tile_batch.mask.to(self.device)
+        flat_tiles = tile_batch.flat().to(self.device)  # only the real tiles go through the backbone
+        features = torch.cat([self._backbone(flat_tiles[start:start + self.tile_chunk_size])
+                              for start in range(0, flat_tiles.shape[0], self.tile_chunk_size)])
+        embeddings = features.new_zeros(mask.shape + (features.shape[-1],))
+        embeddings[mask] = features
+        return self.pool_bags(embeddings, mask)
+
+    def pool_bags(self, embeddings, mask):
+        # embeddings: [batch_size, max_tiles, embed_dim], mask: [batch_size, max_tiles]; padding tiles are ignored
+        if self.pooling == 'average':
+            counts = mask.sum(dim=1, keepdim=True).clamp(min=1).to(embeddings.dtype)
+            return torch.bmm(mask.unsqueeze(1).to(embeddings.dtype), embeddings).squeeze(1) / counts
+        if self.pooling in {'attention', 'learned_weighted', 'gated_attention'}:
+            pooled, weights = self.attention_pool(embeddings, mask)
+            self.last_attention_weights = weights.detach()  # [batch_size, max_tiles] for interpretability
+            return pooled
+        raise ValueError(f"Pooling '{self.pooling}' is not supported for tile bags")
 
     def get_wsi_embeddings(self, x_wsi):
         # 'x_wsi' contain data from all tiles (list of tensors residing on the gpu)
         # len(x_wsi) = number of tiles per WSI
         # should get embeddings for each tile and pool them to get embeddings at the patient level
+        if isinstance(x_wsi, TileBatch):  # variable number of tiles per slide (HDF5Dataset with tiles_per_slide > 0)
+            return self.get_bag_embeddings(x_wsi)
         dataset = CustomDatasetWSI(x_wsi, self.wsi_fm, transform=self.transform)
         tile_loader = DataLoader(dataset, batch_size=1, shuffle=False)  # check later why the batch size is hard-coded to 1
         embeddings = []
@@ -342,17 +547,20 @@ class WSIEncoder(nn.Module):
                 for tiles in tile_loader:
                     tile_index += 1
                     # print(f"Loaded {tile_index} of {len(tile_loader)} tiles")
-                    tiles = tiles.to(device)
+                    tiles = tiles.to(self.device)
                     # tiles.shape torch.Size([1, 200, 3, 224, 224])
-                    features = self.model(tiles.squeeze(0))  # get rid of the leading singleton dim (tied to the batch size?); the model expects [batch_size, n_channels, h, w]
+                    features = self._backbone(tiles.squeeze(0))  # get rid of the leading singleton dim (tied to the batch size?); the model expects [batch_size, n_channels, h, w]
                     embeddings.append(features.cpu().numpy())
             embeddings_array = np.array(embeddings)
 
             # combine all tile embeddings into a single numpy array
-            if self.pooling in {'attention', 'learned_weight'}:
+            if self.pooling in {'attention', 'learned_weighted', 'gated_attention'}:
                 # convert to tensor for attention pooling
-                embeddings_tensor = torch.tensor(embeddings_array).squeeze(1).to(device)
-                slide_embedding = self.attention_pool(embeddings_tensor).cpu().numpy()
+                embeddings_tensor = torch.tensor(embeddings_array).squeeze(1).to(self.device)
+                with torch.no_grad():
+                    slide_embedding, weights = self.attention_pool(embeddings_tensor)
+                self.last_attention_weights = weights
+                slide_embedding = slide_embedding.cpu().numpy()
             elif self.pooling == 'average':  # average pooling
                 slide_embedding = np.mean(embeddings_array, axis=1)
             elif self.pooling == 'no_pooling':  # no pooling; get embeddings from all the tiles
@@ -362,14 +570,16 @@ class WSIEncoder(nn.Module):
 
         else:  # for joint fusion. Need to train parts of the model alongside models for other modalities and the downstream task
             for tiles in tile_loader:
-                tiles = tiles.to(device)
-                features = self.model(tiles.squeeze(
+                tiles = tiles.to(self.device)
+                features = self._backbone(tiles.squeeze(
                     0))  # Get rid of the leading dim; the model expects [batch_size, n_channels, h, w]; probably tied to batch_size hardcoded to 1?
                 embeddings.append(features.cpu())  # is moving to cpu really needed??
             embeddings_tensor = torch.stack(embeddings)
             # for joint fusion, the backprop will be through the combined embeddings to the inputs
-            if self.pooling in {'attention', 'learned_weighted'}:
-                slide_embedding = self.attention_pool(embeddings_tensor.squeeze(1).to(device))
+            if self.pooling in {'attention', 'learned_weighted', 'gated_attention'}:
+                # [n_tiles, batch_size, embed_dim] -> [batch_size, n_tiles, embed_dim]
+                slide_embedding, weights = self.attention_pool(embeddings_tensor.transpose(0, 1).to(self.device))
+                self.last_attention_weights = weights.detach()
             else:  # average pooling
                 slide_embedding = torch.mean(embeddings_tensor, dim=0)
         return slide_embedding
@@ -379,6 +589,9 @@ class WSIEncoder(nn.Module):
 # if this code is run directly, it only generates the embeddings (one embedding for each TCGA slide) and saves it as a dictionary
 # Generates embeddings for all samples, and not only for the training dataset (the train/validation/test is done later at the prediction stage)
 if __name__ == "__main__":
+    from inference_engines import ENGINES
+    from quantization import QUANTIZATION_MODES
+
     # run in only inference mode for early fusion
     # df containing the samples with both WSI and rnaseq data (generated by trainer.py)
     mapping_df = pd.read_json(
@@ -402,11 +615,35 @@ if __name__ == "__main__":
                         help="input_size for path images")
     parser.add_argument('--wsi_fm', type=str, default='uni', choices=['lunit_DINO', 'uni'],
                         help='WSI foundation model to use')
-    parser.add_argument('--pooling', type=str, default='no_pooling', choices=['average', 'learned_weighted', 'attention', 'no_pooling'],
+    parser.add_argument('--pooling', type=str, default='no_pooling', choices=['average', 'learned_weighted', 'attention', 'gated_attention', 'no_pooling'],
                         help='Pooling method for tile embeddings')
+    parser.add_argument('--pooling_chunk_size', type=int, default=None,
+                        help='score the tiles in chunks of this size for learned_weighted pooling (large slides)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(AMP_DTYPES),
+                        help='autocast dtype for the backbone (bf16 also runs on CPUs with AVX512-BF16/AMX)')
+    parser.add_argument('--channels_last', action='store_true', help='use NHWC memory format for the tiles')
+    parser.add_argument('--device', type=str, default=None, help='cuda or cpu (default: cuda if available)')
+    parser.add_argument('--output_file', type=str, default='./WSI_embeddings_uni_31Jan_1000tiles.json',
+                        help='output json file (compare against the fp32 embeddings with compare_wsi_embeddings.py)')
+    parser.add_argument('--inference_engine', type=str, default='eager', choices=ENGINES,
+                        help='run the frozen backbone with torch.compile, TorchScript or ONNX (onnxruntime)')
+    parser.add_argument('--engine_cache_dir', type=str, default='./engine_cache',
+                        help='cache of the compiled/exported backbones (reused by later runs)')
+    parser.add_argument('--quantization', type=str, default=None, choices=[m for m in QUANTIZATION_MODES if m],
+                        help='int8 quantized Linear layers for CPU inference (validate with compare_wsi_embeddings.py)')
+    parser.add_argument('--calibration_tiles', type=int, default=256,
+                        help='tiles (from slides spread over the dataset) for --quantization static')
+    parser.add_argument('--weights_dir', type=str, default=None,
+                        help='local backbone weights cache (default: $WSI_WEIGHTS_DIR or the torch hub/huggingface caches)')
+    parser.add_argument('--offline', action='store_true', help='only use cached backbone weights (no network access)')
+    parser.add_argument('--tile_embeddings_dir', type=str, default=None,
+                        help='with --pooling no_pooling, also write the tile embeddings to a tile embedding store '
+                             '(see tile_embedding_store.py) for training the MIL head with train_mil.py')
     opt = parser.parse_args()
+    configure_backbones(opt.weights_dir, opt.offline or None)
     # set_trace()
 
+    from datasets import CustomDataset, HDF5Dataset
     custom_dataset = CustomDataset(opt,
                                    mapping_df,
                                    mode='wsi')
@@ -418,12 +655,25 @@ if __name__ == "__main__":
                                                batch_size=1,
                                                shuffle=False, )
 
-    encoder = WSIEncoder(wsi_fm=opt.wsi_fm, pooling=opt.pooling)
+    encoder = WSIEncoder(wsi_fm=opt.wsi_fm, pooling=opt.pooling, precision=opt.precision,
+                         channels_last=opt.channels_last, device=opt.device, pooling_chunk_size=opt.pooling_chunk_size,
+                         inference_engine=opt.inference_engine, engine_cache_dir=opt.engine_cache_dir,
+                         quantization=opt.quantization)
+    if opt.quantization == 'static':
+        calibration_tiles = []
+        n_calibration_slides = min(len(custom_dataset), 16)
+        for index in np.linspace(0, len(custom_dataset) - 1, n_calibration_slides).astype(int):
+            x_wsi = custom_dataset[index][3]
+            calibration_tiles.append(torch.cat([tile.reshape((-1,) + tuple(tile.shape[-3:])) for tile in x_wsi]))
+        calibration_tiles = torch.cat(calibration_tiles)
+        calibration_tiles = calibration_tiles[torch.randperm(calibration_tiles.shape[0])[:opt.calibration_tiles]]
+        encoder.calibrate(calibration_tiles)
 
     # Initialize an empty dictionary to store TCGA IDs and embeddings
     # excluded_ids = ['TCGA-05-4395', 'TCGA-86-8281']  # contains anomalous time to event and censoring data
     excluded_ids = []
     patient_embeddings = {}
+    tile_embeddings = {}
 
     # loop over all samples in batches
     # can do this in batches as in generating rnaseq embeddings
@@ -437,6 +687,8 @@ if __name__ == "__main__":
         # save the embeddings in a file for using in early fusion
         embeddings_list = embeddings_slide.tolist() if isinstance(embeddings_slide, np.ndarray) else embeddings_slide
         patient_embeddings[tcga_id] = embeddings_list
+        if opt.tile_embeddings_dir is not None:
+            tile_embeddings[tcga_id] = np.asarray(embeddings_slide, dtype=np.float32).reshape(-1, encoder.embed_dim)
         # set_trace()
         # if batch_idx == 5:
         #     break
@@ -444,10 +696,13 @@ if __name__ == "__main__":
     # write out the embeddings to a json file
     # filename = "./WSI_embeddings_23july.json"
 
-    filename = "./WSI_embeddings_uni_31Jan_1000tiles.json"
+    filename = opt.output_file
     with open(filename, 'w') as file:
         json.dump(patient_embeddings, file)
 
+    if opt.tile_embeddings_dir is not None:
+        write_tile_embeddings(opt.tile_embeddings_dir, list(tile_embeddings), list(tile_embeddings.values()))
+
     # reduce storage precision for smaller file size
     wsi_embs_rounded = patient_embeddings.applymap(lambda x: [round(val, 4) for val in x])
     wsi_embs_rounded.to_json('./WSI_embeddings_uni_31Jan.rounded.json', orient='columns')
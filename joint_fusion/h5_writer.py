@@ -0,0 +1,183 @@
+# parallel writer of the HDF5 dataset of trainer.py (mapping_data.h5: split/patient/{days_to_*, event_occurred, rnaseq_data,
+# images/image_<i>}), same layout and gzip filter as before
+#   workers (process pool): decode the tiles (PIL) and deflate them (zlib, the format of the HDF5 gzip filter), a few tiles
+#                           per task
+#   writer (this process):  commits the compressed tiles in order with write_direct_chunk (one chunk per tile, so HDF5
+#                           doesn't compress again), at most max_pending tasks are in flight
+# every patient group is marked complete (attribute) and the file flushed once all its tiles are written, so an interrupted
+# run can be resumed (resume=True): complete patients are skipped, partially written ones are written again
+# python h5_writer.py --benchmark --n_patients 8 --tiles_per_patient 200 --num_workers 8   # tiles/s on synthetic tiles
+import os
+import time
+import zlib
+import argparse
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+
+def encode_tiles(paths, compression_level=4):
+    """
+    :return: list of (shape, dtype, deflated bytes) of the decoded tiles
+    """
+    encoded = []
+    for path in paths:
+        with Image.open(path) as image:
+            img_arr = np.ascontiguousarray(np.asarray(image))
+        encoded.append((img_arr.shape, img_arr.dtype.str, zlib.compress(img_arr.tobytes(), compression_level)))
+    return encoded
+
+
+def write_patient_data(patient_group, row, rnaseq_data):
+    patient_group.create_dataset('days_to_death', data=row['days_to_death'])
+    patient_group.create_dataset('days_to_last_followup', data=row['days_to_last_followup'])
+    patient_group.create_dataset('days_to_event', data=row['time'])
+    patient_group.create_dataset('event_occurred', data=1 if row['event_occurred'] == 'Dead' else 0)
+    patient_group.create_dataset('rnaseq_data', data=rnaseq_data)
+
+
+def write_tile(images_group, name, shape, dtype, data, compression_level=4):
+    dset = images_group.create_dataset(name, shape=shape, dtype=dtype, chunks=shape, compression='gzip',
+                                       compression_opts=compression_level)
+    dset.id.write_direct_chunk((0,) * len(shape), data)
+
+
+class Progress:
+    # patients/tiles done, tiles/s and MB/s (decoded and compressed), printed at most every `every` seconds
+    def __init__(self, n_patients, n_tiles, every=10.0):
+        self.n_patients, self.n_tiles, self.every = n_patients, n_tiles, every
+        self.patients = self.tiles = self.raw_bytes = self.written_bytes = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, shape, dtype, data):
+        self.tiles += 1
+        self.raw_bytes += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.written_bytes += len(data)
+
+    def patient_done(self):
+        self.patients += 1
+        now = time.perf_counter()
+        if now - self.last >= self.every or self.patients == self.n_patients:
+            self.last = now
+            print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        rate = self.tiles / elapsed
+        eta = (self.n_tiles - self.tiles) / rate if rate > 0 else float('nan')
+        return (f"{self.patients}/{self.n_patients} patients, {self.tiles}/{self.n_tiles} tiles in {elapsed:.0f} s: "
+                f"{rate:.0f} tiles/s, {self.raw_bytes / elapsed / 2 ** 20:.1f} MB/s decoded, "
+                f"{self.written_bytes / elapsed / 2 ** 20:.1f} MB/s written, ETA {eta:.0f} s")
+
+
+def _iter_encoded(tasks, num_workers, compression_level, max_pending):
+    # encoded tiles of the tasks, in order
+    if num_workers == 0:
+        for paths in tasks:
+            yield encode_tiles(paths, compression_level)
+        return
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        tasks = iter(tasks)
+        for paths in tasks:
+            pending.append(executor.submit(encode_tiles, paths, compression_level))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_h5_file(file_name, splits, rnaseq, tile_path, num_workers=None, resume=False, compression_level=4,
+                  tiles_per_task=16, max_pending=None, progress_every=10.0):
+    """
+    :param splits: list of (split name, mapping DataFrame) (index: patient ids; tiles, rnaseq_row and survival columns)
+    :param rnaseq: [n_samples, n_genes] expression matrix (rows given by rnaseq_row)
+    :param tile_path: function of a tile name returning its path
+    :param num_workers: decoding/compression processes (0: in this process)
+    :param resume: keep the patients completed by a previous run of file_name (else the file is overwritten)
+    :return: Progress of the run
+    """
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    max_pending = max_pending or 4 * max(num_workers, 1)
+    mode = 'a' if resume and os.path.exists(file_name) else 'w'
+    with h5py.File(file_name, mode) as hdf:
+        todo = []  # (split group, patient id, row)
+        for split, df in splits:
+            split_group = hdf.require_group(split)
+            for idx, row in df.iterrows():
+                if idx in split_group:
+                    if split_group[idx].attrs.get('complete', False):
+                        continue
+                    del split_group[idx]  # (partially written by an interrupted run)
+                todo.append((split_group, idx, row))
+        n_tiles = sum(len(row['tiles']) for _, _, row in todo)
+        print(f"Writing {len(todo)} patients ({n_tiles} tiles) to {file_name} with {num_workers} workers"
+              + (f" ({sum(len(df) for _, df in splits) - len(todo)} patients already complete)" if mode == 'a' else ''))
+        progress = Progress(len(todo), n_tiles, progress_every)
+
+        def tasks():
+            for _, _, row in todo:
+                paths = [tile_path(tile) for tile in row['tiles']]
+                for start in range(0, len(paths), tiles_per_task):
+                    yield paths[start:start + tiles_per_task]
+
+        encoded = _iter_encoded(tasks(), num_workers, compression_level, max_pending)
+        for split_group, idx, row in todo:
+            patient_group = split_group.create_group(idx)
+            write_patient_data(patient_group, row, np.asarray(rnaseq[row['rnaseq_row']], dtype=np.float64))
+            images_group = patient_group.create_group('images')
+            i = 0
+            while i < len(row['tiles']):
+                for shape, dtype, data in next(encoded):
+                    write_tile(images_group, f'image_{i}', shape, dtype, data, compression_level)
+                    progress.update(shape, dtype, data)
+                    i += 1
+            patient_group.attrs['complete'] = True
+            hdf.flush()
+            progress.patient_done()
+        encoded.close()
+    return progress
+
+
+def synthetic_tiles(tiles_dir, n_patients=8, tiles_per_patient=200, tile_px=256, seed=0):
+    # noisy RGB png tiles and the matching mapping DataFrame and expression matrix
+    rng = np.random.default_rng(seed)
+    rows = {}
+    for p in range(n_patients):
+        tcga_id = f"TCGA-SY-{p:04d}"
+        tiles = []
+        for t in range(tiles_per_patient):
+            tile = f"{tcga_id}_{t}.png"
+            base = rng.integers(120, 230, size=3)
+            img = np.clip(base + rng.normal(0, 20, (tile_px, tile_px, 3)), 0, 255).astype(np.uint8)
+            Image.fromarray(img).save(os.path.join(tiles_dir, tile))
+            tiles.append(tile)
+        rows[tcga_id] = {'days_to_death': float(rng.integers(10, 3000)), 'days_to_last_followup': np.nan,
+                         'event_occurred': 'Dead', 'tiles': tiles, 'rnaseq_row': p}
+    mapping_df = pd.DataFrame.from_dict(rows, orient='index')
+    mapping_df['time'] = mapping_df['days_to_death'].fillna(mapping_df['days_to_last_followup'])
+    return mapping_df, rng.lognormal(0, 2, (n_patients, 1000)).astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', action='store_true', help='write synthetic tiles (serial and with the pool)')
+    parser.add_argument('--n_patients', type=int, default=8)
+    parser.add_argument('--tiles_per_patient', type=int, default=200)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--compression_level', type=int, default=4)
+    opt = parser.parse_args()
+
+    if opt.benchmark:
+        tiles_dir = tempfile.mkdtemp()
+        mapping_df, rnaseq = synthetic_tiles(tiles_dir, opt.n_patients, opt.tiles_per_patient)
+        splits = [('train', mapping_df.iloc[::2]), ('val', mapping_df.iloc[1::2])]
+        for num_workers in [0, opt.num_workers]:
+            progress = write_h5_file(os.path.join(tiles_dir, 'mapping_data.h5'), splits, rnaseq,
+                                     lambda tile: os.path.join(tiles_dir, tile), num_workers=num_workers,
+                                     compression_level=opt.compression_level, progress_every=float('inf'))
+            print(f"num_workers={num_workers}: {progress.summary()}")
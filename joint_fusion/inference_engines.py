@@ -0,0 +1,170 @@
+# inference engines for the frozen WSI backbone (early fusion embedding generation)
+#   eager:       plain PyTorch
+#   compile:     torch.compile (inductor); the compiled kernels go to the inductor FX graph cache under cache_dir, so that
+#                later runs skip the compilation
+#   torchscript: traced once and saved to cache_dir (later runs load the saved module)
+#   onnx:        exported once to cache_dir and run with onnxruntime (CPU by default)
+# the cached artifacts are keyed by the backbone weights, the input tile shape and the torch version; every engine is
+# checked against eager mode on the first batch of tiles it sees
+import os
+import time
+import hashlib
+import inspect
+import numpy as np
+import torch
+
+ENGINES = ['eager', 'compile', 'torchscript', 'onnx']
+
+
+def model_fingerprint(model):
+    # hash of the weights (names, shapes, values) of the model
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def compare_outputs(reference, output):
+    """
+    :return: max abs difference relative to the max abs reference value, and the min cosine similarity of the rows
+    """
+    reference, output = reference.float().cpu(), output.float().cpu()
+    max_rel_diff = ((output - reference).abs().max() / reference.abs().max().clamp(min=1e-12)).item()
+    min_cosine = torch.nn.functional.cosine_similarity(output, reference, dim=-1).min().item()
+    return max_rel_diff, min_cosine
+
+
+class InferenceEngine:
+    """
+    Frozen backbone wrapped in an inference engine; built lazily on the first call (the tile shape of that batch is
+    used for tracing/export, the batch dimension stays dynamic).
+
+    :param model: backbone in eval mode ([n_tiles, C, H, W] -> [n_tiles, embed_dim])
+    :param engine: one of ENGINES
+    :param cache_dir: directory of the cached artifacts
+    :param name: prefix of the cached artifacts (e.g. the foundation model)
+    :param rtol: max abs difference to eager mode (relative to the max abs eager output) accepted by the check
+    """
+
+    def __init__(self, model, engine='eager', cache_dir='./engine_cache', name='backbone', device='cpu', rtol=1e-3,
+                 verify=True):
+        if engine not in ENGINES:
+            raise ValueError(f"Unsupported inference engine: {engine} (choose from {ENGINES})")
+        self.model = model.eval()
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.name = name
+        self.device = torch.device(device)
+        self.rtol = rtol
+        self.verify = verify
+        self.runner = None
+        self.build_time = None
+
+    def artifact_path(self, tile_shape, extension):
+        key = f"{self.name}_{model_fingerprint(self.model)}_{'x'.join(map(str, tile_shape))}_torch{torch.__version__}"
+        return os.path.join(self.cache_dir, f"{key}.{extension}")
+
+    def build(self, example):
+        start = time.perf_counter()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tile_shape = tuple(example.shape[1:])
+        if self.engine == 'eager':
+            self.runner = self.model
+        elif self.engine == 'compile':
+            # the inductor cache directory is read when inductor is first used in the process
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(self.cache_dir, "inductor"))
+            import torch._inductor.config  # (not imported by `import torch`)
+            torch._inductor.config.fx_graph_cache = True
+            self.runner = torch.compile(self.model)
+        elif self.engine == 'torchscript':
+            path = self.artifact_path(tile_shape, 'ts.pt')
+            if not os.path.exists(path):
+                with torch.no_grad():
+                    traced = torch.jit.freeze(torch.jit.trace(self.model, example))
+                traced.save(path)
+                print(f"saved the TorchScript backbone to {path}")
+            self.runner = torch.jit.load(path, map_location=self.device)
+        elif self.engine == 'onnx':
+            import onnxruntime
+            path = self.artifact_path(tile_shape, 'onnx')
+            if not os.path.exists(path):
+                # legacy (TorchScript based) exporter; the dynamo exporter needs onnxscript
+                export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+                torch.onnx.export(self.model, (example,), path, input_names=['tiles'], output_names=['features'],
+                                  dynamic_axes={'tiles': {0: 'n_tiles'}, 'features': {0: 'n_tiles'}},
+                                  opset_version=17, **export_kwargs)
+                print(f"saved the ONNX backbone to {path}")
+            providers = ['CUDAExecutionProvider'] if self.device.type == 'cuda' else ['CPUExecutionProvider']
+            session = onnxruntime.InferenceSession(path, providers=providers)
+            self.runner = lambda tiles: torch.from_numpy(
+                session.run(None, {'tiles': tiles.detach().cpu().numpy()})[0]).to(tiles.device)
+
+        if self.verify and self.engine != 'eager':  # (for compile, the first call also compiles)
+            with torch.no_grad():
+                max_rel_diff, min_cosine = compare_outputs(self.model(example), self.runner(example))
+            print(f"{self.engine} vs eager: max rel diff {max_rel_diff:.2e}, min cosine {min_cosine:.6f}")
+            if max_rel_diff > self.rtol:
+                raise RuntimeError(f"{self.engine} backbone differs from eager mode (max rel diff {max_rel_diff:.2e} > "
+                                   f"{self.rtol:.0e}); delete the cached artifacts in {self.cache_dir} if the model changed")
+        self.build_time = time.perf_counter() - start
+
+    def __call__(self, tiles):
+        if self.runner is None:
+            self.build(tiles)
+        with torch.no_grad():
+            return self.runner(tiles)
+
+
+def benchmark_engine(engine, tiles, batch_size, repeats=3):
+    """
+    :return: tiles/s of the engine (after the build/warm-up call) and the build time (s)
+    """
+    engine(tiles[:batch_size])  # build, verify and warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i in range(0, tiles.shape[0], batch_size):
+            engine(tiles[i:i + batch_size])
+        times.append(time.perf_counter() - start)
+    return tiles.shape[0] / float(np.median(times)), engine.build_time
+
+
+if __name__ == "__main__":
+    # tiles/s of each engine for a foundation model backbone on random tiles
+    # python inference_engines.py --wsi_fm lunit_DINO --engines eager compile torchscript onnx --n_tiles 256
+    import argparse
+    from generate_wsi_embeddings import build_lunit_dino, build_uni, configure_backbones
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wsi_fm', type=str, default='lunit_DINO', choices=['lunit_DINO', 'uni'])
+    parser.add_argument('--engines', type=str, nargs='+', default=ENGINES, choices=ENGINES)
+    parser.add_argument('--n_tiles', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--cache_dir', type=str, default='./engine_cache')
+    parser.add_argument('--weights_dir', type=str, default=None)
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--random_weights', action='store_true', help='skip loading the pretrained weights')
+    opt = parser.parse_args()
+
+    if opt.num_threads is not None:
+        torch.set_num_threads(opt.num_threads)
+    configure_backbones(opt.weights_dir, opt.offline or None)
+    build = build_lunit_dino if opt.wsi_fm == 'lunit_DINO' else build_uni
+    model, _, _ = build(pretrained=not opt.random_weights)
+    model.eval()
+    tiles = torch.randn(opt.n_tiles, 3, 224, 224)
+
+    print(f"{opt.wsi_fm}, {opt.n_tiles} tiles, batch_size={opt.batch_size}, threads={torch.get_num_threads()}")
+    print(f"{'engine':>12s} {'tiles/s':>9s} {'build (s)':>10s}")
+    for name in opt.engines:
+        engine = InferenceEngine(model, engine=name, cache_dir=opt.cache_dir, name=opt.wsi_fm)
+        try:
+            tiles_per_second, build_time = benchmark_engine(engine, tiles, opt.batch_size, opt.repeats)
+        except (ImportError, RuntimeError) as error:
+            print(f"{name:>12s} failed: {error}")
+            continue
+        print(f"{name:>12s} {tiles_per_second:9.1f} {build_time:10.2f}")
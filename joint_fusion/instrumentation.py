@@ -0,0 +1,190 @@
+# Lightweight step instrumentation for the joint fusion pipeline
+# replaces the ad-hoc "Step 1/2/3" wall-clock prints in the datasets, the model forward pass and train_nn
+# usage:
+#   from instrumentation import instr
+#   instr.configure(enabled=True, sample_every=10)
+#   with instr.timer('forward'):
+#       ...
+#   instr.end_epoch(epoch)  # prints/exports p50/p95 summaries for the epoch
+# when disabled, timer() returns a shared no-op context manager and debug() returns immediately,
+# so the instrumented code paths cost one attribute lookup and never force device synchronizations
+
+import os
+import csv
+import json
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import numpy as np
+
+_NULL_TIMER = nullcontext()
+
+
+class _Timer:
+    __slots__ = ('instr', 'name', 'start')
+
+    def __init__(self, instr, name):
+        self.instr = instr
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.instr.sync_cuda:
+            self.instr._synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.instr.sync_cuda:
+            self.instr._synchronize()  # make sure the queued kernels are included in the measured time
+        self.instr.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation:
+    """
+    Named timers and counters with sampling control and per-epoch summaries.
+
+    :param enabled: if False, all calls are no-ops
+    :param sample_every: record timers only on every n-th step (see step())
+    :param sync_cuda: synchronize CUDA before/after each timed region (accurate GPU times, but adds syncs)
+    :param verbose: print the debug() messages for sampled steps
+    :param output_dir: directory for the JSON/CSV exports (nothing is written if None)
+    :param use_wandb: also log the epoch summaries to wandb
+    """
+
+    def __init__(self, enabled=False, sample_every=1, sync_cuda=False, verbose=False, output_dir=None,
+                 use_wandb=False):
+        self.configure(enabled=enabled, sample_every=sample_every, sync_cuda=sync_cuda, verbose=verbose,
+                       output_dir=output_dir, use_wandb=use_wandb)
+
+    def configure(self, enabled=False, sample_every=1, sync_cuda=False, verbose=False, output_dir=None,
+                  use_wandb=False):
+        self.enabled = bool(enabled)
+        self.sample_every = max(int(sample_every), 1)
+        self.sync_cuda = bool(sync_cuda) and self.enabled
+        self.verbose = bool(verbose) and self.enabled
+        self.output_dir = output_dir
+        self.use_wandb = bool(use_wandb) and self.enabled
+        self.reset()
+        if self.enabled and self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+        return self
+
+    def reset(self):
+        self.step_count = 0
+        self.sampled = self.enabled
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.history = []  # one summary dict per epoch
+
+    def step(self):
+        """advance the step counter (call once per training/validation batch) and update the sampling flag"""
+        if not self.enabled:
+            return
+        self.step_count += 1
+        self.sampled = (self.step_count % self.sample_every) == 0
+
+    def timer(self, name):
+        if not (self.enabled and self.sampled):
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.timings[name].append(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def debug(self, msg, *args):
+        # lazy %-formatting so that tensors are only converted to strings when the message is printed
+        if self.verbose and self.sampled:
+            print(msg % args if args else msg)
+
+    def summarize(self):
+        summary = {}
+        for name, values in self.timings.items():
+            arr = np.asarray(values, dtype=np.float64)
+            summary[name] = {
+                'count': int(arr.size),
+                'total_s': float(arr.sum()),
+                'mean_s': float(arr.mean()),
+                'p50_s': float(np.percentile(arr, 50)),
+                'p95_s': float(np.percentile(arr, 95)),
+                'max_s': float(arr.max()),
+            }
+        for name, value in self.counters.items():
+            summary.setdefault(name, {})['counter'] = value
+        return summary
+
+    def end_epoch(self, epoch, prefix=''):
+        """summarize the timings collected since the last call, export them, and start a new window"""
+        if not self.enabled:
+            return None
+        summary = self.summarize()
+        self.history.append({'epoch': epoch, 'prefix': prefix, 'metrics': summary})
+        self._print_summary(epoch, prefix, summary)
+        if self.output_dir:
+            self.export_json(os.path.join(self.output_dir, 'instrumentation.json'))
+            self.export_csv(os.path.join(self.output_dir, 'instrumentation.csv'))
+        if self.use_wandb:
+            self._log_wandb(epoch, prefix, summary)
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        return summary
+
+    def export_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.history, file, indent=2)
+
+    def export_csv(self, path):
+        fields = ['epoch', 'prefix', 'name', 'count', 'total_s', 'mean_s', 'p50_s', 'p95_s', 'max_s', 'counter']
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            for entry in self.history:
+                for name, metrics in entry['metrics'].items():
+                    writer.writerow({'epoch': entry['epoch'], 'prefix': entry['prefix'], 'name': name, **metrics})
+
+    def _print_summary(self, epoch, prefix, summary):
+        print(f"---- instrumentation summary {prefix}(epoch {epoch}) ----")
+        for name, metrics in sorted(summary.items()):
+            if 'p50_s' in metrics:
+                print(f"{name:>24s}: n={metrics['count']:6d}  p50={metrics['p50_s'] * 1e3:9.2f} ms  "
+                      f"p95={metrics['p95_s'] * 1e3:9.2f} ms  total={metrics['total_s']:8.2f} s")
+            if 'counter' in metrics:
+                print(f"{name:>24s}: count={metrics['counter']}")
+
+    def _log_wandb(self, epoch, prefix, summary):
+        import wandb
+        if wandb.run is None:
+            return
+        log = {}
+        for name, metrics in summary.items():
+            for key in ('p50_s', 'p95_s', 'total_s', 'counter'):
+                if key in metrics:
+                    log[f"Instrumentation/{prefix}{name}/{key}"] = metrics[key]
+        wandb.log(log, step=epoch)
+
+    @staticmethod
+    def _synchronize():
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+
+# module level instance shared by datasets.py, models.py and train_test.py
+instr = Instrumentation()
+
+
+def configure_from_opt(opt):
+    """configure the shared instance from the argparse options in trainer.py (missing options disable it)"""
+    return instr.configure(enabled=getattr(opt, 'instrument', False),
+                           sample_every=getattr(opt, 'instrument_every', 1),
+                           sync_cuda=getattr(opt, 'instrument_sync_cuda', False),
+                           verbose=getattr(opt, 'instrument_verbose', False),
+                           output_dir=getattr(opt, 'instrument_output_dir', None),
+                           use_wandb=getattr(opt, 'instrument_wandb', False))
@@ -0,0 +1,65 @@
+# startup time of omic-only training: importing models.py / train_test.py and building an omic-only MultimodalNetwork,
+# each measured in a fresh interpreter (median of --repeats runs)
+# also reports whether the WSI backbone stack (timm, huggingface_hub) was imported
+# compare before/after a change by pointing --code_dir to another checkout, e.g.
+#   git worktree add /tmp/baseline <commit> && python measure_startup.py --code_dir /tmp/baseline/joint_fusion
+#   python measure_startup.py
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+STAGES = {
+    'import models': "import models",
+    'import train_test': "import train_test",
+    'omic-only model': ("import models\n"
+                        "model = models.MultimodalNetwork(embedding_dim_wsi=384, embedding_dim_omic=256, mode='omic', "
+                        "fusion_type=None)"),
+}
+
+TEMPLATE = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'timm': 'timm' in sys.modules, 'huggingface_hub': 'huggingface_hub' in sys.modules}}))
+"""
+
+
+def measure(code_dir, code, offline):
+    env = dict(os.environ)
+    if offline:
+        env['WSI_OFFLINE'] = '1'
+        env['HF_HUB_OFFLINE'] = '1'
+    result = subprocess.run([sys.executable, '-c', TEMPLATE.format(code=code)], cwd=code_dir, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'
+    return json.loads(result.stdout.strip().splitlines()[-1]), None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--code_dir', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help='joint_fusion directory of the checkout to measure')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--offline', action='store_true', help='set WSI_OFFLINE=1 and HF_HUB_OFFLINE=1')
+    opt = parser.parse_args()
+
+    print(f"code_dir={opt.code_dir}, repeats={opt.repeats}, offline={opt.offline}")
+    print(f"{'stage':>18s} {'median (s)':>11s} {'min (s)':>8s} {'timm':>5s} {'hf_hub':>6s}")
+    for stage, code in STAGES.items():
+        runs, error = [], None
+        for _ in range(opt.repeats):
+            run, error = measure(opt.code_dir, code, opt.offline)
+            if run is None:
+                break
+            runs.append(run)
+        if not runs:
+            print(f"{stage:>18s} failed: {error}")
+            continue
+        seconds = [run['seconds'] for run in runs]
+        print(f"{stage:>18s} {np.median(seconds):11.3f} {np.min(seconds):8.3f} {str(runs[-1]['timm']):>5s} "
+              f"{str(runs[-1]['huggingface_hub']):>6s}")
@@ -5,18 +5,17 @@ import pandas as pd
 import numpy as np
 import os
 import time
-from generate_rnaseq_embeddings import get_omic_embeddings
-from lookup_embeddings import early_fusion_get_omic_embeddings, early_fusion_get_wsi_embeddings
-from generate_wsi_embeddings import WSIEncoder
-import torchvision.models as models
+# the WSI backbones (and the rnaseq VAE / early fusion lookups) are only imported and loaded when a network needs them,
+# so that importing this module is cheap and works offline (e.g. omic-only training); generate_wsi_embeddings is imported
+# by the constructors of WSINetwork and MILNetwork
+from instrumentation import instr
+from profiling import region
 from pdb import set_trace
-from torchvision.models.vision_transformer import vit_b_32
-from torchvision.models import ViT_B_32_Weights
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 # make the output(embedding) dimension a hyperparameter
 class WSINetwork(nn.Module):
-    def __init__(self, embedding_dim):
+    def __init__(self, embedding_dim, wsi_fm='lunit_DINO', pretrained=True):
         super(WSINetwork, self).__init__()
         self.embedding_dim = embedding_dim
         self.use_cnn = False
@@ -50,6 +49,9 @@ class WSINetwork(nn.Module):
             )
 
         elif self.use_resnet:
+            import torchvision.models as models
+            from torchvision.models.vision_transformer import vit_b_32
+            from torchvision.models import ViT_B_32_Weights
             # 18 layer resnet
             # can train the whole model or freeze certain layers
             resnet18 = models.resnet18(pretrained=True)
@@ -82,9 +84,10 @@ class WSINetwork(nn.Module):
             )
 
         elif self.use_lunit_dino:
-            self.encoder = WSIEncoder(pretrained=True)
+            from generate_wsi_embeddings import WSIEncoder
+            self.encoder = WSIEncoder(wsi_fm=wsi_fm, pretrained=pretrained)
             self.net = nn.Sequential(
-                nn.Linear(384, embedding_dim),  # to match the embedding dimension to the vit output
+                nn.Linear(self.encoder.embed_dim, embedding_dim),  # to match the embedding dimension to the vit output
                 nn.ReLU()
             )
 
@@ -99,6 +102,35 @@ class WSINetwork(nn.Module):
             return self.net(x_wsi)
 
 
+class MILNetwork(nn.Module):
+    """
+    gated attention MIL head over precomputed tile embeddings (no pixels and no foundation model in the loop)
+    :param input_dim: dimension of the tile embeddings (384 for lunit DINO, 1024 for UNI)
+    :param embedding_dim: output (slide) embedding dimension
+    """
+    def __init__(self, embedding_dim, input_dim=1024, hidden_dim=256, attention_dim=128, dropout=0.25):
+        super(MILNetwork, self).__init__()
+        self.embedding_dim = embedding_dim
+        self.tile_projection = nn.Sequential(
+            nn.Linear(input_dim, hidden_dim),
+            nn.ReLU(),
+            nn.Dropout(dropout)
+        )
+        from generate_wsi_embeddings import GatedAttentionPool
+        self.attention_pool = GatedAttentionPool(hidden_dim, hidden_dim=attention_dim, dropout=dropout)
+        self.net = nn.Sequential(
+            nn.Linear(hidden_dim, embedding_dim),
+            nn.ReLU()
+        )
+        self.last_attention_weights = None
+
+    def forward(self, x_wsi):
+        # x_wsi: utils.TileBatch of tile embeddings [batch_size, max_tiles, input_dim] + mask [batch_size, max_tiles]
+        pooled, weights = self.attention_pool(self.tile_projection(x_wsi.tiles), x_wsi.mask)
+        self.last_attention_weights = weights.detach()
+        return self.net(pooled)
+
+
 class OmicNetwork(nn.Module): # MLP for WSI tile-level embedding generation
     def __init__(self, embedding_dim):
         super(OmicNetwork, self).__init__()
@@ -116,7 +148,7 @@ class OmicNetwork(nn.Module): # MLP for WSI tile-level embedding generation
 
 
 class MultimodalNetwork(nn.Module):
-    def __init__(self, embedding_dim_wsi, embedding_dim_omic, mode, fusion_type):
+    def __init__(self, embedding_dim_wsi, embedding_dim_omic, mode, fusion_type, tile_embedding_dim=1024):
         super(MultimodalNetwork, self).__init__()
 
         self.mode = mode  # wsi_omic, wsi or omic
@@ -130,7 +162,10 @@ class MultimodalNetwork(nn.Module):
         # if self.fusion_type is not None: # not unimodal
 
         if self.mode == 'wsi_omic':
-            self.wsi_net = WSINetwork(embedding_dim_wsi)
+            if self.fusion_type == 'mil':  # MIL head over the tile embedding store instead of the WSI encoder
+                self.wsi_net = MILNetwork(embedding_dim_wsi, input_dim=tile_embedding_dim)
+            else:
+                self.wsi_net = WSINetwork(embedding_dim_wsi)
             self.omic_net = OmicNetwork(embedding_dim_omic)
             # self.wsi_encoder = WSIEncoder()
             # Note: the above networks won't be used for early fusion
@@ -162,72 +197,73 @@ class MultimodalNetwork(nn.Module):
     def forward(self, opt, tcga_id, x_wsi=None, x_omic=None):
         # print("x_wsi: ", x_wsi) # contains float values and not the image files here
         # print("x_omic: ", x_omic)
-        start_time = time.time()
         # print("fusion type: ", self.fusion_type)
-        if self.fusion_type == 'joint':
-            wsi_embedding = self.wsi_net(x_wsi)
-            omic_embedding = self.omic_net(x_omic)
+        if self.fusion_type in ['joint', 'mil']:
+            with region('wsi_encoder'), instr.timer('model/wsi'):
+                wsi_embedding = self.wsi_net(x_wsi)
+            with region('omic_mlp'), instr.timer('model/omic'):
+                omic_embedding = self.omic_net(x_omic)
             # print("wsi_embedding.shape: ", wsi_embedding.shape)
             # print("omic_embedding.shape: ", omic_embedding.shape)
-        step1_time = time.time()
         # set_trace()
         if self.fusion_type == 'joint_omic':
-            wsi_embedding = pd.read_json(os.path.join(opt.input_wsi_embeddings_path, 'WSI_embeddings.json'))  # read pre-generated embeddings from the pathology foundation model
-            wsi_embedding = wsi_embedding[list(tcga_id)] # keep only the embeddings corresponding to the tcga_ids in the batch
-            print("Shape of omic input before OmicNetwork", x_omic.shape)
-            omic_embedding = self.omic_net(x_omic)
-            print("wsi_embedding.shape: ", wsi_embedding.shape)
-            print("omic_embedding.shape: ", omic_embedding.shape)
+            with instr.timer('model/wsi'):
+                wsi_embedding = pd.read_json(os.path.join(opt.input_wsi_embeddings_path, 'WSI_embeddings.json'))  # read pre-generated embeddings from the pathology foundation model
+                wsi_embedding = wsi_embedding[list(tcga_id)] # keep only the embeddings corresponding to the tcga_ids in the batch
+            instr.debug("Shape of omic input before OmicNetwork: %s", x_omic.shape)
+            with region('omic_mlp'), instr.timer('model/omic'):
+                omic_embedding = self.omic_net(x_omic)
+            instr.debug("wsi_embedding.shape: %s", wsi_embedding.shape)
+            instr.debug("omic_embedding.shape: %s", omic_embedding.shape)
 
         elif self.fusion_type == 'early':
             # wsi_embedding = self.wsi_encoder.get_wsi_embeddings(x_wsi)  # get from pretrained foundation models; x_wsi contain data from all tiles
             # omic_embedding = get_omic_embeddings(x_omic)  # get from a simple VAE based encoder
             # for early fusion, we can get the embeddings from lookup tables
+            from lookup_embeddings import early_fusion_get_omic_embeddings, early_fusion_get_wsi_embeddings
             wsi_embedding = early_fusion_get_wsi_embeddings
             omic_embedding = early_fusion_get_omic_embeddings
 
-            print("wsi_embedding.shape: ", wsi_embedding.shape)
-            print("omic_embedding.shape: ", omic_embedding.shape)
+            instr.debug("wsi_embedding.shape: %s", wsi_embedding.shape)
+            instr.debug("omic_embedding.shape: %s", omic_embedding.shape)
 
         elif self.fusion_type is None:  # unimodal case
-            print("This is a unimodal case")
+            instr.debug("This is a unimodal case")
             if self.mode == 'wsi':
-                wsi_embedding = self.wsi_encoder.get_wsi_embeddings(x_wsi) # x_wsi contain data from all tiles
-                print("wsi_embedding.shape (should be [batch_size, embedding_dim]): ", wsi_embedding.shape)
+                with region('wsi_encoder'), instr.timer('model/wsi'):
+                    wsi_embedding = self.wsi_encoder.get_wsi_embeddings(x_wsi) # x_wsi contain data from all tiles
+                instr.debug("wsi_embedding.shape (should be [batch_size, embedding_dim]): %s", wsi_embedding.shape)
             elif self.mode == 'omic':
                 if self.stored_omic_embedding is None and x_omic is not None: # to avoid calling this function for every forward pass
+                    from generate_rnaseq_embeddings import get_omic_embeddings
                     self.stored_omic_embedding = get_omic_embeddings(x_omic)
                     self.stored_omic_embedding = torch.tensor(self.stored_omic_embedding, dtype=torch.float32).to(x_wsi[0].device)
-                    print("omic_embedding.shape (should be [batch_size, embedding_dim]): ", self.stored_omic_embedding.shape)
+                    instr.debug("omic_embedding.shape (should be [batch_size, embedding_dim]): %s", self.stored_omic_embedding.shape)
                 omic_embedding = self.stored_omic_embedding # reuse the stored embeddings for early fusion
 
-        print("input mode: ", self.mode)
+        instr.debug("input mode: %s", self.mode)
 
-        # concatenate embeddings
-        if self.mode == 'wsi':
-            combined_embedding = wsi_embedding
-        elif self.mode == 'omic':
-            combined_embedding = omic_embedding
-        elif self.mode == 'wsi_omic' and (self.fusion_type == 'joint_omic' or self.fusion_type == 'joint'):
-            # set_trace()
-            # wsi_embedding_tensor = torch.tensor(wsi_embedding)
-            # omic_embedding_tensor = torch.tensor(omic_embedding)
-            # Do not re-create tensors from embeddings if they are already tensors
-            if not isinstance(wsi_embedding, torch.Tensor):
-                wsi_embedding = torch.tensor(wsi_embedding).to(device)
-            if not isinstance(omic_embedding, torch.Tensor):
-                omic_embedding = torch.tensor(omic_embedding).to(device)
-            # combined_embedding = torch.cat((wsi_embedding_tensor, omic_embedding_tensor), dim=1)
-            combined_embedding = torch.cat((wsi_embedding, omic_embedding), dim=1)
-        step2_time = time.time()
-        # combined_embedding = torch.tensor(combined_embedding).to(device) # removed to avoid graph disconnect during backprop
-        print("combined_embedding.shape: ", combined_embedding.shape)
-        # use combined embedding with downstream MLP for getting the output that enters the loss function
-        step3_time = time.time()
-        output = self.fused_mlp(combined_embedding)
-        # step2_time = time.time()
-        print(
-            f"(In MultimodalNetwork) Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
+        with region('fusion'), instr.timer('model/fusion'):
+            # concatenate embeddings
+            if self.mode == 'wsi':
+                combined_embedding = wsi_embedding
+            elif self.mode == 'omic':
+                combined_embedding = omic_embedding
+            elif self.mode == 'wsi_omic' and self.fusion_type in ['joint_omic', 'joint', 'mil']:
+                # set_trace()
+                # wsi_embedding_tensor = torch.tensor(wsi_embedding)
+                # omic_embedding_tensor = torch.tensor(omic_embedding)
+                # Do not re-create tensors from embeddings if they are already tensors
+                if not isinstance(wsi_embedding, torch.Tensor):
+                    wsi_embedding = torch.tensor(wsi_embedding).to(device)
+                if not isinstance(omic_embedding, torch.Tensor):
+                    omic_embedding = torch.tensor(omic_embedding).to(device)
+                # combined_embedding = torch.cat((wsi_embedding_tensor, omic_embedding_tensor), dim=1)
+                combined_embedding = torch.cat((wsi_embedding, omic_embedding), dim=1)
+            # combined_embedding = torch.tensor(combined_embedding).to(device) # removed to avoid graph disconnect during backprop
+            instr.debug("combined_embedding.shape: %s", combined_embedding.shape)
+            # use combined embedding with downstream MLP for getting the output that enters the loss function
+            output = self.fused_mlp(combined_embedding)
 
         return output
 
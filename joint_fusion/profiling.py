@@ -0,0 +1,148 @@
+# torch.profiler integration for train_nn
+# usage (see the --profile* options in trainer.py):
+#   profiler = TrainingProfiler.from_opt(opt)
+#   profiler.start(fold)
+#   for batch in profiler.iterate(train_loader):   # tags the dataloader fetch as 'data_loading'
+#       with region('cox_loss'):
+#           ...
+#       profiler.step()                            # advances the wait/warmup/active schedule
+#   profiler.stop()
+# one trace per fold and per active cycle is written to <profile_dir>/fold_<k>/fold_<k>_cycle_<c>.pt.trace.json
+# the traces are chrome traces (chrome://tracing, perfetto) and are picked up by 'tensorboard --logdir <profile_dir>'
+# region() returns a shared no-op context manager when no profiler is running, so the tagged code paths are unchanged otherwise
+
+import os
+from contextlib import nullcontext
+
+import torch
+from torch.profiler import profile, record_function, ProfilerActivity, schedule
+
+_NULL_REGION = nullcontext()
+_active = False  # True while a TrainingProfiler is recording (regions are only tagged then)
+
+
+def region(name):
+    """record_function(name) while profiling, otherwise a no-op context manager"""
+    if not _active:
+        return _NULL_REGION
+    return record_function(name)
+
+
+class TrainingProfiler:
+    """
+    Scheduled torch.profiler wrapper for the per-fold training loop.
+
+    :param enabled: if False, all calls are no-ops
+    :param output_dir: root directory for the per-fold traces
+    :param wait: number of steps to skip at the start of each cycle
+    :param warmup: number of steps to trace but discard (profiler start-up overhead)
+    :param active: number of steps to record per cycle
+    :param repeat: number of cycles to record per fold (0 = until the fold ends)
+    :param row_limit: number of operators in the printed top-k tables
+    :param record_shapes: record the input shapes of the operators
+    :param profile_memory: track tensor allocations (needed for the memory table)
+    :param with_stack: record the python stacks (large traces, but attributes ops to source lines)
+    """
+
+    def __init__(self, enabled=False, output_dir='./profiler_logs', wait=1, warmup=1, active=3, repeat=1,
+                 row_limit=15, record_shapes=True, profile_memory=True, with_stack=False):
+        self.enabled = bool(enabled)
+        self.output_dir = output_dir
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.repeat = repeat
+        self.row_limit = row_limit
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.prof = None
+        self.fold = None
+        self.cycle = 0
+
+    @classmethod
+    def from_opt(cls, opt):
+        """build from the argparse options in trainer.py (missing options disable profiling)"""
+        enabled = getattr(opt, 'profile', False)
+        if isinstance(enabled, str):
+            enabled = enabled.lower() in ('true', '1', 'yes')
+        return cls(enabled=enabled,
+                   output_dir=getattr(opt, 'profile_dir', './profiler_logs'),
+                   wait=getattr(opt, 'profile_wait', 1),
+                   warmup=getattr(opt, 'profile_warmup', 1),
+                   active=getattr(opt, 'profile_active', 3),
+                   repeat=getattr(opt, 'profile_repeat', 1),
+                   row_limit=getattr(opt, 'profile_row_limit', 15),
+                   record_shapes=getattr(opt, 'profile_record_shapes', True),
+                   profile_memory=getattr(opt, 'profile_memory', True),
+                   with_stack=getattr(opt, 'profile_with_stack', False))
+
+    def start(self, fold):
+        global _active
+        if not self.enabled:
+            return self
+        self.fold = fold
+        self.cycle = 0
+        fold_dir = os.path.join(self.output_dir, f"fold_{fold}")
+        os.makedirs(fold_dir, exist_ok=True)
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.prof = profile(activities=activities,
+                            schedule=schedule(wait=self.wait, warmup=self.warmup, active=self.active,
+                                              repeat=self.repeat),
+                            on_trace_ready=self._on_trace_ready,
+                            record_shapes=self.record_shapes,
+                            profile_memory=self.profile_memory,
+                            with_stack=self.with_stack)
+        self.prof.start()
+        _active = True
+        print(f"profiling fold {fold} (wait={self.wait}, warmup={self.warmup}, active={self.active}, "
+              f"repeat={self.repeat}), traces in {fold_dir}")
+        return self
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+
+    def stop(self):
+        global _active
+        if self.prof is None:
+            return
+        self.prof.stop()
+        self.prof = None
+        _active = False
+
+    def iterate(self, loader, name='data_loading'):
+        """iterate over a dataloader, tagging each batch fetch (including worker wait time) as a profiler region"""
+        iterator = iter(loader)
+        while True:
+            with region(name):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def _on_trace_ready(self, prof):
+        # the .pt.trace.json suffix is what the TensorBoard profiler plugin looks for (kineto can only save a trace once)
+        trace_path = os.path.join(self.output_dir, f"fold_{self.fold}",
+                                  f"fold_{self.fold}_cycle_{self.cycle}.pt.trace.json")
+        prof.export_chrome_trace(trace_path)
+        print(f"saved trace for fold {self.fold}, cycle {self.cycle} to {trace_path}")
+        self.print_tables(prof)
+        self.cycle += 1
+
+    def print_tables(self, prof):
+        averages = prof.key_averages()
+        print(f"---- top {self.row_limit} operators by self CPU time (fold {self.fold}, cycle {self.cycle}) ----")
+        print(averages.table(sort_by="self_cpu_time_total", row_limit=self.row_limit))
+        if torch.cuda.is_available():
+            print(f"---- top {self.row_limit} operators by self CUDA time (fold {self.fold}, cycle {self.cycle}) ----")
+            print(averages.table(sort_by="self_cuda_time_total", row_limit=self.row_limit))
+        if self.profile_memory:
+            print(f"---- top {self.row_limit} operators by self CPU memory (fold {self.fold}, cycle {self.cycle}) ----")
+            print(averages.table(sort_by="self_cpu_memory_usage", row_limit=self.row_limit))
+            if torch.cuda.is_available():
+                print(f"---- top {self.row_limit} operators by self CUDA memory (fold {self.fold}, cycle {self.cycle}) ----")
+                print(averages.table(sort_by="self_cuda_memory_usage", row_limit=self.row_limit))
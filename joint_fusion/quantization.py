@@ -0,0 +1,132 @@
+# INT8 quantized CPU inference for the frozen WSI backbones (early fusion embedding generation on CPU-only nodes)
+#   dynamic: the weights of all the Linear layers (qkv/proj of the attention, fc1/fc2 of the MLPs; ~all the FLOPs of a
+#            ViT) are quantized to int8 ahead of time, the activations are quantized on the fly per batch
+#   static:  the activation ranges at the input of every Linear layer are calibrated on a sample of tiles, so that no
+#            per-batch range computation is needed; the patch embedding, LayerNorm, softmax and GELU stay in fp32
+# validate the embeddings against fp32 with compare_wsi_embeddings.py (per tile cosine similarity and GBST C-index drift)
+# python quantization.py --wsi_fm uni --n_tiles 128     # tiles/s and per tile cosine similarity on random tiles
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (quantize_dynamic, get_default_qconfig, prepare, convert, QuantStub, DeQuantStub)
+
+QUANTIZATION_MODES = [None, 'dynamic', 'static']  # (None: fp32)
+
+
+class QuantizedLinearWrapper(nn.Module):
+    # quantize the input of a Linear layer with a calibrated (static) scale, dequantize its output
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = QuantStub()
+        self.linear = linear
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _wrap_linears(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, QuantizedLinearWrapper(child))
+        else:
+            _wrap_linears(child)
+
+
+def quantize_dynamic_int8(model):
+    """
+    :param model: fp32 backbone (not modified)
+    :return: copy of the model with dynamically quantized int8 Linear layers (CPU only)
+    """
+    return quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def prepare_static_int8(model, backend='x86'):
+    """
+    :return: copy of the model with observers at the inputs/outputs of the Linear layers; run the calibration tiles
+             through it, then call convert_static_int8
+    sets the process-wide torch.backends.quantized.engine to backend and leaves it set: the int8 weights are packed for
+    that engine by convert_static_int8, and the converted model only runs while it is the active engine
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+    _wrap_linears(model)
+    for module in model.modules():
+        if isinstance(module, QuantizedLinearWrapper):
+            module.qconfig = get_default_qconfig(backend)
+    return prepare(model)
+
+
+def convert_static_int8(prepared_model):
+    return convert(prepared_model)
+
+
+def quantize_static_int8(model, calibration_tiles, batch_size=32, backend='x86'):
+    """
+    :param calibration_tiles: [n_tiles, C, H, W] sample of (preprocessed) tiles for the activation ranges
+    :return: copy of the model with statically quantized int8 Linear layers (CPU only)
+    """
+    prepared = prepare_static_int8(model, backend)
+    with torch.no_grad():
+        for start in range(0, calibration_tiles.shape[0], batch_size):
+            prepared(calibration_tiles[start:start + batch_size])
+    return convert_static_int8(prepared)
+
+
+def tile_cosine_similarity(model_a, model_b, tiles, batch_size=32):
+    with torch.no_grad():
+        a = torch.cat([model_a(tiles[i:i + batch_size]) for i in range(0, tiles.shape[0], batch_size)])
+        b = torch.cat([model_b(tiles[i:i + batch_size]) for i in range(0, tiles.shape[0], batch_size)])
+    return nn.functional.cosine_similarity(a.float(), b.float(), dim=-1)
+
+
+def tiles_per_second(model, tiles, batch_size=32, repeats=3):
+    with torch.no_grad():
+        model(tiles[:batch_size])  # warm up
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for i in range(0, tiles.shape[0], batch_size):
+                model(tiles[i:i + batch_size])
+            times.append(time.perf_counter() - start)
+    return tiles.shape[0] / sorted(times)[len(times) // 2]
+
+
+if __name__ == "__main__":
+    import argparse
+    from generate_wsi_embeddings import build_lunit_dino, build_uni, configure_backbones
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wsi_fm', type=str, default='lunit_DINO', choices=['lunit_DINO', 'uni'])
+    parser.add_argument('--n_tiles', type=int, default=128, help='random tiles for the throughput and the cosine similarity')
+    parser.add_argument('--calibration_tiles', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--weights_dir', type=str, default=None)
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--random_weights', action='store_true', help='skip loading the pretrained weights')
+    opt = parser.parse_args()
+
+    if opt.num_threads is not None:
+        torch.set_num_threads(opt.num_threads)
+    configure_backbones(opt.weights_dir, opt.offline or None)
+    build = build_lunit_dino if opt.wsi_fm == 'lunit_DINO' else build_uni
+    model, _, _ = build(pretrained=not opt.random_weights)
+    model.eval()
+    tiles = torch.randn(opt.n_tiles, 3, 224, 224)
+    calibration_tiles = torch.randn(opt.calibration_tiles, 3, 224, 224)
+
+    models = {'fp32': model,
+              'int8 dynamic': quantize_dynamic_int8(model),
+              'int8 static': quantize_static_int8(model, calibration_tiles, opt.batch_size)}
+    print(f"{opt.wsi_fm}, {opt.n_tiles} tiles, batch_size={opt.batch_size}, threads={torch.get_num_threads()}")
+    print(f"{'model':>13s} {'tiles/s':>9s} {'speedup':>8s} {'cos mean':>9s} {'cos min':>8s}")
+    base = None
+    for name, candidate in models.items():
+        throughput = tiles_per_second(candidate, tiles, opt.batch_size, opt.repeats)
+        base = base or throughput
+        cosine = tile_cosine_similarity(model, candidate, tiles, opt.batch_size)
+        print(f"{name:>13s} {throughput:9.1f} {throughput / base:8.2f} {cosine.mean().item():9.5f} "
+              f"{cosine.min().item():8.5f}")
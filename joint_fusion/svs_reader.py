@@ -0,0 +1,321 @@
+# streaming tile reader for the whole slide images (.svs): the tiles are decoded from the slides with OpenSlide at the
+# coordinates of a tile manifest when they are needed, so that no tile images (png/jpg) have to be extracted and re-read
+#   SlideHandlePool: open OpenSlide handles of a process (DataLoader worker), least recently used ones are closed
+#   RegionCache:     LRU cache (bounded in bytes) of the decoded tiles
+#   SlideTileReader: reads the tiles of one slide in a batch; runs of horizontally adjacent tiles are read with a single
+#                    read_region call
+# tile coordinates are level-0 pixels of the top left corner of the tiles; grid_manifest writes such a manifest (tissue
+# tiles of a regular grid, tissue fraction from a low resolution level, as in TCGA_WSI/remove_background.py)
+# python svs_reader.py --slides_dir <dir with .svs files> --manifest slide_tiles.parquet --tile_um 128
+# python svs_reader.py --synthetic 4 --benchmark    # tiles/s on synthetic pyramidal TIFFs (needs tifffile)
+import os
+import time
+import argparse
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.mrxs')
+
+
+def _open_slide(slide_path):
+    import openslide  # only needed when the tiles are read from the slides
+    return openslide.OpenSlide(slide_path)
+
+
+class SlideHandlePool:
+    """
+    open slide handles of the current process; at most max_open are kept open (least recently used closed first)
+    the handles are not shared with forked/spawned DataLoader workers, every worker opens its own
+    """
+
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.pid = os.getpid()
+
+    def get(self, slide_path):
+        if os.getpid() != self.pid:  # in a forked worker: the handles of the parent are not safe to use
+            self.handles = OrderedDict()
+            self.pid = os.getpid()
+        if slide_path in self.handles:
+            self.handles.move_to_end(slide_path)
+            return self.handles[slide_path]
+        while len(self.handles) >= self.max_open:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+        handle = _open_slide(slide_path)
+        self.handles[slide_path] = handle
+        return handle
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = OrderedDict()
+
+    def __getstate__(self):
+        # (spawned workers) the handles are reopened on demand
+        state = self.__dict__.copy()
+        state['handles'] = OrderedDict()
+        return state
+
+
+class RegionCache:
+    """
+    LRU cache of decoded tiles (uint8 arrays), at most max_bytes in total
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        region = self.entries.get(key)
+        if region is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return region
+
+    def put(self, key, region):
+        if region.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key).nbytes
+        self.entries[key] = region
+        self.n_bytes += region.nbytes
+        while self.n_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+
+class SlideTileReader:
+    """
+    :param tile_px: size (pixels) of the returned tiles
+    :param tile_um: size of the tiles in microns (e.g. 128 for 256 px tiles at 20X, as in slideflow_preprocessing.py); the
+                    tiles are read from the pyramid level closest to (and not coarser than) tile_um / tile_px microns per
+                    pixel and resized to tile_px. None: tile_px x tile_px pixels of level 0
+    :param max_open: max number of open slide handles (per process)
+    :param cache_mb: size of the cache of decoded tiles (per process, 0 disables it)
+    :param max_run: max number of horizontally adjacent tiles read with a single read_region call (1 disables it)
+    :param default_mpp: microns per pixel of slides without an openslide.mpp-x property
+    """
+
+    def __init__(self, tile_px=256, tile_um=None, max_open=16, cache_mb=512, max_run=8, default_mpp=0.25):
+        self.tile_px = tile_px
+        self.tile_um = tile_um
+        self.max_run = max_run
+        self.default_mpp = default_mpp
+        self.pool = SlideHandlePool(max_open)
+        self.cache = RegionCache(int(cache_mb * 2 ** 20)) if cache_mb > 0 else None
+        self.geometries = {}
+        self.n_read_calls = 0
+        self.n_tiles_read = 0
+
+    def geometry(self, slide_path):
+        """
+        :return: pyramid level, its downsample, tile size in level-0 pixels and tile size in pixels of the level
+        """
+        if slide_path not in self.geometries:
+            slide = self.pool.get(slide_path)
+            if self.tile_um is None:
+                extent = self.tile_px
+            else:
+                mpp = float(slide.properties.get('openslide.mpp-x') or self.default_mpp)
+                extent = int(round(self.tile_um / mpp))
+            level = slide.get_best_level_for_downsample(extent / self.tile_px)
+            downsample = slide.level_downsamples[level]
+            self.geometries[slide_path] = (level, downsample, extent, int(round(extent / downsample)))
+        return self.geometries[slide_path]
+
+    def read_tiles(self, slide_path, coords):
+        """
+        :param coords: [n_tiles, 2] level-0 (x, y) of the top left corner of the tiles
+        :return: list of uint8 arrays [tile_px, tile_px, 3] (in the order of coords)
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        tiles = [None] * len(coords)
+        missing = []
+        for i, (x, y) in enumerate(coords):
+            tiles[i] = self.cache.get((slide_path, x, y)) if self.cache is not None else None
+            if tiles[i] is None:
+                missing.append(i)
+        if not missing:
+            return tiles
+
+        level, downsample, extent, read_size = self.geometry(slide_path)
+        slide = self.pool.get(slide_path)
+        # adjacent tiles can only be cut from one region if the tile boundaries fall on pixels of the level
+        max_run = self.max_run if float(extent / downsample).is_integer() else 1
+        missing.sort(key=lambda i: (coords[i, 1], coords[i, 0]))
+        start = 0
+        while start < len(missing):
+            run = [missing[start]]
+            while (len(run) < max_run and start + len(run) < len(missing)
+                   and coords[missing[start + len(run)], 1] == coords[run[0], 1]
+                   and coords[missing[start + len(run)], 0] == coords[run[-1], 0] + extent):
+                run.append(missing[start + len(run)])
+            x, y = coords[run[0]]
+            region = slide.read_region((int(x), int(y)), level, (read_size * len(run), read_size))
+            region = np.asarray(region.convert('RGB'))
+            self.n_read_calls += 1
+            for j, i in enumerate(run):
+                tile = region[:, j * read_size:(j + 1) * read_size]
+                if read_size != self.tile_px:
+                    tile = np.asarray(Image.fromarray(tile).resize((self.tile_px, self.tile_px), Image.BOX))
+                tile = np.ascontiguousarray(tile)
+                tiles[i] = tile
+                if self.cache is not None:
+                    self.cache.put((slide_path, coords[i, 0], coords[i, 1]), tile)
+            self.n_tiles_read += len(run)
+            start += len(run)
+        return tiles
+
+    def close(self):
+        self.pool.close()
+
+
+def slide_name(slide_path):
+    return os.path.splitext(os.path.basename(slide_path))[0]
+
+
+def list_slides(slides_dir):
+    with os.scandir(slides_dir) as entries:
+        return sorted(entry.path for entry in entries if entry.name.lower().endswith(SLIDE_EXTENSIONS))
+
+
+def grid_manifest(slide_paths, tile_px=256, tile_um=None, tissue_threshold=0.4, dark_threshold=150, default_mpp=0.25):
+    """
+    tiles of a regular (non-overlapping) grid over each slide that contain enough tissue; the tissue fraction of a tile
+    (fraction of the grayscale pixels darker than dark_threshold) is computed on the lowest resolution level
+    :return: DataFrame with patient_id, slide_id, slide_path, x, y (level-0 top left corner) and tissue_fraction
+    """
+    frames = []
+    for slide_path in slide_paths:
+        slide = _open_slide(slide_path)
+        mpp = float(slide.properties.get('openslide.mpp-x') or default_mpp)
+        extent = tile_px if tile_um is None else int(round(tile_um / mpp))
+        width, height = slide.dimensions
+        n_x, n_y = width // extent, height // extent
+        level = slide.level_count - 1
+        downsample = slide.level_downsamples[level]
+        thumbnail = np.asarray(slide.read_region((0, 0), level, slide.level_dimensions[level]).convert('L'))
+        slide.close()
+        # tissue fraction of every grid cell from the thumbnail pixels that fall into the cell
+        ys = np.minimum((np.arange(thumbnail.shape[0]) * downsample // extent).astype(int), n_y)
+        xs = np.minimum((np.arange(thumbnail.shape[1]) * downsample // extent).astype(int), n_x)
+        dark = np.zeros((n_y + 1, n_x + 1))
+        total = np.zeros((n_y + 1, n_x + 1))
+        np.add.at(dark, (ys[:, None], xs[None, :]), thumbnail < dark_threshold)
+        np.add.at(total, (ys[:, None], xs[None, :]), 1)
+        fraction = (dark / np.maximum(total, 1))[:n_y, :n_x]
+        cell_y, cell_x = np.nonzero(fraction > tissue_threshold)
+        name = slide_name(slide_path)
+        frames.append(pd.DataFrame({'patient_id': '-'.join(name.split('-')[:3]), 'slide_id': name,
+                                    'slide_path': slide_path, 'x': (cell_x * extent).astype(np.int64),
+                                    'y': (cell_y * extent).astype(np.int64),
+                                    'tissue_fraction': fraction[cell_y, cell_x].astype(np.float32)}))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['patient_id', 'slide_id', 'slide_path', 'x', 'y', 'tissue_fraction'])
+
+
+def load_slide_manifest(manifest_path, slides_dir=None):
+    """
+    :param manifest_path: parquet with patient_id, x, y and slide_path (grid_manifest) or slide_id (e.g. the manifest
+                          of preprocessing/build_tile_manifest.py, with the slide name in the tile names)
+    :param slides_dir: directory of the slides, for manifests without slide_path
+    """
+    manifest = pd.read_parquet(manifest_path)
+    if 'slide_path' not in manifest.columns:
+        if slides_dir is None:
+            raise ValueError(f"{manifest_path} has no slide_path column; the directory of the slides is needed")
+        paths = {slide_name(path): path for path in list_slides(slides_dir)}
+        manifest['slide_path'] = manifest['slide_id'].astype(str).map(paths)
+        n_missing = int(manifest['slide_path'].isna().sum())
+        if n_missing:
+            print(f"Warning: no slide in {slides_dir} for {n_missing} tiles (skipped)")
+            manifest = manifest[manifest['slide_path'].notna()]
+    return manifest[(manifest['x'] >= 0) & (manifest['y'] >= 0)].reset_index(drop=True)
+
+
+def write_synthetic_slide(path, width=4096, height=3072, n_levels=3, mpp=0.25, seed=0):
+    """
+    pyramidal (tiled, deflate compressed) TIFF with random 'tissue' blobs on a white background, readable by OpenSlide
+    (generic TIFF); each level is downsampled by 2
+    """
+    import tifffile
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    tissue = np.zeros((height, width), dtype=bool)
+    for _ in range(12):
+        cy, cx, r = rng.integers(0, height), rng.integers(0, width), rng.integers(height // 12, height // 4)
+        tissue |= (yy - cy) ** 2 + (xx - cx) ** 2 < r ** 2
+    image = np.full((height, width, 3), 240, dtype=np.uint8)
+    image[tissue] = (180, 90, 150)
+    image = np.clip(image + rng.normal(0, 12, image.shape), 0, 255).astype(np.uint8)
+    resolution = (1e4 / mpp, 1e4 / mpp)  # pixels per cm
+    with tifffile.TiffWriter(path, bigtiff=False) as tif:
+        for level in range(n_levels):
+            tif.write(image, tile=(256, 256), photometric='rgb', compression='zlib', subfiletype=1 if level else 0,
+                      resolution=(resolution[0] / 2 ** level, resolution[1] / 2 ** level), resolutionunit='CENTIMETER')
+            image = image[:image.shape[0] // 2 * 2, :image.shape[1] // 2 * 2]
+            image = image.reshape(image.shape[0] // 2, 2, image.shape[1] // 2, 2, 3).mean(axis=(1, 3)).astype(np.uint8)
+
+
+def benchmark(reader_kwargs, manifest, tiles_per_slide=64, epochs=2, seed=0):
+    # tiles/s reading random bags of tiles_per_slide tiles of every slide, over a few epochs
+    rng = np.random.default_rng(seed)
+    reader = SlideTileReader(**reader_kwargs)
+    groups = [(path, group[['x', 'y']].to_numpy()) for path, group in manifest.groupby('slide_path')]
+    start = time.perf_counter()
+    n_tiles = 0
+    for _ in range(epochs):
+        for path, coords in groups:
+            idx = rng.choice(len(coords), size=min(tiles_per_slide, len(coords)), replace=False)
+            n_tiles += len(reader.read_tiles(path, coords[np.sort(idx)]))
+    elapsed = time.perf_counter() - start
+    hits = reader.cache.hits if reader.cache is not None else 0
+    reader.close()
+    return n_tiles / elapsed, reader.n_read_calls, hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slides_dir', type=str, default=None)
+    parser.add_argument('--manifest', type=str, default='slide_tiles.parquet', help='output tile manifest (parquet)')
+    parser.add_argument('--tile_px', type=int, default=256)
+    parser.add_argument('--tile_um', type=float, default=None, help='tile size in microns (default: tile_px at level 0)')
+    parser.add_argument('--tissue_threshold', type=float, default=0.4)
+    parser.add_argument('--dark_threshold', type=int, default=150)
+    parser.add_argument('--synthetic', type=int, default=0, help='use this many synthetic slides')
+    parser.add_argument('--benchmark', action='store_true', help='report tiles/s of the reader instead of writing the manifest')
+    parser.add_argument('--tiles_per_slide', type=int, default=64)
+    parser.add_argument('--epochs', type=int, default=2)
+    opt = parser.parse_args()
+
+    if opt.synthetic > 0:
+        opt.slides_dir = tempfile.mkdtemp()
+        for i in range(opt.synthetic):
+            write_synthetic_slide(os.path.join(opt.slides_dir, f"TCGA-SYN-{i:04d}-01Z-00-DX1.tiff"), seed=i)
+    start = time.perf_counter()
+    manifest = grid_manifest(list_slides(opt.slides_dir), opt.tile_px, opt.tile_um, opt.tissue_threshold,
+                             opt.dark_threshold)
+    print(f"{len(manifest)} tissue tiles of {manifest['slide_id'].nunique()} slides in {time.perf_counter() - start:.1f} s")
+
+    if opt.benchmark:
+        print(f"{'reader':>22s} {'tiles/s':>9s} {'read calls':>11s} {'cache hits':>11s}")
+        for name, kwargs in [('single tile reads', dict(max_run=1, cache_mb=0)),
+                             ('batched runs', dict(max_run=8, cache_mb=0)),
+                             ('batched runs + cache', dict(max_run=8, cache_mb=512))]:
+            kwargs.update(tile_px=opt.tile_px, tile_um=opt.tile_um)
+            rate, n_calls, hits = benchmark(kwargs, manifest, opt.tiles_per_slide, opt.epochs)
+            print(f"{name:>22s} {rate:9.1f} {n_calls:11d} {hits:11d}")
+    else:
+        manifest.to_parquet(opt.manifest, index=False)
+        print(f"manifest written to {opt.manifest}")
@@ -0,0 +1,96 @@
+# on-disk store of precomputed tile level embeddings (one variable length bag of tile embeddings per patient)
+# layout of the store directory:
+#   embeddings.npy     [total_tiles, embed_dim] (float16 by default), the tiles of all patients concatenated
+#   offsets.npy        [n_patients + 1] int64, the tiles of patient i are embeddings[offsets[i]:offsets[i + 1]]
+#   patient_ids.json   list of the TCGA ids (same order as the offsets)
+# written by generate_wsi_embeddings.py --tile_embeddings_dir, or converted from a no_pooling embeddings json:
+#   python tile_embedding_store.py --from_json WSI_embeddings_uni_31Jan_1000tiles.json --output_dir tile_embeddings_uni
+import os
+import json
+import argparse
+import numpy as np
+import torch
+
+
+def write_tile_embeddings(output_dir, patient_ids, embeddings, dtype=np.float16):
+    """
+    :param patient_ids: list of ids
+    :param embeddings: list of [n_tiles, embed_dim] arrays (same order as patient_ids)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    counts = [len(emb) for emb in embeddings]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    embed_dim = np.asarray(embeddings[0]).shape[-1]
+    out = np.lib.format.open_memmap(os.path.join(output_dir, 'embeddings.npy'), mode='w+', dtype=dtype,
+                                    shape=(int(offsets[-1]), embed_dim))
+    for i, emb in enumerate(embeddings):
+        out[offsets[i]:offsets[i + 1]] = np.asarray(emb, dtype=dtype).reshape(-1, embed_dim)
+    out.flush()
+    np.save(os.path.join(output_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(output_dir, 'patient_ids.json'), 'w') as file:
+        json.dump(list(patient_ids), file)
+    print(f"wrote {offsets[-1]} tile embeddings (dim {embed_dim}) of {len(patient_ids)} patients to {output_dir}")
+
+
+class TileEmbeddingStore:
+    """
+    Tile embeddings of all patients held in memory as one flat tensor, with vectorized sampling of tile bags.
+
+    :param store_dir: directory written by write_tile_embeddings
+    :param dtype: dtype of the in-memory tensor
+    """
+
+    def __init__(self, store_dir, dtype=torch.float32):
+        embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r')
+        self.embeddings = torch.from_numpy(np.ascontiguousarray(embeddings)).to(dtype)
+        self.offsets = torch.from_numpy(np.load(os.path.join(store_dir, 'offsets.npy')))
+        with open(os.path.join(store_dir, 'patient_ids.json')) as file:
+            self.patient_ids = json.load(file)
+        self.index = {patient_id: i for i, patient_id in enumerate(self.patient_ids)}
+        self.counts = self.offsets[1:] - self.offsets[:-1]
+        self.embed_dim = self.embeddings.shape[1]
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def bag(self, patient_id):
+        i = self.index[patient_id]
+        return self.embeddings[self.offsets[i]:self.offsets[i + 1]]
+
+    def sample_bags(self, rows, k=None, generator=None):
+        """
+        padded tile bags of the patients in rows (store row indices)
+        :param k: sample (without replacement) at most k tiles per patient; None takes all the tiles
+        :return: embeddings [len(rows), n, embed_dim], mask [len(rows), n]
+        """
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        counts = self.counts[rows]
+        max_count = int(counts.max())
+        positions = torch.arange(max_count).unsqueeze(0)
+        valid = positions < counts.unsqueeze(1)
+        if k is not None and k < max_count:
+            # random permutation of the valid positions of each bag (padding positions sort last), keep the first k
+            keys = torch.rand(rows.shape[0], max_count, generator=generator).masked_fill(~valid, 2.0)
+            positions = keys.argsort(dim=1)[:, :k]
+            valid = torch.arange(k).unsqueeze(0) < counts.unsqueeze(1)
+        else:
+            positions = positions.expand(rows.shape[0], -1)
+        flat_idx = (self.offsets[rows].unsqueeze(1) + positions).masked_fill(~valid, 0)
+        embeddings = self.embeddings[flat_idx] * valid.unsqueeze(-1).to(self.embeddings.dtype)
+        return embeddings, valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--from_json', type=str, required=True,
+                        help='json with the tile embeddings of each patient (generate_wsi_embeddings.py --pooling no_pooling)')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'])
+    opt = parser.parse_args()
+
+    with open(opt.from_json) as file:
+        embeddings_dict = json.load(file)
+    patient_ids = sorted(embeddings_dict)
+    embeddings = [np.asarray(embeddings_dict[patient_id], dtype=np.float32).reshape(
+        -1, np.asarray(embeddings_dict[patient_id]).shape[-1]) for patient_id in patient_ids]
+    write_tile_embeddings(opt.output_dir, patient_ids, embeddings, dtype=np.dtype(opt.dtype))
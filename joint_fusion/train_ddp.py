@@ -0,0 +1,327 @@
+# distributed data-parallel (DDP) training of MultimodalNetwork with an exact Cox partial likelihood
+# nn.DataParallel/plain DDP would compute the Cox loss on each GPU's shard only (truncated risk sets), which is why
+# train_test.py pins a single GPU. Here the patients of each global batch are sharded across the ranks, the embeddings and
+# risk scores are computed locally, and the risk scores, times and events are all-gathered (with gradient support) so that
+# every rank computes the same full-batch Cox loss
+# usage:
+#   torchrun --nproc_per_node=4 train_ddp.py --h5_file mapping_data.h5 --batch_size 32        # nccl on GPUs
+#   torchrun --nproc_per_node=4 train_ddp.py --h5_file mapping_data.h5 --backend gloo         # CPU processes
+#   python train_ddp.py --check_equivalence --world_size 4     # DDP loss/gradients vs single process (gloo, synthetic data)
+#   python train_ddp.py --benchmark --max_world_size 8         # step time for 1-8 ranks (gloo, synthetic data)
+import os
+import time
+import socket
+import argparse
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader
+
+from datasets import HDF5Dataset
+from models import MultimodalNetwork
+from train_test import CoxLoss
+from utils import get_collate_fn, tiles_to_device
+
+
+class _GatherWithGrad(torch.autograd.Function):
+    """
+    all_gather of variable sized (along dim 0) tensors that propagates gradients back to the local shard.
+    Every rank computes the same loss from the gathered tensor, so the incoming gradients are identical on all ranks;
+    they are summed across ranks (x world_size) which cancels the gradient averaging of DDP.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor, sizes):
+        ctx.sizes = sizes
+        ctx.rank = dist.get_rank()
+        padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+        padded[:tensor.shape[0]] = tensor
+        gathered = [torch.empty_like(padded) for _ in sizes]
+        dist.all_gather(gathered, padded)
+        return torch.cat([shard[:size] for shard, size in zip(gathered, sizes)])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad = grad_output.contiguous()
+        dist.all_reduce(grad, op=dist.ReduceOp.SUM)
+        start = sum(ctx.sizes[:ctx.rank])
+        return grad[start:start + ctx.sizes[ctx.rank]], None
+
+
+def gather_sizes(n, device):
+    size = torch.tensor([n], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size)
+    return [int(s.item()) for s in sizes]
+
+
+def gather_risk_sets(risks, times, events, indices):
+    """
+    gather the local risk scores (with grad), times, events of all ranks and restore the global batch order
+    (the order matters for tied event times, so that the loss matches single process training exactly)
+
+    :param indices: dataset indices of the local samples (used to restore the global order)
+    """
+    sizes = gather_sizes(risks.shape[0], risks.device)
+    risks = _GatherWithGrad.apply(risks, sizes)
+    times = _GatherWithGrad.apply(times, sizes)
+    events = _GatherWithGrad.apply(events, sizes)
+    indices = _GatherWithGrad.apply(indices, sizes)
+    order = torch.argsort(indices)
+    return risks[order], times[order], events[order]
+
+
+class GlobalBatchShardSampler:
+    """
+    Batch sampler that draws the same (epoch seeded) global batches on every rank and yields the local shard
+    (global_batch[rank::world_size]) of each of them.
+    """
+
+    def __init__(self, num_samples, batch_size, rank, world_size, seed=0, drop_last=True):
+        if batch_size < world_size:
+            raise ValueError(f"batch_size ({batch_size}) must be >= world_size ({world_size})")
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def global_batches(self):
+        permuted = np.random.default_rng(self.seed + self.epoch).permutation(self.num_samples)
+        for start in range(0, self.num_samples, self.batch_size):
+            batch = permuted[start:start + self.batch_size]
+            if len(batch) < self.batch_size and (self.drop_last or len(batch) < self.world_size):
+                return
+            yield batch
+
+    def __iter__(self):
+        for batch in self.global_batches():
+            yield batch[self.rank::self.world_size].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return int(np.ceil(self.num_samples / self.batch_size))
+
+
+def setup(rank, world_size, backend):
+    if backend == 'nccl':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return device
+
+
+def cox_step(ddp_model, opt, batch, indices, cox_loss, device):
+    """forward the local shard, gather the risk sets and compute the full-batch Cox loss (identical on all ranks)"""
+    tcga_id, days_to_event, event_occurred, x_wsi, x_omic = batch
+    predictions = ddp_model(opt,
+                            tcga_id,
+                            x_wsi=tiles_to_device(x_wsi, device),
+                            x_omic=x_omic.to(device))
+    risks, times, events = gather_risk_sets(predictions.reshape(-1).float(),
+                                            days_to_event.to(device),
+                                            event_occurred.to(device),
+                                            torch.as_tensor(indices, device=device))
+    return cox_loss(risks, times, events)
+
+
+def train(rank, world_size, opt):
+    device = setup(rank, world_size, opt.backend)
+    dataset = HDF5Dataset(opt, opt.h5_file, split='train', mode=opt.input_mode, train_val_test="train")
+    model = MultimodalNetwork(embedding_dim_wsi=opt.embedding_dim_wsi,
+                              embedding_dim_omic=opt.embedding_dim_omic,
+                              mode=opt.input_mode,
+                              fusion_type=opt.fusion_type).to(device)
+    ddp_model = DDP(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                    find_unused_parameters=opt.find_unused_parameters)
+    optimizer = torch.optim.Adam(ddp_model.parameters(), lr=opt.lr)
+    scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.999)
+    cox_loss = CoxLoss()
+    sampler = GlobalBatchShardSampler(len(dataset), opt.batch_size, rank, world_size, seed=opt.seed)
+    if rank == 0:
+        os.makedirs(opt.checkpoint_dir, exist_ok=True)
+        print(f"DDP training on {world_size} ranks ({opt.backend}), {len(dataset)} patients, "
+              f"global batch size {opt.batch_size}, {len(sampler)} steps per epoch")
+
+    for epoch in range(opt.num_epochs):
+        ddp_model.train()
+        sampler.set_epoch(epoch)
+        dataset.set_epoch(epoch)
+        local_batches = list(sampler)
+        loader = DataLoader(dataset, batch_sampler=local_batches, num_workers=opt.num_workers,
+                            collate_fn=get_collate_fn(opt),
+                            pin_memory=device.type == 'cuda')
+        loss_epoch = 0.0
+        start_time = time.time()
+        for indices, batch in zip(local_batches, loader):
+            loss = cox_step(ddp_model, opt, batch, indices, cox_loss, device)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            loss_epoch += loss.item()
+        scheduler.step()
+        if rank == 0:
+            print(f"epoch {epoch}: train loss {loss_epoch / max(len(local_batches), 1):.4f}, "
+                  f"{time.time() - start_time:.1f}s")
+            if (epoch + 1) % opt.save_every == 0 or epoch + 1 == opt.num_epochs:
+                model_path = os.path.join(opt.checkpoint_dir, f"model_ddp_epoch_{epoch}.pt")
+                torch.save(model.state_dict(), model_path)
+                print(f"saved model checkpoint at epoch {epoch} to {model_path}")
+    dist.destroy_process_group()
+
+
+# ---- synthetic omic-only runs for the equivalence check and the scaling benchmark (gloo on CPU) ----
+
+class OmicOnlyModel(nn.Module):
+    # DDP only synchronizes gradients for calls through forward(), so route forward_omic_only through it
+    def __init__(self, embedding_dim_omic):
+        super(OmicOnlyModel, self).__init__()
+        self.net = MultimodalNetwork(embedding_dim_wsi=None, embedding_dim_omic=embedding_dim_omic, mode='omic',
+                                     fusion_type=None)
+
+    def forward(self, x_omic):
+        return self.net.forward_omic_only(x_omic)
+
+
+def synthetic_cohort(n_patients, n_genes, seed):
+    generator = torch.Generator().manual_seed(seed)
+    x_omic = torch.log1p(torch.rand(n_patients, n_genes, generator=generator) * 100)
+    times = torch.randint(1, 2000, (n_patients,), generator=generator).float()  # integer days, so ties do occur
+    events = (torch.rand(n_patients, generator=generator) < 0.4).long()
+    return x_omic, times, events
+
+
+def _synthetic_worker(rank, world_size, opt, port, result_path, mode):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(max(1, opt.threads_per_rank))
+    device = setup(rank, world_size, 'gloo')
+    torch.manual_seed(opt.seed)
+    model = DDP(OmicOnlyModel(opt.embedding_dim_omic))
+    cox_loss = CoxLoss()
+    x_omic, times, events = synthetic_cohort(opt.batch_size, opt.n_genes, opt.seed)
+    indices = np.arange(opt.batch_size)[rank::world_size]
+    local = torch.as_tensor(indices)
+
+    def step():
+        risks, t, e = gather_risk_sets(model(x_omic[local]).reshape(-1), times[local], events[local], local)
+        loss = cox_loss(risks, t, e)
+        model.zero_grad()
+        loss.backward()
+        return loss
+
+    if mode == 'equivalence':
+        loss = step()
+        if rank == 0:
+            grads = torch.cat([p.grad.reshape(-1) for p in model.module.parameters() if p.grad is not None])
+            torch.save({'loss': loss.item(), 'grads': grads}, result_path)
+    else:
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        for _ in range(opt.warmup_steps):
+            step()
+            optimizer.step()
+        dist.barrier()
+        start_time = time.perf_counter()
+        for _ in range(opt.benchmark_steps):
+            step()
+            optimizer.step()
+        dist.barrier()
+        if rank == 0:
+            torch.save({'step_time': (time.perf_counter() - start_time) / opt.benchmark_steps}, result_path)
+    dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_synthetic(world_size, opt, mode):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = os.path.join(tmp_dir, 'result.pt')
+        mp.spawn(_synthetic_worker, args=(world_size, opt, _free_port(), result_path, mode), nprocs=world_size,
+                 join=True)
+        return torch.load(result_path)
+
+
+def check_equivalence(opt):
+    torch.manual_seed(opt.seed)
+    model = OmicOnlyModel(opt.embedding_dim_omic)
+    x_omic, times, events = synthetic_cohort(opt.batch_size, opt.n_genes, opt.seed)
+    loss = CoxLoss()(model(x_omic).reshape(-1), times, events)
+    loss.backward()
+    grads = torch.cat([p.grad.reshape(-1) for p in model.parameters() if p.grad is not None])
+    print(f"single process: loss {loss.item():.6f}")
+    for world_size in sorted({1, 2, opt.world_size}):
+        result = run_synthetic(world_size, opt, 'equivalence')
+        grad_diff = (result['grads'] - grads).abs().max().item()
+        print(f"{world_size} ranks: loss {result['loss']:.6f} (diff {abs(result['loss'] - loss.item()):.2e}), "
+              f"max abs gradient diff {grad_diff:.2e}")
+
+
+def benchmark(opt):
+    print(f"{'ranks':>5s} {'step time (s)':>14s} {'patients/s':>11s} {'speedup':>8s} {'efficiency':>10s}")
+    base_step_time = None
+    for world_size in range(1, opt.max_world_size + 1):
+        step_time = run_synthetic(world_size, opt, 'benchmark')['step_time']
+        base_step_time = base_step_time or step_time
+        speedup = base_step_time / step_time
+        print(f"{world_size:5d} {step_time:14.4f} {opt.batch_size / step_time:11.1f} {speedup:8.2f} "
+              f"{speedup / world_size:10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--h5_file', type=str, default='mapping_data.h5', help='h5 file created by trainer.py')
+    parser.add_argument('--input_wsi_path', type=str, default='', help='Path to input WSI tiles')
+    parser.add_argument('--input_wsi_embeddings_path', type=str, default='', help='Path to WSI embeddings (joint_omic)')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoint_ddp', help='Path to the checkpoints')
+    parser.add_argument('--backend', type=str, default='nccl' if torch.cuda.is_available() else 'gloo',
+                        choices=['nccl', 'gloo'])
+    parser.add_argument('--batch_size', type=int, default=32, help='global batch size (sharded across the ranks)')
+    parser.add_argument('--num_workers', type=int, default=2, help='dataloader workers per rank')
+    parser.add_argument('--lr', type=float, default=1e-4, help='Initial learning rate')
+    parser.add_argument('--num_epochs', type=int, default=500, help='Number of training epochs')
+    parser.add_argument('--save_every', type=int, default=50, help='save a checkpoint every n epochs')
+    parser.add_argument('--seed', type=int, default=6)
+    parser.add_argument('--embedding_dim_wsi', type=int, default=384, help="embedding dimension for WSI")
+    parser.add_argument('--embedding_dim_omic', type=int, default=256, help="embedding dimension for omic")
+    parser.add_argument('--input_mode', type=str, default="wsi_omic", help="wsi, omic, wsi_omic")
+    parser.add_argument('--fusion_type', type=str, default="joint", help="joint, joint_omic")
+    parser.add_argument('--tiles_per_slide', type=int, default=0,
+                        help='sample this many tiles per slide and epoch (tile bags of variable length); 0: all tiles')
+    parser.add_argument('--tile_sampling', type=str, default='random', choices=['random', 'stratified'])
+    parser.add_argument('--tile_cache_mb', type=int, default=512,
+                        help='LRU cache of decoded tiles per process/DataLoader worker for --tiles_per_slide > 0')
+    parser.add_argument('--find_unused_parameters', action='store_true')
+    parser.add_argument('--check_equivalence', action='store_true',
+                        help='compare the DDP loss and gradients with single process training on synthetic data')
+    parser.add_argument('--benchmark', action='store_true', help='step time scaling for 1..max_world_size gloo ranks')
+    parser.add_argument('--world_size', type=int, default=4, help='number of ranks for --check_equivalence')
+    parser.add_argument('--max_world_size', type=int, default=8, help='largest number of ranks for --benchmark')
+    parser.add_argument('--n_genes', type=int, default=19962, help='number of genes of the synthetic cohort')
+    parser.add_argument('--threads_per_rank', type=int, default=1, help='torch threads per rank for the synthetic runs')
+    parser.add_argument('--warmup_steps', type=int, default=3)
+    parser.add_argument('--benchmark_steps', type=int, default=20)
+    opt = parser.parse_args()
+
+    if opt.check_equivalence:
+        check_equivalence(opt)
+    elif opt.benchmark:
+        benchmark(opt)
+    else:
+        # launched by torchrun (RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT are set in the environment)
+        train(int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1)), opt)
@@ -0,0 +1,172 @@
+# trains the gated attention MIL head (MultimodalNetwork with fusion_type='mil') jointly with the omic MLP and the Cox head
+# on precomputed tile embeddings; the pixels and the foundation model are never touched, so the whole cohort (tile
+# embeddings, rnaseq, survival data) is held in memory and an epoch runs in seconds on CPU
+# the tile embedding store is written by generate_wsi_embeddings.py --pooling no_pooling --tile_embeddings_dir ...
+# (or converted from an existing no_pooling json with tile_embedding_store.py)
+# usage:
+#   python train_mil.py --h5_file mapping_data.h5 --tile_embeddings_dir tile_embeddings_uni --tiles_per_slide 512
+#   python train_mil.py --synthetic --n_patients 2000 --n_tiles 1000 --num_epochs 3      # throughput on a synthetic cohort
+import os
+import time
+import argparse
+import tempfile
+import h5py
+import numpy as np
+import torch
+from sklearn.model_selection import KFold
+from sksurv.metrics import concordance_index_censored
+
+from models import MultimodalNetwork
+from train_test import CoxLoss
+from tile_embedding_store import TileEmbeddingStore, write_tile_embeddings
+from utils import TileBatch
+
+
+def load_cohort(h5_file, split, store):
+    # survival data and rnaseq of the patients that have tile embeddings (the images group is not read)
+    patient_ids, rows, x_omic, times, events = [], [], [], [], []
+    with h5py.File(h5_file, 'r') as hdf:
+        group = hdf if split == 'all' else hdf[split]
+        for patient_id in group.keys():
+            if patient_id not in store.index:
+                continue
+            patient_data = group[patient_id]
+            patient_ids.append(patient_id)
+            rows.append(store.index[patient_id])
+            x_omic.append(np.log1p(patient_data['rnaseq_data'][()]))  # same log transformation as HDF5Dataset
+            times.append(patient_data['days_to_event'][()])
+            events.append(patient_data['event_occurred'][()])
+    print(f"{len(patient_ids)} patients of split '{split}' have tile embeddings")
+    return (patient_ids, torch.tensor(rows), torch.tensor(np.stack(x_omic), dtype=torch.float32),
+            torch.tensor(times, dtype=torch.float32), torch.tensor(events, dtype=torch.float32))
+
+
+def synthetic_cohort(opt, output_dir):
+    # random tile embeddings (variable number of tiles per patient) and omics, for measuring the training throughput
+    rng = np.random.default_rng(opt.seed)
+    patient_ids = [f"SYNTH-{i:05d}" for i in range(opt.n_patients)]
+    counts = rng.integers(opt.n_tiles // 2, opt.n_tiles + 1, opt.n_patients)
+    write_tile_embeddings(output_dir, patient_ids,
+                          [rng.standard_normal((n, opt.tile_embedding_dim), dtype=np.float32) for n in counts])
+    store = TileEmbeddingStore(output_dir)
+    x_omic = torch.log1p(torch.rand(opt.n_patients, opt.n_genes) * 100)
+    times = torch.randint(1, 2000, (opt.n_patients,)).float()
+    events = (torch.rand(opt.n_patients) < 0.4).float()
+    return store, (patient_ids, torch.arange(opt.n_patients), x_omic, times, events)
+
+
+def predict(model, opt, store, rows, x_omic):
+    # risk scores of all the patients using all their tiles (or at most opt.eval_tiles_per_slide)
+    model.eval()
+    predictions = []
+    with torch.no_grad():
+        for start in range(0, len(rows), opt.val_batch_size):
+            embeddings, mask = store.sample_bags(rows[start:start + opt.val_batch_size], k=opt.eval_tiles_per_slide)
+            predictions.append(model(opt, None, x_wsi=TileBatch(embeddings, mask),
+                                     x_omic=x_omic[start:start + opt.val_batch_size]).reshape(-1))
+    return torch.cat(predictions)
+
+
+def train_mil(opt, store, cohort):
+    patient_ids, rows, x_omic, times, events = cohort
+    torch.manual_seed(opt.seed)
+    generator = torch.Generator().manual_seed(opt.seed)
+    kf = KFold(n_splits=opt.n_folds, shuffle=True, random_state=6)  # same folds as train_test.train_nn
+    os.makedirs(opt.checkpoint_dir, exist_ok=True)
+    cox_loss = CoxLoss()
+    fold_c_indices = []
+
+    for fold, (train_idx, val_idx) in enumerate(kf.split(np.arange(len(patient_ids)))):
+        print(f"Fold {fold + 1}/{kf.get_n_splits()}")
+        train_idx, val_idx = torch.as_tensor(train_idx), torch.as_tensor(val_idx)
+        # standardize the omics with the statistics of the training patients of the fold
+        mean = x_omic[train_idx].mean(dim=0)
+        std = x_omic[train_idx].std(dim=0).clamp(min=1e-6)
+        x_omic_fold = (x_omic - mean) / std
+
+        model = MultimodalNetwork(embedding_dim_wsi=opt.embedding_dim_wsi,
+                                  embedding_dim_omic=opt.embedding_dim_omic,
+                                  mode='wsi_omic',
+                                  fusion_type='mil',
+                                  tile_embedding_dim=store.embed_dim)
+        optimizer = torch.optim.Adam(model.parameters(), lr=opt.lr, weight_decay=opt.weight_decay)
+        c_index = float('nan')  # (no evaluation when num_epochs = 0)
+
+        for epoch in range(opt.num_epochs):
+            model.train()
+            start_time = time.perf_counter()
+            permuted_idx = train_idx[torch.randperm(len(train_idx), generator=generator)]
+            loss_epoch, n_batches = 0.0, 0
+            for start in range(0, len(permuted_idx), opt.batch_size):
+                batch_idx = permuted_idx[start:start + opt.batch_size]
+                if len(batch_idx) < 2:  # the Cox loss needs at least two patients
+                    continue
+                embeddings, mask = store.sample_bags(rows[batch_idx], k=opt.tiles_per_slide or None,
+                                                     generator=generator)
+                predictions = model(opt, None, x_wsi=TileBatch(embeddings, mask), x_omic=x_omic_fold[batch_idx])
+                loss = cox_loss(predictions.reshape(-1), times[batch_idx], events[batch_idx])
+                if loss.grad_fn is None:  # no events in the batch
+                    continue
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                loss_epoch += loss.item()
+                n_batches += 1
+            epoch_time = time.perf_counter() - start_time
+            message = (f"epoch {epoch}: train loss {loss_epoch / max(n_batches, 1):.4f}, "
+                       f"{len(permuted_idx) / epoch_time:.0f} patients/s")
+
+            if (epoch + 1) % opt.eval_every == 0 or epoch + 1 == opt.num_epochs:
+                predictions = predict(model, opt, store, rows[val_idx], x_omic_fold[val_idx])
+                c_index = concordance_index_censored(events[val_idx].numpy().astype(bool), times[val_idx].numpy(),
+                                                     predictions.numpy())[0]
+                message += f", val C-index {c_index:.4f}"
+            print(message)
+
+        fold_c_indices.append(c_index)
+        model_path = os.path.join(opt.checkpoint_dir, f"mil_model_fold_{fold}.pt")
+        torch.save(model.state_dict(), model_path)
+        print(f"saved model of fold {fold} to {model_path}")
+
+    print(f"val C-index over the folds: {np.mean(fold_c_indices):.4f} +/- {np.std(fold_c_indices):.4f}")
+    return fold_c_indices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--h5_file', type=str, default='mapping_data.h5', help='h5 file created by trainer.py')
+    parser.add_argument('--split', type=str, default='train', help='split of the h5 file used for the k-fold CV')
+    parser.add_argument('--tile_embeddings_dir', type=str, default='tile_embeddings_uni',
+                        help='tile embedding store (see tile_embedding_store.py)')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoint_mil', help='Path to the checkpoints')
+    parser.add_argument('--n_folds', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=64, help='patients per Cox loss batch')
+    parser.add_argument('--val_batch_size', type=int, default=64)
+    parser.add_argument('--tiles_per_slide', type=int, default=512,
+                        help='tiles sampled per slide and step (0: all the tiles of the slide)')
+    parser.add_argument('--eval_tiles_per_slide', type=int, default=None,
+                        help='tiles per slide for validation (default: all the tiles)')
+    parser.add_argument('--lr', type=float, default=1e-4, help='Initial learning rate')
+    parser.add_argument('--weight_decay', type=float, default=1e-5)
+    parser.add_argument('--num_epochs', type=int, default=50)
+    parser.add_argument('--eval_every', type=int, default=5, help='compute the validation C-index every n epochs')
+    parser.add_argument('--embedding_dim_wsi', type=int, default=384, help="embedding dimension for WSI")
+    parser.add_argument('--embedding_dim_omic', type=int, default=256, help="embedding dimension for omic")
+    parser.add_argument('--num_threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--seed', type=int, default=6)
+    parser.add_argument('--synthetic', action='store_true', help='train on a random synthetic cohort (throughput)')
+    parser.add_argument('--n_patients', type=int, default=2000, help='patients of the synthetic cohort')
+    parser.add_argument('--n_tiles', type=int, default=1000, help='max tiles per patient of the synthetic cohort')
+    parser.add_argument('--tile_embedding_dim', type=int, default=1024, help='tile embedding dim of the synthetic cohort')
+    parser.add_argument('--n_genes', type=int, default=19962, help='genes of the synthetic cohort')
+    opt = parser.parse_args()
+
+    if opt.num_threads is not None:
+        torch.set_num_threads(opt.num_threads)
+    if opt.synthetic:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store, cohort = synthetic_cohort(opt, tmp_dir)
+            train_mil(opt, store, cohort)
+    else:
+        store = TileEmbeddingStore(opt.tile_embeddings_dir)
+        train_mil(opt, store, load_cohort(opt.h5_file, opt.split, store))
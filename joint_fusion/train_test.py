@@ -19,13 +19,16 @@ from torch.utils.data import RandomSampler, DataLoader, Subset
 from torchsummary import summary
 from torch.cuda.amp import autocast, GradScaler
 from sklearn.model_selection import train_test_split
-from utils import mixed_collate
+from utils import mixed_collate, get_collate_fn, tiles_to_device
 from tqdm import tqdm
 from torch.utils.data import ConcatDataset
 from sklearn.preprocessing import StandardScaler
 
-from datasets import CustomDataset, HDF5Dataset
+from datasets import CustomDataset, HDF5Dataset, SVSTileDataset
 from models import MultimodalNetwork, OmicNetwork, print_model_summary
+from instrumentation import instr
+from profiling import TrainingProfiler, region
+from cox_accumulation import train_epoch_accumulated
 from sklearn.model_selection import KFold
 from generate_wsi_embeddings import CustomDatasetWSI
 
@@ -80,8 +83,7 @@ class CoxLoss(nn.Module):
             # include only the uncensored samples (i.e., for whom the event has happened)
             if sorted_censor[time_index] == 1:
                 at_risk_mask = torch.arange(
-                    len(sorted_times)) <= time_index  # less than, as sorted_times is in descending order
-                at_risk_mask = at_risk_mask.to(device)
+                    len(sorted_times), device=sorted_times.device) <= time_index  # less than, as sorted_times is in descending order
                 at_risk_sum = torch.sum(exp_sorted_log_risks[  # 2nd term on the RHS
                                             at_risk_mask])  # all are at-risk for the first sample (after arranged in descending order)
                 loss = sorted_log_risks[time_index] - torch.log(at_risk_sum + 1e-15)
@@ -98,8 +100,11 @@ class CoxLoss(nn.Module):
 
 
 def create_data_loaders(opt, h5_file):
+    # --tile_source svs: decode the tiles from the slides at the coordinates of --svs_manifest (no tile images needed)
+    dataset_class = SVSTileDataset if getattr(opt, 'tile_source', 'h5') == 'svs' else HDF5Dataset
     train_loader = torch.utils.data.DataLoader(
-        dataset=HDF5Dataset(opt, h5_file, split='train', mode=opt.input_mode, train_val_test="train"),
+        dataset=dataset_class(opt, h5_file, split='train', mode=opt.input_mode, train_val_test="train"),
+        collate_fn=get_collate_fn(opt),
         batch_size=opt.batch_size,
         shuffle=True,
         num_workers=0,  # 8,
@@ -108,7 +113,8 @@ def create_data_loaders(opt, h5_file):
     )
 
     validation_loader = torch.utils.data.DataLoader(
-        dataset=HDF5Dataset(opt, h5_file, split='val', mode=opt.input_mode, train_val_test="val"),
+        dataset=dataset_class(opt, h5_file, split='val', mode=opt.input_mode, train_val_test="val"),
+        collate_fn=get_collate_fn(opt),
         batch_size=opt.val_batch_size,
         shuffle=True,
         num_workers=0,  # 8,
@@ -117,7 +123,8 @@ def create_data_loaders(opt, h5_file):
     )
 
     test_loader = torch.utils.data.DataLoader(
-        dataset=HDF5Dataset(opt, h5_file, split='test', mode=opt.input_mode, train_val_test="test"),
+        dataset=dataset_class(opt, h5_file, split='test', mode=opt.input_mode, train_val_test="test"),
+        collate_fn=get_collate_fn(opt),
         batch_size=opt.test_batch_size,
         shuffle=True,
         num_workers=0,  # 1, #4,
@@ -129,6 +136,9 @@ def create_data_loaders(opt, h5_file):
 
 
 def train_nn(opt, h5_file, device):
+    if opt.fusion_type == 'mil':
+        # the MIL head is trained on the tile embedding store, not on the tiles of the h5 file
+        raise ValueError("fusion_type 'mil' is not supported by train_nn, use train_mil.py")
     wandb.init(project="multimodal_survival_analysis", entity='tnnandi')
     config = wandb.config
     current_time = datetime.now()
@@ -142,6 +152,9 @@ def train_nn(opt, h5_file, device):
 
     total_samples = len(dataset)
     print(f"total training data size: {total_samples} samples")
+    profiler = TrainingProfiler.from_opt(opt)  # no-op unless --profile is set
+    use_mixed_precision = str(opt.use_mixed_precision).lower() in ('true', '1', 'yes')
+    use_gradient_accumulation = str(opt.use_gradient_accumulation).lower() in ('true', '1', 'yes')
 
     # train models for each fold
     for fold, (train_idx, val_idx) in enumerate(kf.split(dataset)):
@@ -154,12 +167,14 @@ def train_nn(opt, h5_file, device):
         # create data loaders for this fold
         train_loader_fold = DataLoader(train_subset,
                                        batch_size=opt.batch_size,
+                                       collate_fn=get_collate_fn(opt),
                                        num_workers=4,
                                        pin_memory=True,
                                        shuffle=True,
                                        drop_last=True)
         val_loader_fold = DataLoader(val_subset,
                                      batch_size=opt.val_batch_size,
+                                     collate_fn=get_collate_fn(opt),
                                      shuffle=False)
 
         # initialize model, optimizer, and scheduler for this fold
@@ -167,6 +182,11 @@ def train_nn(opt, h5_file, device):
                                   embedding_dim_omic=opt.embedding_dim_omic,
                                   mode=opt.input_mode,
                                   fusion_type=opt.fusion_type)
+        # mixed precision: autocast only the WSI backbone; the loss scaler is only needed for fp16 (bf16 has the fp32 exponent range)
+        precision = opt.amp_dtype if use_mixed_precision else 'fp32'
+        if getattr(model.wsi_net, 'use_lunit_dino', False):  # (MILNetwork has no WSI backbone)
+            model.wsi_net.encoder.set_precision(precision, channels_last=getattr(opt, 'channels_last', False))
+        grad_scaler = GradScaler(enabled=(precision == 'fp16' and torch.cuda.is_available()))
 
         if torch.cuda.device_count() > 1:
             print(f"Using {torch.cuda.device_count()} GPUs")
@@ -180,21 +200,23 @@ def train_nn(opt, h5_file, device):
 
         # initialize and fit the scaler incrementally on training data
         print("fitting scaler [train_test.py]")
-        scaler = StandardScaler()
+        omic_scaler = StandardScaler()
         for batch_idx, (tcga_id, _, _, _, x_omic) in enumerate(train_loader_fold):
-            print(f"fitting batch index {batch_idx} of {len(train_loader_fold)} batches")
+            instr.debug("fitting batch index %d of %d batches", batch_idx, len(train_loader_fold))
             x_omic = x_omic.cpu().numpy()
-            scaler.partial_fit(x_omic)
+            omic_scaler.partial_fit(x_omic)
 
         # save the scaler for the current fold
         scaler_path = os.path.join(checkpoint_dir, f'scaler_fold_{fold}.save')
-        joblib.dump(scaler, scaler_path)
+        joblib.dump(omic_scaler, scaler_path)
         print(f"Scaler saved for fold {fold} at {scaler_path}")
 
         # training loop
+        profiler.start(fold)
         for epoch in tqdm(range(0, opt.num_epochs)):
             print(f"**********  Fold {fold} out of {opt.n_folds},  Epoch: {epoch + 1} out of {opt.num_epochs}")
             start_train_time = time.time()
+            dataset.set_epoch(epoch)  # resample the tile bags (with --tiles_per_slide)
             model.train()
             # # added to reduce memory requirement
             # if isinstance(model, torch.nn.DataParallel):
@@ -208,63 +230,59 @@ def train_nn(opt, h5_file, device):
             wandb.log({"LR": current_lr}, step=epoch)
 
             # model training in batches for the train dataloader for the current fold
-            for batch_idx, (tcga_id, days_to_event, event_occurred, x_wsi, x_omic) in enumerate(train_loader_fold):
-                # x_wsi is a list of tensors (one tensor for each tile)
-                print(f"Total training samples in fold: {len(train_loader_fold.dataset)}")
-                print(f"Batch size: {opt.batch_size}")
-                print(f"Batch index: {batch_idx + 1} out of {np.ceil(len(train_loader_fold.dataset) / opt.batch_size)}")
-                x_wsi = [x.to(device) for x in x_wsi]
-                x_omic = x_omic.to(device)
-                days_to_event = days_to_event.to(device)
-                # days_to_last_followup = days_to_last_followup.to(device)
-                event_occurred = event_occurred.to(device)
-                print("Days to event: ", days_to_event)
-                print("event occurred: ", event_occurred)
-
-                optimizer.zero_grad()
-
-                if opt.use_mixed_precision:
-                    with autocast():  # should wrap only the forward pass including the loss calculation
-                        predictions = model(x_wsi=x_wsi,  # list of tensors (one for each tile)
-                                            x_omic=x_omic)
-                        loss = cox_loss(predictions.squeeze(),
-                                        days_to_death,
-                                        event_occurred)
-                        print("\n loss: ", loss.data.item())
-                        loss_epoch += loss.data.item()
-                    scaler.scale(loss).backward()
-                    scaler.step(optimizer)
-                    scaler.update()
-                else:
-                    print(" Not using mixed precision")
+            if use_gradient_accumulation:
+                # exact Cox risk sets over virtual batches (up to the whole fold), computed in micro-batches
+                loss_epoch = train_epoch_accumulated(model, opt, dataset, train_idx, cox_loss, optimizer, grad_scaler,
+                                                     device, profiler=profiler)
+            else:
+                data_start_time = time.perf_counter()
+                for batch_idx, (tcga_id, days_to_event, event_occurred, x_wsi, x_omic) in enumerate(
+                        profiler.iterate(train_loader_fold)):
+                    instr.step()
+                    if instr.sampled:
+                        instr.record('train/data_load', time.perf_counter() - data_start_time)  # time spent waiting on the dataloader
+                    # x_wsi is a list of tensors (one tensor for each tile)
+                    instr.debug("Batch index: %d out of %d (batch size: %d, training samples in fold: %d)",
+                                batch_idx + 1, np.ceil(len(train_loader_fold.dataset) / opt.batch_size),
+                                opt.batch_size, len(train_loader_fold.dataset))
+                    with instr.timer('train/to_device'):
+                        x_wsi = tiles_to_device(x_wsi, device)
+                        x_omic = x_omic.to(device)
+                        days_to_event = days_to_event.to(device)
+                        # days_to_last_followup = days_to_last_followup.to(device)
+                        event_occurred = event_occurred.to(device)
+                    instr.debug("Days to event: %s", days_to_event)
+                    instr.debug("event occurred: %s", event_occurred)
+
+                    optimizer.zero_grad()
+
                     # model for survival outcome (uses Cox PH partial log likelihood as the loss function)
                     # the model output should be considered as beta*X to be used in the Cox loss function
-
-                    start_time = time.time()
-                    predictions = model(opt,
-                                        tcga_id,
-                                        x_wsi=x_wsi,  # list of tensors (one for each tile)
-                                        x_omic=x_omic,
-                                        )
+                    # with --use_mixed_precision, only the WSI backbone runs under autocast (see WSIEncoder.set_precision)
+                    with instr.timer('train/forward'):
+                        predictions = model(opt,
+                                            tcga_id,
+                                            x_wsi=x_wsi,  # list of tensors (one for each tile)
+                                            x_omic=x_omic,
+                                            )
                     # print(f"predictions: {predictions} from train_test.py")
-                    step1_time = time.time()
-                    loss = cox_loss(predictions.squeeze(),
-                                    # predictions are not survival outcomes, rather log-risk scores beta*X
-                                    days_to_event,
-                                    event_occurred)  # Cox partial likelihood loss for survival outcome prediction
-                    print("\n loss (train): ", loss.data.item())
-                    step2_time = time.time()
+                    with region('cox_loss'), instr.timer('train/loss'):
+                        loss = cox_loss(predictions.squeeze().float(),  # the Cox partial likelihood is always computed in fp32
+                                        # predictions are not survival outcomes, rather log-risk scores beta*X
+                                        days_to_event,
+                                        event_occurred)  # Cox partial likelihood loss for survival outcome prediction
                     loss_epoch += loss.data.item()  # * len(tcga_id)  # multiplying loss by batch size for accurate epoch averaging
+                    instr.debug("loss (train): %s", loss.data.item())
                     # backpropagate loss through the entire model arch upto the inputs
-                    loss.backward(
-                        retain_graph=True if epoch == 0 and batch_idx == 0 else False)  # tensors retained to allow backpropagation for torchhviz (for visualizing the graph)
-                    optimizer.step()
+                    # grad_scaler is a pass-through unless fp16 autocast is used
+                    with instr.timer('train/backward'):
+                        grad_scaler.scale(loss).backward(
+                            retain_graph=True if epoch == 0 and batch_idx == 0 else False)  # tensors retained to allow backpropagation for torchhviz (for visualizing the graph)
+                    with region('optimizer_step'), instr.timer('train/optimizer_step'):
+                        grad_scaler.step(optimizer)
+                        grad_scaler.update()
                     torch.cuda.empty_cache()
 
-                    step3_time = time.time()
-                    print(
-                        f"(in train_nn) Step 1: {step1_time - start_time:.4f}s, Step 2: {step2_time - step1_time:.4f}s, Step 3: {step3_time - step2_time:.4f}s")
-
                     # if epoch == 0 and batch_idx == 0:
                     #     # Note: graphviz is fine for small graphs, but for large graphs it becomes cumbersome so instead opting TensorBoard for the latter
                     #     # graph = torchviz.make_dot(loss, params=dict(model.named_parameters()))
@@ -275,6 +293,11 @@ def train_nn(opt, h5_file, device):
                     #     writer.add_graph(model_to_log, [x_wsi[0], x_omic])
                     #     print(f"Computation graph saved to TensorBoard logs at {log_dir}")
 
+                    instr.count('train/batches')
+                    instr.count('train/samples', len(tcga_id))
+                    profiler.step()
+                    data_start_time = time.perf_counter()
+
             train_loss = loss_epoch / len(train_loader_fold.dataset)  # average training loss per sample for the epoch
             wandb.log({"Loss/train": train_loss}, step=epoch)
             scheduler.step()  # step scheduler after each epoch
@@ -282,6 +305,7 @@ def train_nn(opt, h5_file, device):
             end_train_time = time.time()
             train_duration = end_train_time - start_train_time
             wandb.log({"Time/train": train_duration}, step=epoch)
+            instr.end_epoch(epoch, prefix=f"fold_{fold}/train/")
 
             # calculate validation loss and calculate CI using validation data for this fold, and save model every 50 epochs
             if epoch % 50 == 0 and epoch > 0:
@@ -310,25 +334,27 @@ def train_nn(opt, h5_file, device):
                     for batch_idx, (tcga_id, days_to_event, event_occurred, x_wsi, x_omic) in enumerate(
                             val_loader_fold):
                         # x_wsi is a list of tensors (one tensor for each tile)
-                        print(f"Batch size: {len(val_loader_fold.dataset)}")
-                        print(
-                            f"Validation Batch index: {batch_idx + 1} out of {np.ceil(len(val_loader_fold.dataset) / opt.val_batch_size)}")
-                        x_wsi = [x.to(device) for x in x_wsi]
+                        instr.step()
+                        instr.debug("Validation Batch index: %d out of %d (validation samples: %d)", batch_idx + 1,
+                                    np.ceil(len(val_loader_fold.dataset) / opt.val_batch_size),
+                                    len(val_loader_fold.dataset))
+                        x_wsi = tiles_to_device(x_wsi, device)
                         x_omic = x_omic.to(device)
                         days_to_event = days_to_event.to(device)
                         event_occurred = event_occurred.to(device)
-                        print("Days to event: ", days_to_event)
-                        print("event occurred: ", event_occurred)
-                        outputs = model(opt,
-                                        tcga_id,
-                                        x_wsi=x_wsi,  # list of tensors (one for each tile)
-                                        x_omic=x_omic,
-                                        )
+                        instr.debug("Days to event: %s", days_to_event)
+                        instr.debug("event occurred: %s", event_occurred)
+                        with instr.timer('val/forward'):
+                            outputs = model(opt,
+                                            tcga_id,
+                                            x_wsi=x_wsi,  # list of tensors (one for each tile)
+                                            x_omic=x_omic,
+                                            )
                         loss = cox_loss(outputs.squeeze(),
                                         # predictions are not survival outcomes, rather log-risk scores beta*X
                                         days_to_event,
                                         event_occurred)  # Cox partial likelihood loss for survival outcome prediction
-                        print("\n loss (validation): ", loss.data.item())
+                        instr.debug("loss (validation): %s", loss.data.item())
                         val_loss_epoch += loss.data.item() * len(tcga_id)
                         all_predictions.append(outputs.squeeze())
                         all_times.append(days_to_event)
@@ -364,7 +390,9 @@ def train_nn(opt, h5_file, device):
                     end_val_time = time.time()
                     val_duration = end_val_time - start_val_time
                     wandb.log({"Time/validation": val_duration}, step=epoch)
+                    instr.end_epoch(epoch, prefix=f"fold_{fold}/val/")
 
+        profiler.stop()
         return model, optimizer
 
 
@@ -494,7 +522,7 @@ def test_and_interpret(opt, model, test_loader, device, baseline=None):
                 print(f"Skipping TCGA ID: {tcga_id}")
                 continue
 
-            x_wsi = [x.to(device) for x in x_wsi]
+            x_wsi = tiles_to_device(x_wsi, device)
             x_omic = x_omic.to(device)
             days_to_event = days_to_event.to(device)
             event_occurred = event_occurred.to(device)
@@ -775,6 +803,8 @@ if __name__ == "__main__":
     parser.add_argument('--input_wsi_path', type=str,
                         default='/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_single_sample_per_patient_13july/tiles/256px_9.9x/combined/',
                         help='Path to input WSI tiles')
+    parser.add_argument('--tile_manifest', type=str, default=None,
+                        help='parquet tile manifest (preprocessing/build_tile_manifest.py) to resolve the tile paths')
     # parser.add_argument('--input_wsi_embeddings_path', type=str,
     #                     default='/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/early_fusion_inputs/',
     #                     help='Path to WSI embeddings generated from pretrained pathology foundation model')
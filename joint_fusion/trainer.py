@@ -15,17 +15,22 @@ import numpy as np
 # import datasets
 # from models import
 # from train_test import train_nn
+from instrumentation import configure_from_opt
+from generate_wsi_embeddings import configure_backbones
+from utils import resolve_tile_path
+from h5_writer import write_h5_file
+from data_mapping import read_mapping, write_mapping, load_mapping, mapping_exists, split_mapping, peak_rss_mb
 from sklearn.model_selection import train_test_split, KFold
 import argparse
 from concurrent.futures import ThreadPoolExecutor
 import pickle
 import os
 import ast
+import time
 from collections import Counter
 # from data_mapping import create_data_mapping
 # for profiling
 # torch.autograd.profiler.profile(enabled=True)
-from torch.profiler import profile, record_function, ProfilerActivity
 from PIL import Image
 from sklearn.model_selection import train_test_split
 
@@ -41,6 +46,11 @@ parser.add_argument('--create_new_data_mapping', type=str, default=False,
                     help="whether to create new data mapping or use existing one")
 parser.add_argument('--create_new_data_mapping_h5', type=str, default=False,
                     help="whether to create new HDF5 data mapping or use existing one")
+parser.add_argument('--h5_num_workers', type=int, default=None,
+                    help="processes decoding/compressing the tiles for mapping_data.h5 (default: all cores, 0: serial)")
+parser.add_argument('--h5_resume', action='store_true',
+                    help="keep the patients already written to mapping_data.h5 by an interrupted run")
+parser.add_argument('--h5_compression_level', type=int, default=4, help="gzip level of the tiles in mapping_data.h5")
 parser.add_argument('--input_mapping_data_path', type=str,
                     # default='/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/joint_fusion/', # on laptop
                     default='/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/joint_fusion/',
@@ -56,6 +66,9 @@ parser.add_argument('--input_wsi_path', type=str,
                     # default='/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_otsu_B/tiles/256px_9.9x/combined_tiles/', # on Polaris
                     default='/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_single_sample_per_patient_13july/tiles/256px_9.9x/combined/',
                     help='Path to input WSI tiles')
+parser.add_argument('--tile_manifest', type=str, default=None,
+                    help='parquet tile manifest (preprocessing/build_tile_manifest.py); the tiles are read from their '
+                         'per-slide directories instead of the flat --input_wsi_path copy')
 parser.add_argument('--input_wsi_embeddings_path', type=str,
                     # default='/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/early_fusion_inputs/', # on laptop
                     default='/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_otsu_B/tiles/256px_9.9x/combined_tiles/',
@@ -80,13 +93,69 @@ parser.add_argument('--embedding_dim_wsi', type=int, default=384, help="embeddin
 parser.add_argument('--embedding_dim_omic', type=int, default=256, help="embedding dimension for omic (the intermediate layer dim is hardcoded)")
 parser.add_argument('--input_mode', type=str, default="wsi_omic", help="wsi, omic, wsi_omic")
 parser.add_argument('--fusion_type', type=str, default="joint",
-                    help="early, late, joint, joint_omic, unimodal")  # "joint_omic" only trains the omic embedding generator jointly with the downstream combined model
+                    help="early, late, joint, joint_omic, mil, unimodal")  # "mil" trains a gated attention MIL head on cached tile embeddings (train_mil.py only, rejected by train_test.train_nn); "joint_omic" only trains the omic embedding generator jointly with the downstream combined model
 parser.add_argument('--profile', type=str, default=False, help="whether to profile or not")
+parser.add_argument('--profile_dir', type=str, default='./profiler_logs',
+                    help="output directory for the per-fold TensorBoard/chrome traces")
+parser.add_argument('--profile_wait', type=int, default=1, help="profiler schedule: steps to skip per cycle")
+parser.add_argument('--profile_warmup', type=int, default=1, help="profiler schedule: warmup steps (traced, discarded)")
+parser.add_argument('--profile_active', type=int, default=3, help="profiler schedule: steps recorded per cycle")
+parser.add_argument('--profile_repeat', type=int, default=1, help="profiler schedule: cycles per fold (0 = until the fold ends)")
+parser.add_argument('--profile_row_limit', type=int, default=15, help="number of operators in the printed top-k tables")
+parser.add_argument('--profile_with_stack', action='store_true', help="record python stacks in the traces")
 parser.add_argument('--use_mixed_precision', type=str, default=False,
-                    help="whether to use mixed precision calculations (currently unstable)")
-parser.add_argument('--use_gradient_accumulation', type=str, default=False, help="whether to use gradient accumulation")
+                    help="whether to run the WSI backbone under autocast (the Cox loss is always computed in fp32)")
+parser.add_argument('--amp_dtype', type=str, default='bf16', choices=['bf16', 'fp16'],
+                    help="autocast dtype with --use_mixed_precision (fp16 also enables the GradScaler)")
+parser.add_argument('--channels_last', action='store_true', help="use NHWC memory format for the WSI tiles")
+parser.add_argument('--use_gradient_accumulation', type=str, default=False,
+                    help="whether to compute the Cox loss over virtual batches of micro_batch_size * accumulation_steps patients "
+                         "(exact risk sets, forward passes recomputed per micro-batch)")
+parser.add_argument('--micro_batch_size', type=int, default=4,
+                    help="patients per forward pass with --use_gradient_accumulation")
+parser.add_argument('--accumulation_steps', type=int, default=0,
+                    help="micro-batches per optimizer step with --use_gradient_accumulation (0: whole training fold)")
+parser.add_argument('--keep_micro_batches', action='store_true',
+                    help="with --use_gradient_accumulation, keep the micro-batches of pass 1 in host memory for pass 2 instead of "
+                         "reading them again (needs host memory for the tiles of a virtual batch)")
+parser.add_argument('--tiles_per_slide', type=int, default=0,
+                    help="multi-instance mode: sample this many tiles per slide and epoch, so that slides with any number of tiles "
+                         "can be used (0: use all the tiles, which requires the same number of tiles for every slide)")
+parser.add_argument('--tile_sampling', type=str, default='random', choices=['random', 'stratified'],
+                    help="tile sampling policy for --tiles_per_slide (stratified spreads the tiles over the tiling order)")
+parser.add_argument('--tile_sampling_seed', type=int, default=0, help="seed of the per-epoch tile sampling")
+parser.add_argument('--tile_source', type=str, default='h5', choices=['h5', 'svs'],
+                    help="h5: image tiles stored in the h5 file; svs: tiles decoded from the slides at the coordinates of "
+                         "--svs_manifest (svs_reader.py; requires --tiles_per_slide > 0, the h5 file needs no images)")
+parser.add_argument('--svs_manifest', type=str, default=None,
+                    help="parquet with the tile coordinates (svs_reader.py) for --tile_source svs")
+parser.add_argument('--slides_dir', type=str, default=None,
+                    help="directory of the slides, for --svs_manifest files without a slide_path column")
+parser.add_argument('--tile_um', type=float, default=None,
+                    help="tile size in microns for --tile_source svs (default: --input_size_wsi pixels at full resolution)")
+parser.add_argument('--max_open_slides', type=int, default=16, help="open slide handles per DataLoader worker")
+parser.add_argument('--tile_cache_mb', type=int, default=512,
+                    help="LRU cache of decoded h5 tiles per process/DataLoader worker for --tiles_per_slide > 0 (0 disables it)")
+parser.add_argument('--region_cache_mb', type=int, default=512,
+                    help="LRU cache of decoded tiles per DataLoader worker for --tile_source svs (0 disables it)")
+parser.add_argument('--wsi_weights_dir', type=str, default=None,
+                    help="local cache of the WSI backbone weights (default: $WSI_WEIGHTS_DIR or the torch hub/huggingface caches)")
+parser.add_argument('--offline', action='store_true',
+                    help="only load the WSI backbone weights from the local caches (no downloads, no huggingface login)")
+parser.add_argument('--instrument', action='store_true',
+                    help="collect per-step timings (dataloading, forward, loss, backward) and report p50/p95 per epoch")
+parser.add_argument('--instrument_every', type=int, default=1, help="record the timings only on every n-th batch")
+parser.add_argument('--instrument_sync_cuda', action='store_true',
+                    help="synchronize CUDA around timed regions (accurate GPU times, but slows down training)")
+parser.add_argument('--instrument_verbose', action='store_true',
+                    help="print the per-batch debug messages (batch indices, event times, shapes) for the sampled batches")
+parser.add_argument('--instrument_output_dir', type=str, default=None,
+                    help="directory to export the per-epoch summaries to (instrumentation.json/csv)")
+parser.add_argument('--instrument_wandb', action='store_true', help="also log the per-epoch summaries to wandb")
 
 opt = parser.parse_args()
+configure_from_opt(opt)
+configure_backbones(opt.wsi_weights_dir, opt.offline or None)
 
 device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
 print("Using device:", device)
@@ -98,19 +167,24 @@ if opt.create_new_data_mapping:
     # mapping_df = pd.read_csv(opt.input_path + "mapped_data_21March.csv")
 
     # mapping_df = pd.read_json(opt.input_path + "mapped_data_8may.json", orient='index') # file generated by create_image_molecular_mapping.py
-    mapping_df = pd.read_json(opt.input_path + "mapped_data_23july.json", orient='index')
+    # mapping_df = pd.read_json(opt.input_path + "mapped_data_23july.json", orient='index')
+    # the json is converted once into the metadata table + float32 expression matrix of data_mapping.py (cached in the
+    # working directory as mapped_data_23july.*; replaces rnaseq_df.json), instead of one dict of ~20k genes per row
+    start = time.perf_counter()
+    mapping_df, rnaseq, genes = read_mapping(opt.input_path + "mapped_data_23july.json", "mapped_data_23july")
     print("Total number of samples: ", mapping_df.shape[0])
     ids_with_wsi = mapping_df[mapping_df['tiles'].map(len) > 0].index.tolist()
-    rnaseq_df = pd.DataFrame(mapping_df['rnaseq_data'].to_list(), index=mapping_df.index).transpose()
-    print("Are there nans in rnaseq_df: ", rnaseq_df.isna().any().any())
+    print("Are there nans in rnaseq_df: ", bool(np.isnan(rnaseq).any()))
     # df containing entries where both WSI and rnaseq data are available
     mapping_df = mapping_df.loc[ids_with_wsi]
     print("Total number of samples where both rnaseq and wsi data are available: ", mapping_df.shape[0])
     # set_trace()
     # remove rows where the number of tiles is different from the standard (to avoid length mismatch issues during batching)
     # edit it to keep only 200 random slides among all the available ones
-    mask = mapping_df['tiles'].apply(len) == 200
-    mapping_df = mapping_df[mask]
+    # not needed for tile bags (--tiles_per_slide > 0), where slides with any number of tiles are batched with padding/masks
+    if opt.tiles_per_slide == 0:
+        mask = mapping_df['tiles'].apply(len) == 200
+        mapping_df = mapping_df[mask]
 
     # set_trace()
     # # check if there are empty (or unexpected number of) rnaseq entries
@@ -131,13 +205,20 @@ if opt.create_new_data_mapping:
     # remove entries with anomalous time_to_death and 'days_to_last_followup' data
     excluded_ids = ['TCGA-05-4395', 'TCGA-86-8281']  # contains anomalous time to event and censoring data
     mapping_df = mapping_df[~mapping_df.index.isin(excluded_ids)]
-    mapping_df.to_json('mapping_df.json', orient='index')
-    rnaseq_df.to_json('rnaseq_df.json', orient='index')
+    write_mapping(mapping_df, rnaseq, genes, 'mapping')  # mapping.parquet, mapping.rnaseq.npy, mapping.genes.txt
+    mapping_df, rnaseq, genes = load_mapping('mapping')
 else:
-    mapping_df = pd.read_json(opt.input_mapping_data_path + "mapping_df.json", orient='index')
+    start = time.perf_counter()
+    if mapping_exists(opt.input_mapping_data_path + "mapping"):
+        mapping_df, rnaseq, genes = load_mapping(opt.input_mapping_data_path + "mapping")
+    else:  # mapping_df.json of older runs
+        mapping_df, rnaseq, genes = split_mapping(pd.read_json(opt.input_mapping_data_path + "mapping_df.json",
+                                                               orient='index'))
     # remove entries with anomalous time_to_death and 'days_to_last_followup' data
     excluded_ids = ['TCGA-05-4395', 'TCGA-86-8281']  # contains anomalous time to event and censoring data
     mapping_df = mapping_df[~mapping_df.index.isin(excluded_ids)]
+print(f"Data mapping loaded in {time.perf_counter() - start:.1f} s: {mapping_df.shape[0]} samples x {len(genes)} genes "
+      f"(peak RSS {peak_rss_mb():.0f} MB)")
 
 
 # set_trace()
@@ -146,63 +227,20 @@ mapping_df_train, temp_df = train_test_split(mapping_df, test_size=0.3, random_s
 mapping_df_val, mapping_df_test = train_test_split(temp_df, test_size=0.5, random_state=40)
 
 
-def create_h5_file(file_name, train_df, val_df, test_df, image_dir):
-    with h5py.File(file_name, 'w') as hdf:
-        for df, split in zip([train_df, val_df, test_df], ['train', 'val', 'test']):
-            split_group = hdf.create_group(split)
-            total_rows = len(df)
-            count_row = 0
-            for idx, row in df.iterrows():
-                # set_trace()
-                count_row += 1
-                print(f"Processing {split} data: {count_row}/{total_rows} rows")
-                patient_group = split_group.create_group(idx)
-                patient_group.create_dataset('days_to_death', data=row['days_to_death'])
-                patient_group.create_dataset('days_to_last_followup', data=row['days_to_last_followup'])
-                patient_group.create_dataset('days_to_event', data=row['time'])
-                patient_group.create_dataset('event_occurred', data=1 if row['event_occurred'] == 'Dead' else 0)
-
-                # store RNA-seq data
-                # rnaseq_data = np.log1p(np.array(list(row['rnaseq_data'].values())))
-                rnaseq_data = np.array(list(row['rnaseq_data'].values()))
-                patient_group.create_dataset('rnaseq_data', data=rnaseq_data)
-
-                # store image tiles
-                images_group = patient_group.create_group('images')
-                for i, tile in enumerate(row['tiles']):
-                    image_path = os.path.join(image_dir, tile)
-                    image = Image.open(image_path)
-                    img_arr = np.array(image)
-                    images_group.create_dataset(f'image_{i}', data=img_arr, compression='gzip')
+def create_h5_file(file_name, train_df, val_df, test_df, opt, rnaseq):
+    # tiles decoded and compressed on a process pool, written in order by this process (see h5_writer.py)
+    write_h5_file(file_name, [('train', train_df), ('val', val_df), ('test', test_df)], rnaseq,
+                  lambda tile: resolve_tile_path(opt, tile), num_workers=opt.h5_num_workers, resume=opt.h5_resume,
+                  compression_level=opt.h5_compression_level)
 
 
 if opt.create_new_data_mapping_h5:
     # create h5 version of mapping_df for faster IO
-    create_h5_file('mapping_data.h5', mapping_df_train, mapping_df_val, mapping_df_test, opt.input_wsi_path)
+    create_h5_file('mapping_data.h5', mapping_df_train, mapping_df_val, mapping_df_test, opt, rnaseq)
 
 if not opt.only_create_new_data_mapping:
     # train the model
-    if opt.profile:
-        with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-                     record_shapes=True,
-                     profile_memory=True,
-                     use_cuda=True) as prof:
-            with record_function("model_train"):
-                model, optimizer = train_nn(opt, data, device)
-        # torch.autograd.profiler.profile().export_chrome_trace("./profiling_results.json")
-        print(prof.key_averages().table(sort_by="cuda_time_total", row_limit=10))
-        # print(prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=10))
-        prof.export_chrome_trace("trace.json")
-
-    # with torch.profiler.profile(
-    #         schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
-    #         on_trace_ready=torch.profiler.tensorboard_trace_handler('./log/multimodal'),
-    #         record_shapes=True,
-    #         profile_memory=True,
-    #         with_stack=True
-    # ) as prof:
-
-    else:
-        model, optimizer = train_nn(opt, 'mapping_data.h5', device)
+    # with --profile, train_nn wraps the training loop of each fold in a scheduled torch.profiler (see profiling.py)
+    model, optimizer = train_nn(opt, 'mapping_data.h5', device)
     # break
     # set_trace()
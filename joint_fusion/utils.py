@@ -1,8 +1,99 @@
 from torch.utils.data._utils.collate import *
 from torch.utils.data.dataloader import default_collate
+import torch
+import os
 
 def mixed_collate(batch):
     elem = batch[0]
     elem_type = type(elem)
     transposed = zip(*batch)
     return [default_collate(samples) for samples in transposed]
+
+
+class TileBatch:
+    """
+    A batch of variable length tile bags (one bag per slide).
+
+    :param tiles: padded tiles [batch_size, max_tiles, n_channels, h, w]
+    :param mask: [batch_size, max_tiles], True for the real (non-padding) tiles
+    """
+
+    def __init__(self, tiles, mask):
+        self.tiles = tiles
+        self.mask = mask
+
+    @property
+    def counts(self):
+        return self.mask.sum(dim=1)  # number of tiles in each bag
+
+    @property
+    def offsets(self):
+        # bag b occupies flat()[offsets[b]:offsets[b + 1]]
+        return torch.cat([self.counts.new_zeros(1), torch.cumsum(self.counts, dim=0)])
+
+    def flat(self):
+        # only the real tiles [total_tiles, n_channels, h, w], concatenated bag by bag
+        return self.tiles[self.mask]
+
+    def to(self, device, non_blocking=False):
+        return TileBatch(self.tiles.to(device, non_blocking=non_blocking), self.mask.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        return TileBatch(self.tiles.pin_memory(), self.mask.pin_memory())
+
+    def __len__(self):
+        return self.tiles.shape[0]
+
+
+def collate_tile_bags(batch):
+    # batch: list of (patient_id, days_to_event, event_occurred, tiles [n_tiles, C, H, W], x_omic) with varying n_tiles
+    patient_ids, days_to_event, event_occurred, bags, x_omic = zip(*batch)
+    max_tiles = max(bag.shape[0] for bag in bags)
+    tiles = bags[0].new_zeros((len(bags), max_tiles) + tuple(bags[0].shape[1:]))
+    mask = torch.zeros(len(bags), max_tiles, dtype=torch.bool)
+    for i, bag in enumerate(bags):
+        tiles[i, :bag.shape[0]] = bag
+        mask[i, :bag.shape[0]] = True
+    return (default_collate(patient_ids), default_collate(days_to_event), default_collate(event_occurred),
+            TileBatch(tiles, mask), default_collate(x_omic))
+
+
+def tiles_to_device(x_wsi, device):
+    # x_wsi is either a TileBatch (tile bags) or a list of tensors (one tensor per tile index, fixed tile counts)
+    if isinstance(x_wsi, TileBatch):
+        return x_wsi.to(device)
+    return [x.to(device) for x in x_wsi]
+
+
+def get_collate_fn(opt):
+    # tile bags have different lengths, so they need collate_tile_bags; None selects the default collate of the DataLoader
+    return collate_tile_bags if getattr(opt, 'tiles_per_slide', 0) > 0 else None
+
+
+_tile_manifests = {}
+
+
+def load_tile_manifest(manifest_path):
+    # tile file name -> tile path, from the parquet written by preprocessing/build_tile_manifest.py (read once per process)
+    if manifest_path not in _tile_manifests:
+        import pandas as pd
+        manifest = pd.read_parquet(manifest_path, columns=['tile', 'path'])
+        duplicated = manifest['tile'].duplicated(keep=False)
+        if duplicated.any():  # (e.g. the same tiles in TCGA-*/0/ and TCGA-*/0_filtered/): the file name is ambiguous
+            raise ValueError(f"{int(duplicated.sum())} tiles of {manifest_path} share their file name with another tile, "
+                             f"e.g. {manifest.loc[duplicated, 'path'].head(2).tolist()}; remove the duplicate directories "
+                             f"from the tiles directory and rebuild the manifest")
+        _tile_manifests[manifest_path] = dict(zip(manifest['tile'], manifest['path']))
+    return _tile_manifests[manifest_path]
+
+
+def resolve_tile_path(opt, tile):
+    """
+    :param tile: tile file name as stored in the mapping files
+    :return: path of the tile; through the tile manifest if opt.tile_manifest is set (the tiles stay in their per-slide
+             directories), in the flat opt.input_wsi_path directory otherwise
+    """
+    manifest_path = getattr(opt, 'tile_manifest', None)
+    if manifest_path:
+        return load_tile_manifest(manifest_path)[tile]
+    return os.path.join(opt.input_wsi_path, tile)
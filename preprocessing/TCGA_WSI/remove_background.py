@@ -1,88 +1,166 @@
 import cv2
 import numpy as np
+import pandas as pd
 import os
+import time
+import glob
+import argparse
+import tempfile
 from multiprocessing import Pool
 import shutil
-from pdb import set_trace
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')
 
 # use the wsi_env conda env with python3.10 remove_background.py
+# tiles are filtered in parallel (shards of tiles over a process pool) and the kept tiles are written to a manifest csv
+# (path, tcga_id, tissue_fraction) instead of copying the pixels:
+#   python remove_background.py --base_dir <dir with TCGA-*/0/*.png> --manifest tile_manifest.csv --num_workers 32
+#   python remove_background.py --base_dir <dir> --reduce 2          # tissue fraction at half resolution
+#   python remove_background.py --synthetic 2000 --benchmark_workers 1 2 4 8   # tiles/s vs number of processes
+
+# full resolution: BGR decoding + cvtColor (the grayscale values of the original filtering; the grayscale conversion of
+# libpng differs slightly); reduced: grayscale decoding at 1/2, 1/4 or 1/8 resolution (decoded at that size for JPEG
+# tiles, decoded and downscaled by OpenCV for PNG tiles), which smooths the tiles and changes the fractions a little
+IMREAD_MODES = {1: cv2.IMREAD_COLOR,
+                2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def tissue_fraction(file_path, dark_threshold=150, reduce=1):
+    """
+    fraction of the (grayscale) pixels darker than dark_threshold, i.e. representing tissue
+    :param reduce: compute the fraction at 1/reduce of the resolution (1, 2, 4 or 8)
+    :return: tissue fraction, or NaN if the tile can not be read
+    """
+    image = cv2.imread(file_path, IMREAD_MODES[reduce])
+    if image is None:
+        return float('nan')
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if reduce == 1 else image
+    return np.count_nonzero(gray_image < dark_threshold) / gray_image.size  # single pass over the pixels
+
+
+def _filter_shard(args):
+    file_paths, dark_threshold, reduce = args
+    return [tissue_fraction(file_path, dark_threshold, reduce) for file_path in file_paths]
+
+
+def filter_tiles(file_paths, tissue_threshold=0.4, dark_threshold=150, reduce=1, num_workers=None, shard_size=256):
+    """
+    :param file_paths: list of tile paths
+    :param tissue_threshold: minimum fraction of the tile that must be tissue
+    :param num_workers: processes (default: all the cores); the tiles are sharded in chunks of shard_size
+    :return: DataFrame with path, tcga_id, tissue_fraction and kept for every tile (in the order of file_paths)
+    """
+    num_workers = num_workers or os.cpu_count()
+    shards = [(file_paths[i:i + shard_size], dark_threshold, reduce) for i in range(0, len(file_paths), shard_size)]
+    if num_workers == 1:
+        fractions = [_filter_shard(shard) for shard in shards]
+    else:
+        # cv2 threads would oversubscribe the cores of the pool
+        with Pool(processes=num_workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+            fractions = pool.map(_filter_shard, shards, chunksize=1)
+    manifest = pd.DataFrame({'path': file_paths,
+                             'tissue_fraction': np.concatenate(fractions) if fractions else np.array([])})
+    # tiles are stored as <base_dir>/<TCGA ID>/0/<tile>.png
+    manifest['tcga_id'] = [os.path.basename(os.path.dirname(os.path.dirname(path))) for path in file_paths]
+    manifest['kept'] = manifest['tissue_fraction'] > tissue_threshold
+    return manifest[['path', 'tcga_id', 'tissue_fraction', 'kept']]
+
+
+def list_tiles(base_dir):
+    tcga_dirs = sorted(d for d in os.listdir(base_dir) if d.startswith("TCGA") and os.path.isdir(os.path.join(base_dir, d)))
+    file_paths = []
+    for tcga_dir in tcga_dirs:
+        with os.scandir(os.path.join(base_dir, tcga_dir, "0")) as entries:
+            file_paths.extend(sorted(entry.path for entry in entries if entry.name.lower().endswith('.png')))
+    return file_paths
+
 
 def process_images(source_dir, dest_dir, tissue_threshold=0.4):
     """
-    Process images in the source directory, moving images with less than the specified
-    foreground threshold of tissue to the destination directory.
+    Process images in the source directory, copying images with more than the specified
+    foreground threshold of tissue to the destination directory (single directory, kept for the old workflow).
 
     :param source_dir: Directory containing the images to process.
-    :param dest_dir: Directory where images with insufficient tissue will be moved.
+    :param dest_dir: Directory where images with sufficient tissue will be copied.
     :param tissue_threshold: Minimum fraction of the image that must be foreground (tissue).
     """
     os.makedirs(dest_dir, exist_ok=True)
+    file_paths = sorted(glob.glob(os.path.join(source_dir, '*.png')) + glob.glob(os.path.join(source_dir, '*.PNG')))
+    manifest = filter_tiles(file_paths, tissue_threshold=tissue_threshold, num_workers=1)
+    for file_path in manifest.loc[manifest['kept'], 'path']:
+        shutil.copy(file_path, os.path.join(dest_dir, os.path.basename(file_path)))
+        print(f"Copied: {os.path.basename(file_path)}")
+
+
+def write_synthetic_tiles(output_dir, n_tiles, tile_size=256, n_slides=10, seed=0):
+    # random 'tissue' blobs on a white background, stored as <output_dir>/<TCGA ID>/0/<tile>.png
+    rng = np.random.default_rng(seed)
+    for i in range(n_tiles):
+        slide_dir = os.path.join(output_dir, f"TCGA-SYN-{i % n_slides:04d}", "0")
+        os.makedirs(slide_dir, exist_ok=True)
+        image = np.full((tile_size, tile_size, 3), 235, dtype=np.uint8)
+        for _ in range(rng.integers(0, 12)):
+            center = tuple(int(c) for c in rng.integers(0, tile_size, 2))
+            color = tuple(int(c) for c in rng.integers(60, 200, 3))
+            cv2.circle(image, center, int(rng.integers(10, tile_size // 2)), color, -1)
+        image = np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(slide_dir, f"{i * tile_size}_{i * tile_size}.png"), image)
+
+
+def benchmark(file_paths, opt):
+    print(f"{len(file_paths)} tiles, reduce={opt.reduce}")
+    print(f"{'workers':>7s} {'tiles/s':>9s} {'speedup':>8s} {'efficiency':>10s} {'kept':>6s}")
+    rates = {}
+    # the speedup and efficiency are relative to a single process, which is always measured first
+    for num_workers in [1] + [n for n in opt.benchmark_workers if n != 1]:
+        start = time.perf_counter()
+        manifest = filter_tiles(file_paths, opt.tissue_threshold, opt.dark_threshold, opt.reduce, num_workers,
+                                opt.shard_size)
+        rate = rates[num_workers] = len(file_paths) / (time.perf_counter() - start)
+        base_rate = rates[1]
+        print(f"{num_workers:7d} {rate:9.1f} {rate / base_rate:8.2f} {rate / base_rate / num_workers:10.2f} "
+              f"{int(manifest['kept'].sum()):6d}")
 
-    file_index = 0
-    for filename in os.listdir(source_dir):
-        if not filename.lower().endswith('.png'):
-            continue
-
-        file_path = os.path.join(source_dir, filename)
-
-        image = cv2.imread(file_path, cv2.IMREAD_COLOR)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # # apply Gaussian blur to reduce noise and improve the thresholding
-        # blurred_image = gray_image #cv2.GaussianBlur(gray_image, (5, 5), 0)
-        # #use Otsu thresholding to separate the tissue from the background
-        # # for this binary thresholding, the pixels above threshold will be set to 255, and those below threshold to 0
-        # ret, otsu_thresh = cv2.threshold(blurred_image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        #
-        # # create a mask where the tissue regions are white and the background is black
-        # mask = otsu_thresh == 255
-        #
-        # # create an output image that will contain the tissue with a white background
-        # tissue = np.zeros_like(gray_image)
-        # tissue[mask] = 255#image[mask]
-        # cv2.imwrite(f"tissue_{file_index}.png", tissue)
-        # # cv2.imshow('Tissue', tissue)
-        # # set_trace()
-
-
-        # calculate the tissue percentage
-        # set_trace()
-        dark_threshold = 150 # pixels with grayscale value below this are considered dark (representing tissues)
-        mask = gray_image < dark_threshold
-        tissue = 255*np.ones_like(gray_image)
-        tissue[mask] = 5 # a low (dark) value
-        # cv2.imwrite(f"tissue_{file_index}.png", tissue)
-
-        tissue_pixel_count = np.sum(gray_image < dark_threshold)
-        tissue_pct = tissue_pixel_count / gray_image.size
-
-        # check if the image has sufficient fraction of tissue compared to the background
-        # print("++++ filename +++: ", filename)
-        # print("tissue_pixel_count: ", tissue_pixel_count)
-        # print("total_pixel_count: ", gray_image.size)
-        # print("tissue_pct:", tissue_pct)
-        if tissue_pct > tissue_threshold:
-            dest_path = os.path.join(dest_dir, filename)
-            # shutil.move(file_path, dest_path)
-            shutil.copy(file_path, dest_path)
-            print(f"Moved: {filename}")
-        file_index += 1
-        # set_trace()
 
 if __name__ == "__main__":
-    base_dir = "/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/preprocessing/TCGA_WSI/"
-    source_dirs = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
-    tcga_dirs = [d for d in source_dirs if d.startswith("TCGA")]
-    num_processes = os.cpu_count()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base_dir', type=str,
+                        default="/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/preprocessing/TCGA_WSI/",
+                        help='directory with the TCGA-*/0/*.png tiles')
+    parser.add_argument('--manifest', type=str, default='tile_manifest.csv', help='output csv of the kept tiles')
+    parser.add_argument('--write_all', action='store_true', help='also write the rejected tiles (kept=False) to the manifest')
+    parser.add_argument('--tissue_threshold', type=float, default=0.4, help='minimum tissue fraction of a kept tile')
+    parser.add_argument('--dark_threshold', type=int, default=150,
+                        help='pixels with grayscale value below this are considered dark (representing tissues)')
+    parser.add_argument('--reduce', type=int, default=1, choices=sorted(IMREAD_MODES),
+                        help='compute the tissue fraction at 1/reduce of the tile resolution')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shard_size', type=int, default=256, help='tiles per task of the process pool')
+    parser.add_argument('--benchmark_workers', type=int, nargs='+', default=None,
+                        help='report tiles/s for each of these numbers of processes instead of writing the manifest')
+    parser.add_argument('--synthetic', type=int, default=0, help='use this many synthetic tiles (for --benchmark_workers)')
+    opt = parser.parse_args()
 
-    # with Pool(processes=num_processes) as pool:
-    #     pool.map()
+    synthetic_dir = None
+    if opt.synthetic > 0:
+        synthetic_dir = tempfile.mkdtemp()
+        write_synthetic_tiles(synthetic_dir, opt.synthetic)
+        opt.base_dir = synthetic_dir
+    file_paths = list_tiles(opt.base_dir)
 
-    for tcga_dir in tcga_dirs:
-        print("Processing TCGA ID: ", tcga_dir)
-        source_directory = tcga_dir + "/0/"
-        destination_directory = tcga_dir + "/0_filtered/"
-        # set_trace()
-        process_images(source_directory, destination_directory)
+    if opt.benchmark_workers:
+        benchmark(file_paths, opt)
+    else:
+        start = time.perf_counter()
+        manifest = filter_tiles(file_paths, opt.tissue_threshold, opt.dark_threshold, opt.reduce, opt.num_workers,
+                                opt.shard_size)
+        elapsed = time.perf_counter() - start
+        n_unreadable = int(manifest['tissue_fraction'].isna().sum())
+        if not opt.write_all:
+            manifest = manifest[manifest['kept']]
+        manifest.to_csv(opt.manifest, index=False)
+        print(f"kept {int(manifest['kept'].sum())} of {len(file_paths)} tiles ({n_unreadable} unreadable) from "
+              f"{manifest['tcga_id'].nunique()} slides in {elapsed:.1f} s ({len(file_paths) / elapsed:.0f} tiles/s); "
+              f"manifest written to {opt.manifest}")
+    if synthetic_dir is not None:
+        shutil.rmtree(synthetic_dir)
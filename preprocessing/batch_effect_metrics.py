@@ -0,0 +1,141 @@
+# batch effect metrics of an expression matrix (samples x genes) with respect to the tissue source sites (TCGA-<site>-...)
+# DSC (dispersion separability criterion, https://bioinformatics.mdanderson.org/public-software/tcga-batch-effects/):
+#   per site:  Db_i = sqrt(trace(Sb_i)), Dw_i = sqrt(trace(Sw_i)) with the scatter matrices of quantify_batch_effects.py
+#              (Sw_i = sum of the outer products of the deviations from the site mean, Sb_i = n_i * p_i * d_i d_i^T)
+#   overall:   Db = sqrt(sum_i p_i |d_i|^2), Dw = sqrt(sum_i p_i trace(cov_i))
+# only the traces are needed, i.e. sums of squared deviations, so the genes x genes scatter matrices are never built: the
+# per-site sums of the samples are grouped reductions (np.add.reduceat over the samples sorted by site), O(samples x genes)
+# permutation p-values: the sites are shuffled n_permutations times; with the samples x samples Gram matrix of the
+# centered data, the squared norm of the sum of a group of samples is 1^T K 1, so each permutation costs
+# O(samples^2) instead of O(samples x genes); blocks of permutations are evaluated as batched matrix products in threads
+# python batch_effect_metrics.py --expression combined_rnaseq_TCGA-LUAD.tsv --n_permutations 1000 --output dsc_values.csv
+# python batch_effect_metrics.py --expression_prefix combined_rnaseq_TCGA-LUAD   # matrix of create_combined_rnaseq_parallel.py
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def tissue_source_sites(sample_ids):
+    # TCGA-44-2655 -> 44 (also TCGA.44.2655 from the batch corrected tables)
+    return np.array([sample_id.replace('.', '-').split('-')[1] for sample_id in sample_ids])
+
+
+def _dsc_from_group_stats(counts, sq_norm_sums, sum_sq_norms):
+    """
+    :param counts: [..., n_sites] samples per site
+    :param sq_norm_sums: [..., n_sites] sum over the samples of a site of their squared norms (centered data)
+    :param sum_sq_norms: [..., n_sites] squared norm of the sum of the samples of a site (centered data)
+    :return: per site DSC [..., n_sites], overall DSC [...]
+    """
+    total = counts.sum(axis=-1, keepdims=True)
+    safe_counts = np.maximum(counts, 1)
+    within = np.maximum(sq_norm_sums - sum_sq_norms / safe_counts, 0)  # sum of squared deviations from the site mean
+    between = sum_sq_norms / total  # n_i * p_i * |d_i|^2 (the global mean is 0 after centering)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        site_dsc = np.where(within > 0, np.sqrt(between) / np.sqrt(within), 0.0)
+        overall_between = (sum_sq_norms / safe_counts ** 2 * counts / total).sum(axis=-1)
+        overall_within = (within / total).sum(axis=-1)
+        overall_dsc = np.where(overall_within > 0, np.sqrt(overall_between / overall_within), 0.0)
+    return site_dsc, overall_dsc
+
+
+def dsc(x, labels):
+    """
+    :param x: [n_samples, n_genes] expression matrix
+    :param labels: [n_samples] batch (tissue source site) of every sample
+    :return: sites, per site DSC, overall DSC
+    """
+    x = np.asarray(x, dtype=np.float64)
+    sites, codes = np.unique(labels, return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(sites))
+    centered = x[order] - x.mean(axis=0)  # (centering reduces the cancellation in the within-site sums)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    site_sums = np.add.reduceat(centered, starts, axis=0)  # [n_sites, n_genes]
+    sq_norm_sums = np.add.reduceat(np.einsum('ij,ij->i', centered, centered), starts)
+    site_dsc, overall_dsc = _dsc_from_group_stats(counts, sq_norm_sums, np.einsum('ij,ij->i', site_sums, site_sums))
+    return sites, site_dsc, float(overall_dsc)
+
+
+def _permutation_block(gram, sq_norms, codes, n_sites, seed, n_permutations):
+    rng = np.random.default_rng(seed)
+    permuted = np.stack([rng.permutation(codes) for _ in range(n_permutations)])  # [B, n_samples]
+    one_hot = np.zeros((n_permutations, n_sites, len(codes)))
+    np.put_along_axis(one_hot, permuted[:, None, :], 1.0, axis=1)
+    counts = one_hot.sum(axis=-1)
+    sq_norm_sums = one_hot @ sq_norms
+    sum_sq_norms = np.einsum('bkn,bkn->bk', one_hot @ gram, one_hot)  # 1_i^T K 1_i
+    return _dsc_from_group_stats(counts, sq_norm_sums, sum_sq_norms)
+
+
+def permutation_test(x, labels, n_permutations=1000, seed=0, block_size=64, num_workers=None):
+    """
+    :return: DataFrame with the DSC and the permutation p-value of every site, and of all the sites ('overall')
+    """
+    x = np.asarray(x, dtype=np.float64)
+    sites, site_dsc, overall_dsc = dsc(x, labels)
+    _, codes = np.unique(labels, return_inverse=True)
+    centered = x - x.mean(axis=0)
+    gram = centered @ centered.T
+    sq_norms = np.diag(gram).copy()
+
+    # blocks of permutations with independent seeds (the result doesn't depend on the number of threads)
+    blocks = [min(block_size, n_permutations - start) for start in range(0, n_permutations, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    num_workers = num_workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:  # (the batched matmuls release the GIL)
+        results = list(executor.map(lambda args: _permutation_block(gram, sq_norms, codes, len(sites), *args),
+                                    zip(seeds, blocks)))
+    null_site = np.concatenate([site for site, _ in results])  # [n_permutations, n_sites]
+    null_overall = np.concatenate([overall for _, overall in results])
+    site_p = (1 + (null_site >= site_dsc).sum(axis=0)) / (n_permutations + 1)
+    overall_p = (1 + (null_overall >= overall_dsc).sum()) / (n_permutations + 1)
+
+    counts = np.bincount(codes, minlength=len(sites))
+    return pd.DataFrame({'Tissue_Site': list(sites) + ['overall'], 'n_samples': list(counts) + [int(counts.sum())],
+                         'DSC': list(site_dsc) + [overall_dsc], 'p_value': list(site_p) + [overall_p]})
+
+
+def load_expression(expression=None, expression_prefix=None, gene_type='protein_coding'):
+    """
+    :return: [n_samples, n_genes] matrix and the sample ids, from the tab-separated table (gene_id, gene_name, gene_type,
+             one column per sample) or from the matrix files of create_combined_rnaseq_parallel.py
+    """
+    if expression_prefix is not None:
+        matrix = np.load(expression_prefix + '.npy', mmap_mode='r')
+        with open(expression_prefix + '.samples.txt') as f:
+            sample_ids = f.read().split()
+        return np.asarray(matrix).T, sample_ids
+    data = pd.read_csv(expression, delimiter='\t')
+    if 'gene_type' in data.columns and gene_type is not None:
+        data = data[data['gene_type'] == gene_type]
+    numeric_data = data.drop(columns=[c for c in ['gene_id', 'gene_name', 'gene_type'] if c in data.columns])
+    return numeric_data.to_numpy(dtype=np.float64).T, list(numeric_data.columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expression', type=str, default='./combined_rnaseq_TCGA-LUAD.tsv')
+    parser.add_argument('--expression_prefix', type=str, default=None, help='.npy matrix + index files (instead of the table)')
+    parser.add_argument('--log1p', action='store_true', help='log(1 + x) transform the expression values first')
+    parser.add_argument('--n_permutations', type=int, default=1000)
+    parser.add_argument('--block_size', type=int, default=64, help='permutations evaluated together')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='dsc_values.csv')
+    opt = parser.parse_args()
+
+    x, sample_ids = load_expression(opt.expression, opt.expression_prefix)
+    if opt.log1p:
+        x = np.log1p(x)
+    labels = tissue_source_sites(sample_ids)
+    start = time.perf_counter()
+    dsc_df = permutation_test(x, labels, opt.n_permutations, opt.seed, opt.block_size, opt.num_workers)
+    print(f"{x.shape[0]} samples x {x.shape[1]} genes, {len(dsc_df) - 1} tissue sites, {opt.n_permutations} permutations "
+          f"in {time.perf_counter() - start:.1f} s")
+    print(dsc_df.to_string(index=False))
+    dsc_df.to_csv(opt.output, index=False)
+    print(f"DSC values saved to '{opt.output}'.")
@@ -0,0 +1,176 @@
+# batch effect QC of the expression matrix: PCA on chunked reads of the matrix, then t-SNE/UMAP of the top PCs only,
+# colored by tissue source site (with the DSC of the PC scores, see batch_effect_metrics.py)
+#   incremental: IncrementalPCA over chunks of samples (two passes over the matrix, the first one for the per-gene mean/std
+#                of the standardization); the full matrix is never loaded (memory mapped .npy of
+#                create_combined_rnaseq_parallel.py, read a chunk of sample columns at a time)
+#   randomized:  randomized SVD of the standardized float32 matrix (in memory; fastest when the matrix fits)
+# the PCA (mean, scale, components, scores, sample ids) is cached in --cache_dir, keyed by the path, size and mtime of the
+# matrix file and the PCA settings, and looked up before the matrix is read, so that reruns (e.g. other
+# perplexities/neighbors, UMAP instead of t-SNE) neither parse the tsv nor redo the PCA, only the embedding of the top PCs
+# python batch_effect_qc.py --expression_prefix combined_rnaseq_TCGA-LUAD --log1p --embedding tsne umap --output_dir qc/
+# python batch_effect_qc.py --expression combined_rnaseq_TCGA-LUAD.tsv --method randomized
+import os
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.manifold import TSNE
+from batch_effect_metrics import dsc, load_expression, tissue_source_sites
+
+
+def iter_sample_chunks(matrix, chunk_size, log1p=False):
+    # [chunk, n_genes] float64 blocks of a [n_genes, n_samples] matrix (contiguous reads for Fortran-order files)
+    for start in range(0, matrix.shape[1], chunk_size):
+        chunk = np.asarray(matrix[:, start:start + chunk_size], dtype=np.float64).T
+        yield np.log1p(chunk) if log1p else chunk
+
+
+def gene_moments(matrix, chunk_size, log1p=False):
+    # per-gene mean and std over the samples, from chunked sums (shifted by the first chunk mean for numerical stability)
+    shift, n, total, total_sq = None, 0, 0.0, 0.0
+    for chunk in iter_sample_chunks(matrix, chunk_size, log1p):
+        if shift is None:
+            shift = chunk.mean(axis=0)
+        chunk = chunk - shift
+        n += chunk.shape[0]
+        total = total + chunk.sum(axis=0)
+        total_sq = total_sq + (chunk ** 2).sum(axis=0)
+    mean = total / n
+    var = np.maximum(total_sq / n - mean ** 2, 0)
+    scale = np.sqrt(var)
+    scale[scale == 0] = 1.0  # (as StandardScaler for constant genes)
+    return mean + shift, scale
+
+
+def fit_pca(matrix, n_components=50, method='incremental', chunk_size=256, log1p=False, seed=0):
+    """
+    :param matrix: [n_genes, n_samples] expression matrix (e.g. memory mapped)
+    :return: dict with mean, scale, components [n_components, n_genes], explained_variance_ratio, scores [n_samples, n_components]
+    """
+    n_components = min(n_components, *matrix.shape)
+    mean, scale = gene_moments(matrix, chunk_size, log1p)
+    if method == 'incremental':
+        chunk_size = max(chunk_size, n_components)  # (IncrementalPCA needs at least n_components samples per batch)
+        pca = IncrementalPCA(n_components=n_components)
+        chunks = list(range(0, matrix.shape[1], chunk_size))
+        for i, chunk in enumerate(iter_sample_chunks(matrix, chunk_size, log1p)):
+            if i == len(chunks) - 1 and chunk.shape[0] < n_components and i > 0:
+                break  # (a too small last chunk only contributes to the scores)
+            pca.partial_fit((chunk - mean) / scale)
+        scores = np.concatenate([pca.transform((chunk - mean) / scale)
+                                 for chunk in iter_sample_chunks(matrix, chunk_size, log1p)])
+    elif method == 'randomized':
+        x = np.concatenate([((chunk - mean) / scale).astype(np.float32)
+                            for chunk in iter_sample_chunks(matrix, chunk_size, log1p)])
+        pca = PCA(n_components=n_components, svd_solver='randomized', random_state=seed)
+        scores = pca.fit_transform(x)
+    else:
+        raise ValueError(f"Unsupported PCA method: {method}")
+    return {'mean': mean, 'scale': scale, 'components': pca.components_,
+            'explained_variance_ratio': pca.explained_variance_ratio_, 'scores': scores.astype(np.float32)}
+
+
+def pca_cache_key(source_path, **settings):
+    stat = os.stat(source_path)
+    key = f"{os.path.abspath(source_path)}|{stat.st_size}|{stat.st_mtime}|" + '|'.join(
+        f"{name}={value}" for name, value in sorted(settings.items()))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def cached_pca(load_matrix, source_path, cache_dir, **settings):
+    """
+    :param load_matrix: function returning the [n_genes, n_samples] matrix of source_path and its sample ids (only called
+                        when the PCA is not cached, so a cached rerun doesn't read the matrix file)
+    :return: fit_pca result with the sample_ids, True if it was loaded from cache_dir (same file path, size and mtime and
+             same settings as before)
+    """
+    path = os.path.join(cache_dir, f"pca_{pca_cache_key(source_path, **settings)}.npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if 'sample_ids' in cached.files:  # (caches of older versions have no sample ids and are recomputed)
+                return {name: cached[name] for name in cached.files}, True
+    matrix, sample_ids = load_matrix()
+    result = fit_pca(matrix, **settings)
+    result['sample_ids'] = np.asarray(sample_ids, dtype=str)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, **result)
+    return result, False
+
+
+def embed(scores, method='tsne', n_pcs=50, seed=42, perplexity=30.0, n_neighbors=15, min_dist=0.1):
+    # 2D embedding of the top n_pcs PC scores
+    x = scores[:, :n_pcs]
+    if method == 'tsne':
+        return TSNE(n_components=2, perplexity=min(perplexity, (len(x) - 1) / 3), init='pca',
+                    random_state=seed).fit_transform(x)
+    if method == 'umap':
+        import umap  # (umap-learn, only needed for this embedding)
+        return umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, random_state=seed).fit_transform(x)
+    if method == 'pca':
+        return x[:, :2]
+    raise ValueError(f"Unsupported embedding: {method}")
+
+
+def plot_embedding(components, labels, title, path):
+    plt.figure(figsize=(8, 6))
+    codes, sites = pd.factorize(labels)
+    plt.scatter(components[:, 0], components[:, 1], c=codes, cmap='tab20', s=12, alpha=0.7)
+    plt.title(title)
+    plt.xlabel('Component 1')
+    plt.ylabel('Component 2')
+    plt.grid(True)
+    plt.savefig(path, dpi=150, bbox_inches='tight')
+    plt.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expression', type=str, default='./combined_rnaseq_TCGA-LUAD.tsv')
+    parser.add_argument('--expression_prefix', type=str, default=None,
+                        help='.npy matrix + index files of create_combined_rnaseq_parallel.py (read in chunks)')
+    parser.add_argument('--log1p', action='store_true')
+    parser.add_argument('--method', type=str, default='incremental', choices=['incremental', 'randomized'])
+    parser.add_argument('--n_components', type=int, default=50)
+    parser.add_argument('--chunk_size', type=int, default=256, help='samples per chunk')
+    parser.add_argument('--embedding', type=str, nargs='+', default=['pca', 'tsne'], choices=['pca', 'tsne', 'umap'])
+    parser.add_argument('--n_pcs', type=int, default=50, help='PCs used for t-SNE/UMAP')
+    parser.add_argument('--perplexity', type=float, default=30.0)
+    parser.add_argument('--n_neighbors', type=int, default=15)
+    parser.add_argument('--cache_dir', type=str, default='./pca_cache')
+    parser.add_argument('--output_dir', type=str, default='./batch_effect_qc')
+    opt = parser.parse_args()
+
+    def load_matrix():
+        if opt.expression_prefix is not None:
+            with open(opt.expression_prefix + '.samples.txt') as f:
+                return np.load(opt.expression_prefix + '.npy', mmap_mode='r'), f.read().split()
+        x, sample_ids = load_expression(opt.expression)  # (parses the whole tsv)
+        return x.T, sample_ids
+
+    start = time.perf_counter()
+    source_path = opt.expression_prefix + '.npy' if opt.expression_prefix is not None else opt.expression
+    pca_result, from_cache = cached_pca(load_matrix, source_path, opt.cache_dir, n_components=opt.n_components,
+                                        method=opt.method, chunk_size=opt.chunk_size, log1p=opt.log1p)
+    scores, sample_ids = pca_result['scores'], pca_result['sample_ids'].tolist()
+    print(f"PCA ({opt.method}, {scores.shape[1]} components, {'cached' if from_cache else 'computed'}) in "
+          f"{time.perf_counter() - start:.1f} s; explained variance of the first 10 PCs: "
+          f"{np.round(pca_result['explained_variance_ratio'][:10], 3)}")
+
+    labels = tissue_source_sites(sample_ids)
+    sites, site_dsc, overall_dsc = dsc(scores[:, :opt.n_pcs], labels)
+    print(f"DSC of the top {min(opt.n_pcs, scores.shape[1])} PCs over {len(sites)} tissue sites: {overall_dsc:.3f}")
+
+    os.makedirs(opt.output_dir, exist_ok=True)
+    for method in opt.embedding:
+        start = time.perf_counter()
+        components = embed(scores, method, opt.n_pcs, perplexity=opt.perplexity, n_neighbors=opt.n_neighbors)
+        print(f"{method} in {time.perf_counter() - start:.1f} s")
+        pd.DataFrame({'sample_id': sample_ids, 'tissue_site': labels, 'component_1': components[:, 0],
+                      'component_2': components[:, 1]}).to_csv(os.path.join(opt.output_dir, f"{method}.csv"), index=False)
+        plot_embedding(components, labels, f"{method} of the top PCs (colored by tissue source site)",
+                       os.path.join(opt.output_dir, f"{method}.png"))
@@ -0,0 +1,154 @@
+# builds a columnar (parquet) index of the extracted WSI tiles, so that the tiles can stay in their per-slide directories
+# (no flat copy into a 'combined' directory) and the mapping/training code doesn't have to list the directories again
+# one row per tile: patient_id, slide_id, tile (file name), path, x, y, file_size, mtime, tissue_fraction
+# the slide directories are scanned in parallel with os.scandir; with an existing manifest only new or modified slide
+# directories (latest mtime of the slide directory and its subdirectories) are rescanned, keeping the tissue fractions of
+# their unchanged tiles (and removed ones are dropped), so the manifest can be updated when new slides arrive
+# python build_tile_manifest.py --tiles_dir <dir with one TCGA-* directory per slide> --manifest tile_manifest.parquet
+# python build_tile_manifest.py --tiles_dir <dir> --manifest tile_manifest.parquet --tissue_manifest tile_filter.csv
+#   (tissue fractions from TCGA_WSI/remove_background.py --write_all)
+# the training code resolves the tile file names through it with --tile_manifest tile_manifest.parquet
+import os
+import re
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+TILE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# slideflow tile names: <slide name>-<x>-<y>.jpg (the slide name itself contains dashes); also accepts _ separators
+TILE_NAME_PATTERN = re.compile(r'^(?P<slide>.+)[-_](?P<x>\d+)[-_](?P<y>\d+)\.(?:png|jpe?g)$', re.IGNORECASE)
+
+COLUMNS = ['patient_id', 'slide_id', 'tile', 'path', 'x', 'y', 'file_size', 'mtime', 'dir_mtime', 'tissue_fraction']
+
+
+def scan_slide_dir(slide_dir):
+    """
+    :return: dict of columns for all the tiles in slide_dir (recursing into subdirectories, e.g. TCGA-*/0/)
+    """
+    rows = {column: [] for column in COLUMNS}
+    dir_mtime = os.stat(slide_dir).st_mtime
+    pending = [slide_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    dir_mtime = max(dir_mtime, entry.stat(follow_symlinks=False).st_mtime)
+                    continue
+                if not entry.name.lower().endswith(TILE_EXTENSIONS):
+                    continue
+                stat = entry.stat()  # cached by scandir on most platforms
+                match = TILE_NAME_PATTERN.match(entry.name)
+                slide_id = match.group('slide') if match else os.path.basename(slide_dir)
+                rows['patient_id'].append('-'.join(entry.name.split('-')[:3]))  # same as create_image_molecular_mapping.py
+                rows['slide_id'].append(slide_id)
+                rows['tile'].append(entry.name)
+                rows['path'].append(entry.path)
+                rows['x'].append(int(match.group('x')) if match else -1)
+                rows['y'].append(int(match.group('y')) if match else -1)
+                rows['file_size'].append(stat.st_size)
+                rows['mtime'].append(stat.st_mtime)
+                rows['tissue_fraction'].append(np.nan)
+    rows['dir_mtime'] = [dir_mtime] * len(rows['tile'])  # (the latest mtime of the directories of the slide)
+    return rows
+
+
+def slide_dir_mtime(slide_dir):
+    # latest mtime of slide_dir and its subdirectories (adding/removing a tile only updates the mtime of its own directory)
+    dir_mtime = os.stat(slide_dir).st_mtime
+    pending = [slide_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    dir_mtime = max(dir_mtime, entry.stat(follow_symlinks=False).st_mtime)
+    return dir_mtime
+
+
+def list_slide_dirs(tiles_dir):
+    with os.scandir(tiles_dir) as entries:
+        return sorted(entry.path for entry in entries if entry.is_dir() and "TCGA" in entry.name)  # skips 'combined'
+
+
+def build_manifest(tiles_dir, manifest_path=None, num_workers=32):
+    """
+    :param manifest_path: existing manifest to update (only new/modified slide directories are rescanned)
+    :return: manifest DataFrame, number of rescanned slide directories
+    """
+    slide_dirs = list_slide_dirs(tiles_dir)
+    previous = None
+    if manifest_path is not None and os.path.exists(manifest_path):
+        previous = pd.read_parquet(manifest_path)
+        previous['slide_dir'] = previous['path'].map(lambda path: _slide_dir(tiles_dir, path))
+        previous = previous[previous['slide_dir'].isin(slide_dirs)]  # drop the removed slides
+        known_mtimes = previous.groupby('slide_dir')['dir_mtime'].first().to_dict()
+        # a slide directory is unchanged if the latest mtime of its directories (updated when tiles are added/removed)
+        # is the same; only the directories are listed here, the tiles are not stat'ed
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            dir_mtimes = dict(zip(slide_dirs, executor.map(slide_dir_mtime, slide_dirs)))
+        to_scan = [d for d in slide_dirs if known_mtimes.get(d) != dir_mtimes[d]]
+        rescanned = previous[previous['slide_dir'].isin(to_scan)]
+        previous = previous[~previous['slide_dir'].isin(to_scan)].drop(columns=['slide_dir'])
+    else:
+        to_scan = slide_dirs
+
+    # scandir/stat are I/O bound and release the GIL, so threads are enough (also on network file systems)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        scanned = list(executor.map(scan_slide_dir, to_scan))
+    new = pd.DataFrame({column: [value for rows in scanned for value in rows[column]] for column in COLUMNS})
+    new = new.astype({'x': np.int32, 'y': np.int32, 'file_size': np.int64, 'tissue_fraction': np.float32})
+    if previous is not None and len(rescanned) > 0:
+        # keep the tissue fractions of the unchanged tiles (same path and mtime) of the rescanned slides
+        known_fractions = rescanned.set_index(['path', 'mtime'])['tissue_fraction']
+        known_fractions = known_fractions[~known_fractions.index.duplicated()]
+        new['tissue_fraction'] = known_fractions.reindex(pd.MultiIndex.from_frame(new[['path', 'mtime']])).to_numpy(
+            dtype=np.float32)  # (nan for the new tiles)
+    manifest = new if previous is None else pd.concat([previous, new], ignore_index=True)
+    manifest = manifest.sort_values(['patient_id', 'slide_id', 'y', 'x', 'tile']).reset_index(drop=True)
+    return manifest, len(to_scan)
+
+
+def _slide_dir(tiles_dir, path):
+    # top level (slide) directory of a tile path
+    return os.path.join(tiles_dir, os.path.relpath(path, tiles_dir).split(os.sep)[0])
+
+
+def add_tissue_fractions(manifest, tissue_manifest_path):
+    # tissue fractions from the csv written by TCGA_WSI/remove_background.py (path, tcga_id, tissue_fraction, kept)
+    fractions = pd.read_csv(tissue_manifest_path, usecols=['path', 'tissue_fraction']).set_index('path')['tissue_fraction']
+    matched = manifest['path'].map(fractions)
+    manifest['tissue_fraction'] = matched.fillna(manifest['tissue_fraction']).astype(np.float32)
+    return int(matched.notna().sum())
+
+
+def write_manifest(manifest, manifest_path):
+    manifest = manifest.copy()
+    for column in ['patient_id', 'slide_id']:
+        manifest[column] = manifest[column].astype('category')  # dictionary encoded in parquet
+    manifest.to_parquet(manifest_path, index=False, compression='zstd')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiles_dir', type=str, required=True, help='directory with one TCGA-* tile directory per slide')
+    parser.add_argument('--manifest', type=str, default='tile_manifest.parquet')
+    parser.add_argument('--tissue_manifest', type=str, default=None,
+                        help='csv with the tissue fraction of the tiles (TCGA_WSI/remove_background.py --write_all)')
+    parser.add_argument('--rebuild', action='store_true', help='rescan all the slide directories')
+    parser.add_argument('--num_workers', type=int, default=32, help='threads scanning the slide directories')
+    opt = parser.parse_args()
+
+    start = time.perf_counter()
+    manifest, n_scanned = build_manifest(opt.tiles_dir, None if opt.rebuild else opt.manifest, opt.num_workers)
+    if opt.tissue_manifest is not None:
+        n_matched = add_tissue_fractions(manifest, opt.tissue_manifest)
+        print(f"tissue fractions for {n_matched} of {len(manifest)} tiles")
+    write_manifest(manifest, opt.manifest)
+    print(f"{len(manifest)} tiles of {manifest['slide_id'].nunique()} slides ({manifest['patient_id'].nunique()} patients), "
+          f"{n_scanned} slide directories scanned, in {time.perf_counter() - start:.1f} s -> {opt.manifest}")
+    n_unparsed = int((manifest['x'] < 0).sum())
+    if n_unparsed:
+        print(f"Warning: no x/y coordinates in the file names of {n_unparsed} tiles")
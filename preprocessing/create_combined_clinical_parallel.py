@@ -1,61 +1,107 @@
 # creates a combined file that contains clinical data from all samples
+# the BCR XML files are streamed with ElementTree.iterparse on a process pool: only the survival fields (and the extra
+# tags given with --extra_tags) among the direct children of the patient/admin elements are kept (the follow_up elements
+# are not used, as before), and the parsing of a file stops as soon as all of them are found
+# the workers return plain tuples, combined into one typed parquet table (one row per clinical file)
+# python create_combined_clinical_parallel.py --output combined_clinical_TCGA-LUAD.parquet --num_workers 16
+# python create_combined_clinical_parallel.py --extra_tags gender age_at_initial_pathologic_diagnosis tobacco_smoking_history
 
+import os
+import time
+import argparse
 import pandas as pd
 import xml.etree.ElementTree as ET
 from pdb import set_trace
-import os
 from concurrent.futures import ProcessPoolExecutor
 
 # read the metadata json file that contains the paths to the clinical and the rnaseq tsv files
 base_dir = '/mnt/c/Users/tnandi/Downloads/TCGA-LUAD-RNASeq_clinical_all/gdc_download_20240224_072723.742270.tar/'
 meta_file = '/mnt/c/Users/tnandi/Downloads/TCGA-LUAD-RNASeq_clinical_all/metadata.cart.2024-02-24.json'
-metadata = pd.read_json(meta_file)
-
-# Get only rows corresponding to BCR XML files with clinical data
-metadata_clinical = metadata[metadata['data_format'] == 'BCR XML']
-# create a new column that contains the full path for the files
-metadata_clinical['full_path'] = base_dir + '/' + metadata_clinical['file_id'] + '/' + metadata_clinical['file_name']
-# set_trace()
-# extract 'entity_submitter_id' from the 'associated_entities' column
-metadata_clinical['entity_submitter_id'] = metadata_clinical['associated_entities'].apply(
-    lambda x: x[0]['entity_submitter_id'] if isinstance(x, list) and len(x) > 0 else None)
-
-# metadata_clinical['entity_submitter_id'] = metadata_clinical['entity_submitter_id'].str.split('-').apply(lambda x: '-'.join(x[:5]))
-repeats_exist = metadata_clinical['entity_submitter_id'].duplicated().any()
-print("Do repeats exist? ", repeats_exist)
-
-namespaces = {
-    'luad': 'http://tcga.nci/bcr/xml/clinical/luad/2.7',
-}
-def read_process_file(full_path, entry_submitter_id):
-    df_file = pd.read_xml(full_path, xpath='//luad:patient | //luad:admin', namespaces=namespaces)
-    print(full_path)
-    print(df_file['days_to_death'])
-    print(df_file['days_to_last_followup'])
-    print(df_file['vital_status'])
-    # print(df_file['patient_withdrawal'])
-    combined = df_file.apply(lambda row: [row['days_to_death'], row['days_to_last_followup'], row['vital_status']], axis=1)
-    # print(df_file.columns)
-    # return df_file[['days_to_death']].rename(columns={'days_to_death': entry_submitter_id})
-    return pd.DataFrame({entry_submitter_id: combined})
-
-
-file_paths = metadata_clinical['full_path'].tolist()
-entry_submitter_ids = metadata_clinical['entity_submitter_id'].tolist()
-# file_paths = metadata_clinical['full_path'].iloc[:10].tolist()  # to debug using 10 samples
-# set_trace()
-
-print("Creating combined df")
-with ProcessPoolExecutor() as executor:
-    df_list = list(executor.map(read_process_file, file_paths, entry_submitter_ids))
-
-# set_trace()
-concatenated_clinical_df = pd.concat(df_list, axis=1)
-output_file = 'combined_clinical_TCGA-LUAD.csv'
-concatenated_clinical_df.to_csv(output_file, sep='\t', index=False)
-
-# for data in metadata['
-
-set_trace()
 
+SURVIVAL_TAGS = ['days_to_death', 'days_to_last_followup', 'vital_status']
+INTEGER_TAGS = {'days_to_death', 'days_to_last_followup', 'age_at_initial_pathologic_diagnosis',
+                'days_to_birth', 'year_of_initial_pathologic_diagnosis'}
+PARENT_TAGS = ('patient', 'admin')  # (the elements read by the old xpath '//luad:patient | //luad:admin')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]  # without the namespace (luad, clin_shared, shared, ...)
+
+
+def select_clinical_files(metadata, base_dir=base_dir):
+    # Get only rows corresponding to BCR XML files with clinical data
+    metadata_clinical = metadata[metadata['data_format'] == 'BCR XML'].copy()
+    # create a new column that contains the full path for the files
+    metadata_clinical['full_path'] = base_dir + '/' + metadata_clinical['file_id'] + '/' + metadata_clinical['file_name']
+    # extract 'entity_submitter_id' from the 'associated_entities' column
+    metadata_clinical['entity_submitter_id'] = metadata_clinical['associated_entities'].apply(
+        lambda x: x[0]['entity_submitter_id'] if isinstance(x, list) and len(x) > 0 else None)
+    repeats_exist = metadata_clinical['entity_submitter_id'].duplicated().any()
+    print("Do repeats exist? ", repeats_exist)
+    return metadata_clinical[['full_path', 'entity_submitter_id']].reset_index(drop=True)
+
+
+def read_process_file(full_path, entry_submitter_id, tags=tuple(SURVIVAL_TAGS)):
+    """
+    :param tags: local names of the fields (direct children of the patient/admin elements)
+    :return: tuple (entry_submitter_id, value of each tag (text or None))
+    """
+    values = dict.fromkeys(tags)
+    remaining = set(tags)
+    stack = []
+    for event, elem in ET.iterparse(full_path, events=('start', 'end')):
+        if event == 'start':
+            stack.append(_local_name(elem.tag))
+            continue
+        name = stack.pop()
+        if stack and stack[-1] in PARENT_TAGS and name in remaining:
+            text = (elem.text or '').strip()
+            values[name] = text or None
+            remaining.discard(name)
+            if not remaining:
+                break
+        if len(stack) > 1:
+            elem.clear()  # (the parsed subtrees are not needed)
+    return (entry_submitter_id,) + tuple(values[tag] for tag in tags)
+
+
+def to_table(rows, tags):
+    # one typed column per tag: nullable integers for the day/age fields, categories for the others
+    table = pd.DataFrame(rows, columns=['entity_submitter_id'] + list(tags))
+    table.insert(1, 'tcga_id', table['entity_submitter_id'].str.split('-').str[:3].str.join('-'))
+    for tag in tags:
+        if tag in INTEGER_TAGS:
+            table[tag] = pd.to_numeric(table[tag], errors='coerce').astype('Int32')
+        else:
+            table[tag] = table[tag].astype('category')
+    return table
+
+
+def combine_clinical_files(files, tags=tuple(SURVIVAL_TAGS), num_workers=None):
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        rows = list(executor.map(read_process_file, files['full_path'], files['entity_submitter_id'],
+                                 [tuple(tags)] * len(files), chunksize=16))
+    return to_table(rows, tags)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meta_file', type=str, default=meta_file)
+    parser.add_argument('--base_dir', type=str, default=base_dir, help='directory of the GDC download')
+    parser.add_argument('--output', type=str, default='combined_clinical_TCGA-LUAD.parquet')
+    parser.add_argument('--extra_tags', type=str, nargs='*', default=[],
+                        help='other fields of the patient/admin elements (local names, e.g. gender)')
+    parser.add_argument('--num_workers', type=int, default=None)
+    opt = parser.parse_args()
+
+    metadata = pd.read_json(opt.meta_file)
+    files = select_clinical_files(metadata, opt.base_dir)
+    # files = files.iloc[:10]  # to debug using 10 samples
+    tags = SURVIVAL_TAGS + [tag for tag in opt.extra_tags if tag not in SURVIVAL_TAGS]
 
+    print("Creating combined table")
+    start = time.perf_counter()
+    clinical_df = combine_clinical_files(files, tags, opt.num_workers)
+    clinical_df.to_parquet(opt.output, index=False)
+    print(f"{len(clinical_df)} clinical files in {time.perf_counter() - start:.1f} s -> {opt.output}")
+    print(clinical_df['vital_status'].value_counts(dropna=False).to_string())
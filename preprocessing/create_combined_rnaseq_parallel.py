@@ -1,98 +1,135 @@
 # creates a combined file that contains rnaseq data from all samples
+# the expression matrix (genes x samples, float32) is written as a Fortran-order .npy file (every sample column is
+# contiguous) with the gene and sample index files next to it:
+#   <output_prefix>.npy          [n_genes, n_samples] tpm_unstranded
+#   <output_prefix>.genes.tsv    gene_id, gene_name, gene_type of the rows
+#   <output_prefix>.samples.txt  TCGA IDs (e.g. TCGA-44-2655) of the columns
+# the matrix file is preallocated and every worker parses one GDC tsv file at a time, keeps only the protein coding rows
+# (row mask from the first file, shared with the workers once) and writes its column straight into the memory mapped file,
+# so the memory stays close to the size of one column per worker (the old version concatenated the full 60k x N frame)
+# python create_combined_rnaseq_parallel.py --output_prefix combined_rnaseq_TCGA-LUAD --num_workers 16
+# python create_combined_rnaseq_parallel.py --tsv combined_rnaseq_TCGA-LUAD.tsv   # also the old tab-separated table
 
+import os
+import time
+import argparse
+import numpy as np
 import pandas as pd
-import xml.etree.ElementTree as ET
 from pdb import set_trace
-import os
 from concurrent.futures import ProcessPoolExecutor
 
 # read the metadata json file that contains the paths to the clinical and the rnaseq tsv files
 base_dir = '/mnt/c/Users/tnandi/Downloads/TCGA-LUAD-RNASeq_clinical_all/gdc_download_20240224_072723.742270.tar/'
 meta_file = '/mnt/c/Users/tnandi/Downloads/TCGA-LUAD-RNASeq_clinical_all/metadata.cart.2024-02-24.json'
-metadata = pd.read_json(meta_file)
-
-# Get only rows corresponding to TSV files with rnaseq data
-metadata_rnaseq = metadata[metadata['data_format'] == 'TSV']
-
-# create a new column that contains the full path for the files
-metadata_rnaseq['full_path'] = base_dir + '/' + metadata_rnaseq['file_id'] + '/' + metadata_rnaseq['file_name']
-
-# extract 'entity_submitter_id' from the 'associated_entities' column
-metadata_rnaseq['entity_submitter_id'] = metadata_rnaseq['associated_entities'].apply(
-    lambda x: x[0]['entity_submitter_id'] if isinstance(x, list) and len(x) > 0 else None)
-
-# metadata_rnaseq['entity_submitter_id'] = metadata_rnaseq['entity_submitter_id'].str.split('-').apply(lambda x: '-'.join(x[:5]))
-repeats_exist = metadata_rnaseq['entity_submitter_id'].duplicated().any()
-print("Do repeats exist? ", repeats_exist)
-
-
-def read_process_file(full_path, entry_submitter_id):
-    df_file = pd.read_csv(full_path, sep='\t', header=1, skiprows=[2, 3, 4, 5])
-    # print(df_file)
-    # print(df_file['gene_name'][1234])
-    # return df_file[['tpm_unstranded']] if 'tpm_unstranded' in df_file else pd.DataFrame()
-    return df_file[['tpm_unstranded']].rename(columns={'tpm_unstranded': entry_submitter_id})
-
-
-file_paths = metadata_rnaseq['full_path'].tolist()
-entry_submitter_ids = metadata_rnaseq['entity_submitter_id'].tolist()
-# file_paths = metadata_rnaseq['full_path'].iloc[:10].tolist()  # to debug using 10 samples
-# set_trace()
-
-# Get the gene IDs and gene names from a single rnaseq file
-df_single = pd.read_csv(file_paths[0], sep='\t', header=1, skiprows=[2, 3, 4, 5])
-gene_df = {
-    'gene_id': df_single['gene_id'],
-    'gene_name': df_single['gene_name'],
-    'gene_type': df_single['gene_type']
-}
-gene_columns_df = pd.DataFrame(gene_df)
-
-print("Creating combined df")
-with ProcessPoolExecutor() as executor:
-    df_list = list(executor.map(read_process_file, file_paths, entry_submitter_ids))
-
-concatenated_rnaseq_df = pd.concat(df_list, axis=1)
-concatenated_rnaseq_with_gene_ids_df = pd.concat([gene_columns_df, concatenated_rnaseq_df], axis=1)
-output_file = 'combined_rnaseq_TCGA-LUAD.csv'
-# set_trace()
-# concatenated_rnaseq_with_gene_ids_df.to_csv(output_file, sep='\t', index=False)
-# set_trace()
-
-# keep only the protein coding genes
-data_rnaseq_df = concatenated_rnaseq_with_gene_ids_df[concatenated_rnaseq_with_gene_ids_df['gene_type'] == 'protein_coding']
-# for some of the samples, there may be more than one rnaseq dataset (those with -01A- or -01B-are from the primary tumor while those with -11A- are from tissue adjacent to the tumor (so, normal?)
-# https://docs.gdc.cancer.gov/Encyclopedia/pages/images/TCGA-TCGAbarcode-080518-1750-4378.pdf
-# in such cases, we will keep only one tumor sample (-01A-)
-# Remove columns that have -11A- within their names
-filtered_columns = ['gene_id', 'gene_name', 'gene_type'] + [col for col in data_rnaseq_df.columns if '-01A-' in col]
-data_rnaseq_df = data_rnaseq_df[filtered_columns]
-
-# rename the columns by keeping only the minimal part of the TCGA ID, e.g.,  TCGA-44-2655
-column_mapping = {
-    col: '-'.join(col.split('-')[:3]) if 'TCGA' in col else col
-    for col in data_rnaseq_df.columns
-}
-data_rnaseq_df = data_rnaseq_df.rename(columns=column_mapping)
-data_rnaseq_df = data_rnaseq_df.loc[:, ~data_rnaseq_df.columns.duplicated()]
-data_rnaseq_df.to_csv(output_file, sep='\t', index=False)
-set_trace()
-
-# tree = ET.parse(
-#     '/mnt/c/Users/tnandi/Downloads/TCGA-LUAD_clinical.tar/00e01b05-d939-49e6-b808-e1bab0d6773b/nationwidechildrens.org_clinical.TCGA-J2-8192.xml')
-# root = tree.getroot()
-#
-# data = []
-#
-# for child in root:
-#     row = {}
-#     for subchild in child:
-#         row[subchild.tag] = subchild.text
-#     data.append(row)
-#
-# df = pd.DataFrame(data)
-#
-# # df.set_index('id', inplace=True)
-#
-# print(df)
-# set_trace()
+
+GENE_COLUMNS = ['gene_id', 'gene_name', 'gene_type']
+# set by the pool initializer (once per worker): row mask of the kept genes and the gene ids of all the rows
+_row_mask = None
+_gene_ids = None
+
+
+def read_gene_columns(full_path):
+    # the 4 rows after the header are the N_unmapped, N_multimapping, ... counts
+    return pd.read_csv(full_path, sep='\t', header=1, skiprows=[2, 3, 4, 5], usecols=GENE_COLUMNS)
+
+
+def select_samples(metadata, base_dir=base_dir, sample_type='-01A-'):
+    """
+    :return: DataFrame with full_path and tcga_id of the rnaseq files to combine (one per patient)
+    """
+    # Get only rows corresponding to TSV files with rnaseq data
+    metadata_rnaseq = metadata[metadata['data_format'] == 'TSV'].copy()
+    # create a new column that contains the full path for the files
+    metadata_rnaseq['full_path'] = base_dir + '/' + metadata_rnaseq['file_id'] + '/' + metadata_rnaseq['file_name']
+    # extract 'entity_submitter_id' from the 'associated_entities' column
+    metadata_rnaseq['entity_submitter_id'] = metadata_rnaseq['associated_entities'].apply(
+        lambda x: x[0]['entity_submitter_id'] if isinstance(x, list) and len(x) > 0 else None)
+    repeats_exist = metadata_rnaseq['entity_submitter_id'].duplicated().any()
+    print("Do repeats exist? ", repeats_exist)
+    # for some of the samples, there may be more than one rnaseq dataset (those with -01A- or -01B-are from the primary tumor while those with -11A- are from tissue adjacent to the tumor (so, normal?)
+    # https://docs.gdc.cancer.gov/Encyclopedia/pages/images/TCGA-TCGAbarcode-080518-1750-4378.pdf
+    # in such cases, we will keep only one tumor sample (-01A-); selected before parsing, so the other files aren't read
+    samples = metadata_rnaseq[metadata_rnaseq['entity_submitter_id'].fillna('').str.contains(sample_type, regex=False)]
+    # keep only the minimal part of the TCGA ID, e.g.,  TCGA-44-2655 (first file of a patient, as before)
+    samples = samples.assign(tcga_id=samples['entity_submitter_id'].str.split('-').str[:3].str.join('-'))
+    return samples.drop_duplicates('tcga_id')[['full_path', 'tcga_id']].reset_index(drop=True)
+
+
+def _init_worker(row_mask, gene_ids):
+    global _row_mask, _gene_ids
+    _row_mask, _gene_ids = row_mask, gene_ids
+
+
+def read_process_file(full_path, column, matrix_path):
+    df_file = pd.read_csv(full_path, sep='\t', header=1, skiprows=[2, 3, 4, 5], usecols=['gene_id', 'tpm_unstranded'],
+                          dtype={'tpm_unstranded': np.float32})
+    if len(df_file) != len(_gene_ids) or not np.array_equal(df_file['gene_id'].to_numpy(), _gene_ids):
+        raise ValueError(f"{full_path} has different genes (or gene order) than the first rnaseq file")
+    matrix = np.load(matrix_path, mmap_mode='r+')
+    matrix[:, column] = df_file['tpm_unstranded'].to_numpy()[_row_mask]
+    matrix.flush()
+    return column
+
+
+def build_expression_matrix(samples, output_prefix, gene_types=('protein_coding',), num_workers=None):
+    """
+    :param samples: DataFrame with full_path and tcga_id (columns of the matrix, in this order)
+    :return: shape of the matrix
+    """
+    gene_columns_df = read_gene_columns(samples['full_path'].iloc[0])
+    row_mask = gene_columns_df['gene_type'].isin(gene_types).to_numpy()
+    gene_columns_df[row_mask].to_csv(output_prefix + '.genes.tsv', sep='\t', index=False)
+    samples['tcga_id'].to_csv(output_prefix + '.samples.txt', index=False, header=False)
+
+    matrix_path = output_prefix + '.npy'
+    shape = (int(row_mask.sum()), len(samples))
+    np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=shape, fortran_order=True).flush()
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(row_mask, gene_columns_df['gene_id'].to_numpy())) as executor:
+        for done, _ in enumerate(executor.map(read_process_file, samples['full_path'], range(len(samples)),
+                                              [matrix_path] * len(samples), chunksize=8), 1):
+            if done % 100 == 0:
+                print(f"{done}/{len(samples)} files")
+    return shape
+
+
+def load_expression_matrix(output_prefix, mmap_mode='r'):
+    """
+    :return: matrix [n_genes, n_samples] (memory mapped), gene DataFrame, list of sample ids
+    """
+    matrix = np.load(output_prefix + '.npy', mmap_mode=mmap_mode)
+    genes = pd.read_csv(output_prefix + '.genes.tsv', sep='\t')
+    with open(output_prefix + '.samples.txt') as f:
+        sample_ids = f.read().split()
+    return matrix, genes, sample_ids
+
+
+def write_tsv(output_prefix, tsv_path):
+    # the table of the old version: gene_id, gene_name, gene_type and one column per sample
+    matrix, genes, sample_ids = load_expression_matrix(output_prefix)
+    data_rnaseq_df = pd.concat([genes.reset_index(drop=True), pd.DataFrame(np.asarray(matrix), columns=sample_ids)], axis=1)
+    data_rnaseq_df.to_csv(tsv_path, sep='\t', index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meta_file', type=str, default=meta_file)
+    parser.add_argument('--base_dir', type=str, default=base_dir, help='directory of the GDC download')
+    parser.add_argument('--output_prefix', type=str, default='combined_rnaseq_TCGA-LUAD')
+    parser.add_argument('--gene_types', type=str, nargs='+', default=['protein_coding'])
+    parser.add_argument('--sample_type', type=str, default='-01A-', help='kept sample type (primary tumor)')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--tsv', type=str, default=None, help='also write the combined tab-separated table')
+    opt = parser.parse_args()
+
+    metadata = pd.read_json(opt.meta_file)
+    samples = select_samples(metadata, opt.base_dir, opt.sample_type)
+    # samples = samples.iloc[:10]  # to debug using 10 samples
+
+    print("Creating combined matrix")
+    start = time.perf_counter()
+    shape = build_expression_matrix(samples, opt.output_prefix, opt.gene_types, opt.num_workers)
+    print(f"{shape[0]} genes x {shape[1]} samples in {time.perf_counter() - start:.1f} s -> {opt.output_prefix}.npy "
+          f"({shape[0] * shape[1] * 4 / 2 ** 20:.1f} MiB)")
+    if opt.tsv is not None:
+        write_tsv(opt.output_prefix, opt.tsv)
@@ -5,8 +5,12 @@ import ast
 import random
 import numpy as np
 from pdb import set_trace
+from build_tile_manifest import build_manifest, write_manifest
 
 num_tiles_per_wsi = 1000 # number of tiles to keep per WSI (tradeoff between information content and compute requirement)
+# set subsample_tiles = False to keep all the tiles of every WSI; training then samples a fixed number of tiles per slide and epoch
+# (trainer.py --tiles_per_slide), so WSIs with fewer tiles don't need to be dropped
+subsample_tiles = True
 
 base_dir = '/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/'  # for Polaris
 tiles_dir = base_dir + 'TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_single_sample_per_patient_13july/tiles/256px_9.9x/'
@@ -22,6 +26,12 @@ tiles_dir = base_dir + 'TCGA_WSI/LUAD_all/svs_files/FFPE_tiles_single_sample_per
 output_csv_path = base_dir + './mapped_data_31Jan_1000tiles.csv'
 # json file with the mapped data
 output_json_path = base_dir + './mapped_data_31Jan_1000tiles.json'
+# tile index of tiles_dir (written/updated by build_tile_manifest.py, updated here if slide directories were added or
+# changed) instead of listing all the tile directories; train with trainer.py --tile_manifest <tile_manifest_path> to read
+# the tiles from their per-slide directories (no copy into a flat 'combined' directory with copy_to_combined.sh)
+use_tile_manifest = True
+tile_manifest_path = tiles_dir + 'tile_manifest.parquet'
+min_tissue_fraction = None  # e.g. 0.4, with the tissue fractions in the manifest (build_tile_manifest.py --tissue_manifest)
 
 rnaseq_clinical_df = pd.read_csv('./rnaseq_clinical_28Jan.csv') # generated by tcga_luad.heidi_rnaseq_xenabrowser_clinical.ipynb
 png_files_dict = {}
@@ -30,24 +40,40 @@ png_files_dict = {}
 count_tcga_wsi = 0
 
 # use only num_tiles_per_wsi (currently set to 200) randomly chosen tiles from each WSI
-for tile_dir in os.listdir(tiles_dir):
-    if "TCGA" in tile_dir:  # skipping the "combined_tiles" directory
-        count_tcga_wsi += 1
-        count_tiles = 0
-        for filename in os.listdir(os.path.join(tiles_dir, tile_dir)):
-            if filename.endswith('.png') or filename.endswith('.jpg'):
-                count_tiles += 1
-                tcga_id = '-'.join(filename.split('-')[:3])
-                if tcga_id in png_files_dict:
-                    png_files_dict[tcga_id].append(filename)
-                else:
-                    png_files_dict[tcga_id] = [filename]
-        print("ID: ", tile_dir, " count_tiles: ", count_tiles)
+if use_tile_manifest:
+    # only the slide directories that are new or changed since the last run are scanned (see build_tile_manifest.py)
+    tile_manifest, n_scanned = build_manifest(tiles_dir, tile_manifest_path)
+    if n_scanned > 0:
+        write_manifest(tile_manifest, tile_manifest_path)
+    print(f"tile manifest: {len(tile_manifest)} tiles, {n_scanned} slide directories scanned")
+    if min_tissue_fraction is not None:
+        n_unknown = int(tile_manifest['tissue_fraction'].isna().sum())
+        if n_unknown:  # (tiles added since the last build_tile_manifest.py --tissue_manifest)
+            print(f"Warning: {n_unknown} tiles without a tissue fraction are dropped by min_tissue_fraction")
+        tile_manifest = tile_manifest[tile_manifest['tissue_fraction'] > min_tissue_fraction]
+    count_tcga_wsi = tile_manifest['slide_id'].nunique()
+    png_files_dict = tile_manifest.groupby('patient_id', observed=True)['tile'].agg(list).to_dict()
+    for slide_id, count_tiles in tile_manifest.groupby('slide_id', observed=True).size().items():
+        print("ID: ", slide_id, " count_tiles: ", count_tiles)
+else:
+    for tile_dir in os.listdir(tiles_dir):
+        if "TCGA" in tile_dir:  # skipping the "combined_tiles" directory
+            count_tcga_wsi += 1
+            count_tiles = 0
+            for filename in os.listdir(os.path.join(tiles_dir, tile_dir)):
+                if filename.endswith('.png') or filename.endswith('.jpg'):
+                    count_tiles += 1
+                    tcga_id = '-'.join(filename.split('-')[:3])
+                    if tcga_id in png_files_dict:
+                        png_files_dict[tcga_id].append(filename)
+                    else:
+                        png_files_dict[tcga_id] = [filename]
+            print("ID: ", tile_dir, " count_tiles: ", count_tiles)
 
 # limit each key to have only 'num_tiles_per_wsi' files in val
 count_gt_tiles_per_wsi = 0
 for tcga_id in png_files_dict:
-    if len(png_files_dict[tcga_id]) > num_tiles_per_wsi:
+    if subsample_tiles and len(png_files_dict[tcga_id]) > num_tiles_per_wsi:
         count_gt_tiles_per_wsi += 1
         png_files_dict[tcga_id] = random.sample(png_files_dict[tcga_id], num_tiles_per_wsi)
 
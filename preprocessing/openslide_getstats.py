@@ -1,18 +1,67 @@
 import os
+import time
+import hashlib
+import argparse
+from multiprocessing import Pool
 import openslide
 import pandas as pd
 
+# slide metadata (MPP, magnification, dimensions, pyramid levels) of all the .svs files of a directory tree, read with a
+# process pool and stored in a parquet table keyed by a hash of the slide file; on reruns only the new or changed slides
+# are opened (unchanged path/size/mtime: the stored hash is reused, moved/renamed files are recognized by their hash)
+# the table is written every --flush_every slides, so an interrupted run keeps its progress
+# thumbnails are optional: --thumbnails writes them during the scan, otherwise get_thumbnail creates them on first use
+# python openslide_getstats.py --slides_dir <dir> --table slide_statistics.parquet --num_workers 16
+# python openslide_getstats.py --slides_dir <dir> --thumbnails --csv slide_statistics.csv
+
 slides_dir = '/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/TCGA_WSI/LUAD_all/svs_files/FFPE_single_sample_per_patient/'
 output_dir = '/lus/eagle/clone/g2/projects/GeomicVar/tarak/multimodal_learning_T1/preprocessing/png_files/'
 
-def save_slide_as_png(slide, slide_path):
-    thumbnail = slide.get_thumbnail((1024, 1024))  # Create a thumbnail
-    png_filename = os.path.join(output_dir, os.path.basename(slide_path).replace('.svs', '.png'))
+HASH_CHUNK = 2 ** 20  # bytes hashed at the start and at the end of a slide file
+
+
+def file_key(slide_path):
+    # hash of the size and of the first and last MiB of the file (the whole svs file would take ~seconds per slide);
+    # the tiff header/directories at the start and the last tiles change with any rewrite of the slide
+    digest = hashlib.sha1()
+    size = os.path.getsize(slide_path)
+    digest.update(str(size).encode())
+    with open(slide_path, 'rb') as f:
+        digest.update(f.read(HASH_CHUNK))
+        if size > 2 * HASH_CHUNK:
+            f.seek(-HASH_CHUNK, os.SEEK_END)
+            digest.update(f.read(HASH_CHUNK))
+    return digest.hexdigest()
+
+
+def thumbnail_path(slide_path, thumbnail_dir):
+    return os.path.join(thumbnail_dir, os.path.basename(slide_path).replace('.svs', '.png'))
+
+
+def save_slide_as_png(slide, slide_path, thumbnail_dir=output_dir, size=1024):
+    thumbnail = slide.get_thumbnail((size, size))  # Create a thumbnail
+    png_filename = thumbnail_path(slide_path, thumbnail_dir)
     thumbnail.save(png_filename)
     return png_filename
 
 
-def get_slide_stats(slide_path):
+def get_thumbnail(slide_path, thumbnail_dir=output_dir, size=1024):
+    """
+    :return: path of the thumbnail of a slide, created if it doesn't exist yet
+    """
+    png_filename = thumbnail_path(slide_path, thumbnail_dir)
+    if not os.path.exists(png_filename):
+        os.makedirs(thumbnail_dir, exist_ok=True)
+        slide = openslide.OpenSlide(slide_path)
+        save_slide_as_png(slide, slide_path, thumbnail_dir, size)
+        slide.close()
+    return png_filename
+
+
+def get_slide_stats(slide_path, thumbnail_dir=None, thumbnail_size=1024):
+    """
+    :param thumbnail_dir: also write a thumbnail of the slide to this directory (None: no thumbnail)
+    """
     try:
         slide = openslide.OpenSlide(slide_path)
         mpp_x = slide.properties.get('openslide.mpp-x')
@@ -22,10 +71,10 @@ def get_slide_stats(slide_path):
         if base_magnification is not None:
             base_magnification = float(base_magnification)
 
-        downsample_factors = slide.level_downsamples
+        downsample_factors = list(slide.level_downsamples)
         magnifications = [base_magnification / ds if base_magnification else None for ds in downsample_factors]
 
-        png_path = save_slide_as_png(slide, slide_path)
+        png_path = save_slide_as_png(slide, slide_path, thumbnail_dir, thumbnail_size) if thumbnail_dir else None
 
         slide_stats = {
             'File': os.path.basename(slide_path),
@@ -42,7 +91,6 @@ def get_slide_stats(slide_path):
             'PNG Path': png_path
         }
         slide.close()
-        print(slide_stats)
         return slide_stats
     except openslide.OpenSlideError as e:
         return {'File': os.path.basename(slide_path), 'Error': str(e)}
@@ -50,16 +98,84 @@ def get_slide_stats(slide_path):
         return {'File': os.path.basename(slide_path), 'Error': 'MPP metadata is missing'}
 
 
-def get_all_slides_stats(slides_dir):
-    stats = []
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def _index_slide(args):
+    slide_path, key, thumbnail_dir, thumbnail_size = args
+    stat = os.stat(slide_path)
+    stats = get_slide_stats(slide_path, thumbnail_dir, thumbnail_size)
+    stats.update({'File Key': key or file_key(slide_path), 'Path': slide_path, 'Size': stat.st_size,
+                  'Mtime': stat.st_mtime})
+    return stats
+
+
+def list_slides(slides_dir):
+    slide_paths = []
     for root, _, files in os.walk(slides_dir):
         for file in files:
             if file.endswith('.svs'):
-                slide_path = os.path.join(root, file)
-                stats.append(get_slide_stats(slide_path))
-    return stats
+                slide_paths.append(os.path.join(root, file))
+    return sorted(slide_paths)
+
+
+def write_table(table, table_path):
+    # (written to a temporary file first, so that an interrupted write doesn't corrupt the table)
+    table = table.drop_duplicates('Path', keep='last').sort_values('Path').reset_index(drop=True)
+    for column in ['MPP X', 'MPP Y', 'PNG Path', 'Error']:
+        if column in table.columns:
+            table[column] = table[column].astype('string')
+    table.to_parquet(table_path + '.tmp', index=False)
+    os.replace(table_path + '.tmp', table_path)
+    return table
+
+
+def index_slides(slides_dir, table_path, num_workers=None, thumbnail_dir=None, thumbnail_size=1024, flush_every=64):
+    """
+    :param table_path: parquet table of the slide metadata (read and updated)
+    :param thumbnail_dir: also write the thumbnails of the (new) slides to this directory
+    :return: table of all the slides under slides_dir, number of slides opened
+    """
+    slide_paths = list_slides(slides_dir)
+    table = pd.read_parquet(table_path) if os.path.exists(table_path) else pd.DataFrame(
+        columns=['File Key', 'Path', 'Size', 'Mtime'])
+    ok = table[table['Error'].isna()] if 'Error' in table.columns else table  # slides that failed are retried
+    known = {(row['Path'], row['Size'], row['Mtime']): row['File Key'] for _, row in ok.iterrows()}
+
+    # slides whose path, size and mtime are unchanged are skipped without reading them
+    todo = []
+    for slide_path in slide_paths:
+        stat = os.stat(slide_path)
+        if (slide_path, stat.st_size, stat.st_mtime) not in known:
+            todo.append(slide_path)
+    kept = table[table['Path'].isin(set(slide_paths) - set(todo))]
+
+    num_workers = num_workers or os.cpu_count()
+    with Pool(processes=num_workers) as pool:
+        # moved/renamed (but otherwise unchanged) slides: reuse their metadata
+        keys = pool.map(file_key, todo, chunksize=4)
+        by_key = ok.drop_duplicates('File Key').set_index('File Key') if len(ok) else None
+        moved, new = [], []
+        for slide_path, key in zip(todo, keys):
+            if by_key is not None and key in by_key.index:
+                row = by_key.loc[key].to_dict()
+                stat = os.stat(slide_path)
+                row.update({'File Key': key, 'Path': slide_path, 'File': os.path.basename(slide_path),
+                            'Size': stat.st_size, 'Mtime': stat.st_mtime})
+                moved.append(row)
+            else:
+                new.append((slide_path, key, thumbnail_dir, thumbnail_size))
+        table = pd.concat([kept, pd.DataFrame(moved)], ignore_index=True) if moved else kept
+
+        rows = []
+        for i, stats in enumerate(pool.imap_unordered(_index_slide, new), 1):
+            rows.append(stats)
+            if 'Error' in stats:
+                print(f"{stats['File']}: {stats['Error']}")
+            if i % flush_every == 0 or i == len(new):
+                table = write_table(pd.concat([table, pd.DataFrame(rows)], ignore_index=True), table_path)
+                rows = []
+                print(f"{i}/{len(new)} slides indexed")
+    if not new:
+        table = write_table(table, table_path)
+    return table, len(new)
 
 
 def save_stats_to_csv(slide_stats, filename='slide_statistics.csv'):
@@ -68,6 +184,24 @@ def save_stats_to_csv(slide_stats, filename='slide_statistics.csv'):
     print(f"Slide statistics saved to {filename}")
 
 
-# get stats for all slides and save them to a CSV file
-slide_stats = get_all_slides_stats(slides_dir)
-save_stats_to_csv(slide_stats)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slides_dir', type=str, default=slides_dir)
+    parser.add_argument('--table', type=str, default='slide_statistics.parquet', help='parquet table of the slide metadata')
+    parser.add_argument('--csv', type=str, default=None, help='also save the table as csv')
+    parser.add_argument('--thumbnails', action='store_true', help='write the thumbnails of the new slides during the scan')
+    parser.add_argument('--thumbnail_dir', type=str, default=output_dir)
+    parser.add_argument('--thumbnail_size', type=int, default=1024)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--flush_every', type=int, default=64, help='write the table every this many new slides')
+    opt = parser.parse_args()
+
+    thumbnail_dir = opt.thumbnail_dir if opt.thumbnails else None
+    if thumbnail_dir is not None:
+        os.makedirs(thumbnail_dir, exist_ok=True)
+    start = time.perf_counter()
+    table, n_opened = index_slides(opt.slides_dir, opt.table, opt.num_workers, thumbnail_dir, opt.thumbnail_size,
+                                   opt.flush_every)
+    print(f"{len(table)} slides ({n_opened} opened) in {time.perf_counter() - start:.1f} s -> {opt.table}")
+    if opt.csv is not None:
+        save_stats_to_csv(table, opt.csv)
@@ -6,6 +6,7 @@ from sklearn.manifold import TSNE
 import umap
 from sklearn.preprocessing import StandardScaler
 import numpy as np
+from batch_effect_metrics import permutation_test
 
 data = pd.read_csv('./combined_rnaseq_TCGA-LUAD.tsv', delimiter='\t')
 data_bc = pd.read_csv('./batchcorrected_combined_rnaseq_TCGA-LUAD.tsv', delimiter='\t')
@@ -63,49 +64,12 @@ tissue_sites = np.unique(tissue_labels)
 # standardizing the features
 # numeric_data = StandardScaler().fit_transform(numeric_data)
 
-# calculate the global (over tissue sites) mean for each gene
-global_mean = numeric_data.mean(axis=0)
-
-# total number of samples
-total_n = numeric_data.shape[0]
-
-# initialize dictionary to store DSC values
-dsc_values = {}
-# set_trace()
-# loop over each unique tissue site
-batch_count = 0
-for site in tissue_sites:
-    batch_count += 1
-    print(f"{batch_count} of {len(tissue_sites)} batches")
-    site_mask = tissue_labels == site
-    # set_trace()
-    site_data = numeric_data[site_mask, :]
-    site_mean = np.mean(site_data, axis=0)
-
-    # number of samples in site
-    n_site = site_data.shape[0]
-
-    # proportion of samples in this site
-    pi_i = n_site / total_n
-
-    # within-site scatter matrix (Sw)
-    deviations_within = site_data - site_mean
-    Sw = np.dot(deviations_within.T, deviations_within)
-
-    # between-site scatter matrix (Sb)
-    mean_deviation_between = site_mean - global_mean
-    Sb = n_site * pi_i * np.dot(mean_deviation_between[:, None], mean_deviation_between[None, :])
-
-    # calculate DSC
-    Db = np.sqrt(np.trace(Sb))
-    Dw = np.sqrt(np.trace(Sw))
-    DSC = Db / Dw if Dw != 0 else 0  # Avoid division by zero
-    dsc_values[site] = DSC
-    print(f"Tissue site: {site}, DSC: {DSC}")
-    set_trace()
+# DSC of every tissue site and of all the sites together, with permutation p-values (see batch_effect_metrics.py;
+# computed from sums of squared deviations, without the genes x genes scatter matrices)
+dsc_df = permutation_test(numeric_data.to_numpy(dtype=np.float64), tissue_labels, n_permutations=1000)
+print(dsc_df.to_string(index=False))
 
 # Output DSC values
-dsc_df = pd.DataFrame(list(dsc_values.items()), columns=['Tissue_Site', 'DSC'])
 dsc_df.to_csv('dsc_values.csv', index=False)
 print("DSC values saved to 'dsc_values.csv'.")
 
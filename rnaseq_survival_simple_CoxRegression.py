@@ -1,15 +1,18 @@
 # Code to carry out simple Cox regression analysis using the RNASeq data as the covariates and the survival time as the target
+# all the genes are screened with univariate Cox models (vectorized over the genes, see cox_screening.py), then an
+# elastic net penalized Cox model is fit on the top_k genes
 import pandas as pd
 import numpy as np
 from collections import Counter
-import ast
-from lifelines import CoxPHFitter
 from sklearn.feature_selection import VarianceThreshold
-from pdb import set_trace
+from cox_screening import univariate_cox, coxnet, standardize, concordance_index
 
 base_dir = '/mnt/c/Users/tnandi/Downloads/multimodal_lucid/multimodal_lucid/preprocessing/'
 data_rnaseq_all_genes_df = pd.read_csv(base_dir + 'combined_rnaseq_TCGA-LUAD.tsv', delimiter='\t')
-data_clinical_df = pd.read_csv(base_dir + 'combined_clinical_TCGA-LUAD.tsv', delimiter='\t')
+# typed clinical table of preprocessing/create_combined_clinical_parallel.py
+data_clinical_df = pd.read_parquet(base_dir + 'combined_clinical_TCGA-LUAD.parquet')
+top_k = 200  # genes of the penalized model (smallest score test p-values)
+l1_ratio = 0.5
 
 
 ############################   CLEAN THE RNASEQ DATASET #####################################
@@ -44,27 +47,10 @@ print("Non-unique column names:", non_unique_columns)
 # data_clinical_df = data_clinical_df[common_columns]
 # data_rnaseq_df = data_rnaseq_df[common_columns]
 # set_trace()
-# extract 'days_to_death' and 'vital_status' into lists for each column
-days_to_death_list = []
-vital_status_list = []
-tcga_sample_list = []
-for col in data_clinical_df.columns:
-    print(data_clinical_df[col])
-    # print(col)
-    val = data_clinical_df[col].values[0]
-    val = val.replace('nan', 'None')
-    try:
-        val_list = ast.literal_eval(val)
-    except ValueError as e:
-        print(f"Error processing column {col}: {e}")
-        continue
-    print(val_list)
-    # set_trace()
-    days_to_death = val_list[0]
-    vital_status = val_list[1]
-    days_to_death_list.append(days_to_death)
-    vital_status_list.append(vital_status)
-    tcga_sample_list.append(col)
+# survival time: days to death for the deceased patients, days to the last follow up for the others
+data_clinical_df = data_clinical_df.drop_duplicates('tcga_id').set_index('tcga_id')
+is_dead = data_clinical_df['vital_status'] == 'Dead'
+time_to_event = data_clinical_df['days_to_death'].where(is_dead, data_clinical_df['days_to_last_followup'])
 
 ####################################### PROCESS DATSETS FOR COX REGRESSION ANALYSIS ####################
 data_rnaseq_df = data_rnaseq_df.set_index('gene_name').T
@@ -72,10 +58,9 @@ data_rnaseq_df = data_rnaseq_df.set_index('gene_name').T
 data_rnaseq_df = data_rnaseq_df.drop(['gene_id', 'gene_type'], errors='ignore')
 
 data_clinical_df = pd.DataFrame({
-    'sample_id': tcga_sample_list,
-    'time_to_event': days_to_death_list,
-    'event_occurred': vital_status_list
-}).set_index('sample_id')
+    'time_to_event': time_to_event.astype(float),
+    'event_occurred': is_dead.astype(int)
+}).dropna()
 
 
 # find the common TCGA sample names
@@ -87,22 +72,25 @@ data_rnaseq_df = data_rnaseq_df.loc[common_rows]
 
 # set_trace()
 ############################################# SET UP COX REGRESSION #################
-combined_df = pd.concat([data_rnaseq_df, data_clinical_df], axis=1)
-combined_df['event_occurred'] = combined_df['event_occurred'].apply(lambda x: 1 if x == 'Dead' else 0)
-
 # remove low variance columns
-X = combined_df.iloc[:, :-2]
+X = data_rnaseq_df.astype(float)
 selector = VarianceThreshold(threshold=0.01)
-X_high_variance = selector.fit_transform(X)
-X_high_variance_df = pd.DataFrame(X_high_variance, columns=X.columns[selector.get_support()])
-combined_df = pd.concat([X_high_variance_df, combined_df.iloc[:, -2:]], axis=1)
-
-print(combined_df)
-
-model = CoxPHFitter()
-model.fit(combined_df, duration_col='time_to_event', event_col='event_occurred')
-print(model.summary)
-
-set_trace()
-
-
+selector.fit(X)
+X = X.loc[:, selector.get_support()]
+time_to_event = data_clinical_df['time_to_event'].to_numpy()
+event_occurred = data_clinical_df['event_occurred'].to_numpy()
+
+# univariate screening of all the genes
+screening_df = univariate_cox(X.to_numpy(), time_to_event, event_occurred, genes=X.columns)
+print(screening_df.head(20))
+screening_df.to_csv('univariate_cox_screening.csv')
+
+# penalized multivariate model on the top genes
+top_genes = screening_df.index[:top_k]
+X_top = standardize(X[top_genes].to_numpy())
+lambdas, path = coxnet(X_top, time_to_event, event_occurred, l1_ratio=l1_ratio)
+# (the C-index is computed on the samples the model is fit on, so it is an optimistic in-sample estimate)
+for lam, beta in zip(lambdas, path):
+    print(f"lambda {lam:.4f}: {(beta != 0).sum()} genes, in-sample C-index {concordance_index(time_to_event, X_top @ beta, event_occurred):.3f}")
+coefficients = pd.Series(path[-1], index=top_genes)
+print(coefficients[coefficients != 0].sort_values())